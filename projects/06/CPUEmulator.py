@@ -0,0 +1,492 @@
+import argparse
+import sys
+import time
+
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+
+from assembler import COMP_TABLE, load_rom, load_symbols
+
+argparser = argparse.ArgumentParser(
+    description="Emulator for the Hack computer",
+    prog="CPUEmulator",
+)
+argparser.add_argument(
+    "file",
+    help=".hack, .bin or .himg file produced by the assembler to be loaded into ROM.",
+    type=str,
+)
+argparser.add_argument(
+    "--headless",
+    help="run without a screen window, e.g. for regression suites in CI.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-t",
+    "--translate",
+    help="translate straight-line blocks of ROM into Python functions instead of interpreting instructions one at a time.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-n",
+    "--steps",
+    help="maximum number of instructions to execute. (default: run until the program halts)",
+    type=int,
+    default=None,
+)
+argparser.add_argument(
+    "--set",
+    help="set RAM[ADDRESS] to VALUE before running, e.g. --set 0=3. Can be repeated.",
+    action="append",
+    default=[],
+    metavar="ADDRESS=VALUE",
+)
+argparser.add_argument(
+    "--ram",
+    help="print RAM[START..END] (inclusive) as signed values after running, e.g. --ram 256:260. Can be repeated.",
+    action="append",
+    default=[],
+    metavar="START[:END]",
+)
+argparser.add_argument(
+    "--screenshot",
+    help="write the screen to a .pbm file after running.",
+    type=str,
+    default=None,
+)
+
+ROM_SIZE = 32768
+RAM_SIZE = 32768
+SCREEN = 16384
+SCREEN_WIDTH = 512
+SCREEN_HEIGHT = 256
+SCREEN_SIZE = SCREEN_WIDTH * SCREEN_HEIGHT // 16
+KBD = 24576
+
+WORD_MASK = 0xFFFF
+SIGN_BIT = 0x8000
+
+# ALU output for every comp mnemonic of the assembler, as a Python expression over A, D
+# and M given as unsigned 16-bit words
+_ALU_EXPRESSIONS = {
+    "0": "0",
+    "1": "1",
+    "-1": "WORD_MASK",
+    "D": "{d}",
+    "A": "{a}",
+    "!D": "{d} ^ WORD_MASK",
+    "!A": "{a} ^ WORD_MASK",
+    "-D": "-{d} & WORD_MASK",
+    "-A": "-{a} & WORD_MASK",
+    "D+1": "({d} + 1) & WORD_MASK",
+    "A+1": "({a} + 1) & WORD_MASK",
+    "D-1": "({d} - 1) & WORD_MASK",
+    "A-1": "({a} - 1) & WORD_MASK",
+    "D+A": "({d} + {a}) & WORD_MASK",
+    "D-A": "({d} - {a}) & WORD_MASK",
+    "A-D": "({a} - {d}) & WORD_MASK",
+    "D&A": "{d} & {a}",
+    "D|A": "{d} | {a}",
+    "M": "{m}",
+    "!M": "{m} ^ WORD_MASK",
+    "-M": "-{m} & WORD_MASK",
+    "M+1": "({m} + 1) & WORD_MASK",
+    "M-1": "({m} - 1) & WORD_MASK",
+    "D+M": "({d} + {m}) & WORD_MASK",
+    "D-M": "({d} - {m}) & WORD_MASK",
+    "M-D": "({m} - {d}) & WORD_MASK",
+    "D&M": "{d} & {m}",
+    "D|M": "{d} | {m}",
+}
+
+_ALU: Dict[str, Callable[[int, int, int], int]] = {
+    comp: eval(f"lambda a, d, m: {expression.format(a='a', d='d', m='m')}")
+    for comp, expression in _ALU_EXPRESSIONS.items()
+}
+
+_COMP_FUNCTIONS = {int(COMP_TABLE[comp], 2): fn for comp, fn in _ALU.items()}
+_COMP_EXPRESSIONS = {
+    int(COMP_TABLE[comp], 2): expression
+    for comp, expression in _ALU_EXPRESSIONS.items()
+}
+
+# Whether each jump condition holds for an ALU output that is zero, positive or negative
+_JUMP_CONDITIONS = [
+    None if jump == 0 else ((jump >> 1) & 1, jump & 1, (jump >> 2) & 1)
+    for jump in range(8)
+]
+
+# Python condition on the ALU output for each jump mnemonic
+_JUMP_EXPRESSIONS = [
+    "",
+    "0 < out < SIGN_BIT",
+    "out == 0",
+    "out < SIGN_BIT",
+    "out >= SIGN_BIT",
+    "out != 0",
+    "out == 0 or out >= SIGN_BIT",
+    "True",
+]
+
+# Straight-line blocks are cut after this many instructions
+MAX_BLOCK_LENGTH = 512
+
+# (ALU function or None for A-instructions, A-instruction value or whether M is read,
+#  write M, write D, write A, jump conditions)
+Instruction = Tuple[
+    Optional[Callable[[int, int, int], int]],
+    int,
+    int,
+    int,
+    int,
+    Optional[Tuple[int, int, int]],
+]
+
+
+class Halt(Exception):
+    pass
+
+
+def _halt(a: int, d: int, m: int) -> int:
+    raise Halt()
+
+
+def _alu(c_bits: int) -> Callable[[int, int, int], int]:
+    # Generic ALU for comp bits that have no assembler mnemonic
+    def compute(a: int, d: int, m: int) -> int:
+        y = m if c_bits & 0b1000000 else a
+        x = 0 if c_bits & 0b100000 else d
+        x = x ^ WORD_MASK if c_bits & 0b10000 else x
+        y = 0 if c_bits & 0b1000 else y
+        y = y ^ WORD_MASK if c_bits & 0b100 else y
+        out = (x + y) & WORD_MASK if c_bits & 0b10 else x & y
+        return out ^ WORD_MASK if c_bits & 0b1 else out
+
+    return compute
+
+
+def decode(word: int, address: int, rom: array) -> Instruction:
+    # A-Instruction
+    if word < SIGN_BIT:
+        return (None, word, 0, 0, 0, None)
+    # C-Instruction
+    c_bits = (word >> 6) & 0b1111111
+    dest = (word >> 3) & 0b111
+    jump = word & 0b111
+    # @X followed by 0;JMP at X + 1 is the conventional end-of-program loop
+    if word == 0b1110101010000111 and address > 0 and rom[address - 1] == address - 1:
+        return (_halt, 0, 0, 0, 0, None)
+    return (
+        _COMP_FUNCTIONS.get(c_bits) or _alu(c_bits),
+        (c_bits >> 6) & 1,
+        dest & 0b001,
+        dest & 0b010,
+        dest & 0b100,
+        _JUMP_CONDITIONS[jump],
+    )
+
+
+def to_signed(value: int) -> int:
+    return value - 0x10000 if value & SIGN_BIT else value
+
+
+Block = Tuple[Optional[Callable[[List[int], int, int], Tuple[int, int, int, int]]], int]
+
+
+class CPUEmulator:
+    def __init__(
+        self,
+        rom: array,
+        labels: Optional[Dict[str, int]] = None,
+        translate: bool = False,
+    ) -> None:
+        # Held as a list rather than an array, since list indexing is markedly faster
+        self.ram = [0] * RAM_SIZE
+        self.A = 0
+        self.D = 0
+        self.pc = 0
+        self.halted = False
+        self.cycles = 0
+        self.translate = translate
+        self.load(rom, labels)
+
+    def load(self, rom: array, labels: Optional[Dict[str, int]] = None) -> None:
+        if len(rom) > ROM_SIZE:
+            raise ValueError(f"Program too large for ROM: {len(rom)} words")
+        self.rom = array("H", rom)
+        self._leaders = set(labels.values()) if labels else set()
+        self._program = self._predecode()
+        self._blocks: Dict[int, Block] = {}
+
+    def set_rom_word(self, address: int, word: int) -> None:
+        # Translated blocks are only invalidated when the ROM actually changes
+        if self.rom[address] == word:
+            return
+        self.rom[address] = word
+        rom = self.rom
+        for decoded in range(address, min(address + 2, len(rom))):
+            self._program[decoded] = decode(rom[decoded], decoded, rom)
+        self._blocks.clear()
+
+    def _predecode(self) -> List[Instruction]:
+        rom = self.rom
+        program = [decode(word, address, rom) for address, word in enumerate(rom)]
+        # Running off the end of the program halts the machine
+        program.extend([(_halt, 0, 0, 0, 0, None)] * (WORD_MASK + 1 - len(program)))
+        return program
+
+    def reset(self) -> None:
+        self.A = 0
+        self.D = 0
+        self.pc = 0
+        self.halted = False
+        self.cycles = 0
+
+    def run(self, max_steps: Optional[int] = None) -> int:
+        if self.halted:
+            return 0
+        if self.translate:
+            return self._run_blocks(max_steps)
+        return self._interpret(max_steps)
+
+    def _interpret(self, max_steps: Optional[int]) -> int:
+        program = self._program
+        ram = self.ram
+        A, D, pc = self.A, self.D, self.pc
+        steps = 0
+        limit = max_steps if max_steps is not None else 1 << 62
+        try:
+            for steps in range(limit):
+                fn, value, write_m, write_d, write_a, jump = program[pc]
+                # A-Instruction
+                if fn is None:
+                    A = value
+                    pc += 1
+                    continue
+                # C-Instruction
+                out = fn(A, D, ram[A] if value else 0)
+                if write_m:
+                    ram[A] = out
+                if write_d:
+                    D = out
+                if (
+                    jump is not None
+                    and jump[0 if out == 0 else 2 if out & SIGN_BIT else 1]
+                ):
+                    pc = A
+                else:
+                    pc += 1
+                if write_a:
+                    A = out
+            else:
+                steps = limit
+        except Halt:
+            self.halted = True
+        self.A, self.D, self.pc = A, D, pc
+        self.cycles += steps
+        return steps
+
+    def _run_blocks(self, max_steps: Optional[int]) -> int:
+        blocks = self._blocks
+        ram = self.ram
+        A, D, pc = self.A, self.D, self.pc
+        steps = 0
+        limit = max_steps if max_steps is not None else 1 << 62
+        while steps < limit:
+            block = blocks.get(pc)
+            if block is None:
+                block = blocks[pc] = self._translate_block(pc)
+            fn, length = block
+            # Halting instructions and blocks that could overshoot the step limit are
+            # left to the interpreter
+            if fn is None or steps + length > limit:
+                self.A, self.D, self.pc = A, D, pc
+                self.cycles += steps
+                return steps + self._interpret(limit - steps if fn else 1)
+            A, D, pc, executed = fn(ram, A, D)
+            steps += executed
+        self.A, self.D, self.pc = A, D, pc
+        self.cycles += steps
+        return steps
+
+    def _translate_block(self, start: int) -> Block:
+        # Translate the straight-line code from start up to the next label or computed
+        # jump into a Python function returning the new A, D, pc and the number of
+        # instructions executed. Conditional jumps become early returns, and
+        # unconditional jumps to a constant address are followed.
+        program = self._program
+        rom = self.rom
+        source = ["def block(ram, A, D):"]
+        namespace: Dict[str, object] = {"WORD_MASK": WORD_MASK, "SIGN_BIT": SIGN_BIT}
+        # Value of A as a constant while it is statically known, or "A"
+        a = "A"
+        address = start
+        next_pc = ""
+        visited = set()
+        length = 0
+        while length < MAX_BLOCK_LENGTH:
+            if (
+                address >= len(rom)
+                or program[address][0] is _halt
+                or address in visited
+                or (length and address in self._leaders)
+            ):
+                break
+            visited.add(address)
+            word = rom[address]
+            address += 1
+            length += 1
+            # A-Instruction
+            if word < SIGN_BIT:
+                a = str(word)
+                continue
+            # C-Instruction
+            c_bits = (word >> 6) & 0b1111111
+            dest = (word >> 3) & 0b111
+            jump = word & 0b111
+            if c_bits in _COMP_EXPRESSIONS:
+                expression = _COMP_EXPRESSIONS[c_bits].format(a=a, d="D", m=f"ram[{a}]")
+            else:
+                namespace[f"alu_{c_bits}"] = _alu(c_bits)
+                expression = f"alu_{c_bits}({a}, D, ram[{a}])"
+            if dest in {0b001, 0b010, 0b100} and not jump:
+                target = {0b001: f"ram[{a}]", 0b010: "D", 0b100: "A"}[dest]
+                source.append(f"    {target} = {expression}")
+            else:
+                source.append(f"    out = {expression}")
+                if dest & 0b001:
+                    source.append(f"    ram[{a}] = out")
+                if dest & 0b010:
+                    source.append("    D = out")
+                if jump and dest & 0b100 and a == "A":
+                    source.append("    target = A")
+                target = "target" if jump and dest & 0b100 and a == "A" else a
+                if dest & 0b100:
+                    source.append("    A = out")
+            if dest & 0b100:
+                a = "A"
+            if jump == 0b111:
+                if not target.isdigit():
+                    next_pc = target
+                    break
+                address = int(target)
+            elif jump:
+                source.append(f"    if {_JUMP_EXPRESSIONS[jump]}:")
+                source.append(f"        return {a}, D, {target}, {length}")
+        if length == 0:
+            return (None, 0)
+        source.append(f"    return {a}, D, {next_pc or address}, {length}")
+        exec(compile("\n".join(source), f"<block {start}>", "exec"), namespace)
+        return (namespace["block"], length)  # type: ignore[return-value]
+
+    def screen_bytes(self) -> bytes:
+        screen = array("H", self.ram[SCREEN : SCREEN + SCREEN_SIZE])
+        if sys.byteorder == "big":
+            screen.byteswap()
+        return screen.tobytes()
+
+    def write_screenshot(self, file: str) -> None:
+        # Screen words hold the leftmost pixel in their least significant bit, PBM rows
+        # hold it in the most significant bit of each byte
+        with open(file, "wb") as t_file:
+            t_file.write(f"P4\n{SCREEN_WIDTH} {SCREEN_HEIGHT}\n".encode())
+            t_file.write(self.screen_bytes().translate(_REVERSED_BITS))
+
+
+_REVERSED_BITS = bytes(int(f"{byte:08b}"[::-1], 2) for byte in range(256))
+
+# Hack key codes for the Tk keysyms that do not map to a printable character
+_TK_KEY_CODES = {
+    "Return": 128,
+    "BackSpace": 129,
+    "Left": 130,
+    "Up": 131,
+    "Right": 132,
+    "Down": 133,
+    "Home": 134,
+    "End": 135,
+    "Prior": 136,
+    "Next": 137,
+    "Insert": 138,
+    "Delete": 139,
+    "Escape": 140,
+    **{f"F{n}": 140 + n for n in range(1, 13)},
+}
+
+
+def run_with_screen(emulator: CPUEmulator, max_steps: Optional[int]) -> None:
+    import tkinter
+
+    # Grey level of the 8 pixels of each screen byte (least significant bit first)
+    pixels = [
+        bytes(0 if byte >> bit & 1 else 255 for bit in range(8)) for byte in range(256)
+    ]
+    header = f"P5\n{SCREEN_WIDTH} {SCREEN_HEIGHT}\n255\n".encode()
+    steps_per_frame = 200_000
+
+    root = tkinter.Tk()
+    root.title("CPUEmulator")
+    image = tkinter.PhotoImage(width=SCREEN_WIDTH, height=SCREEN_HEIGHT)
+    tkinter.Label(root, image=image).pack()
+
+    def on_key_press(event: tkinter.Event) -> None:  # type: ignore[type-arg]
+        if event.keysym in _TK_KEY_CODES:
+            emulator.ram[KBD] = _TK_KEY_CODES[event.keysym]
+        elif event.char and ord(event.char) < 128:
+            emulator.ram[KBD] = ord(event.char)
+
+    def on_key_release(event: tkinter.Event) -> None:  # type: ignore[type-arg]
+        emulator.ram[KBD] = 0
+
+    def tick(remaining: Optional[int]) -> None:
+        steps = (
+            steps_per_frame if remaining is None else min(steps_per_frame, remaining)
+        )
+        emulator.run(steps)
+        screen = emulator.screen_bytes()
+        image.configure(data=header + b"".join(pixels[byte] for byte in screen))
+        if remaining is not None:
+            remaining -= steps
+        if not emulator.halted and remaining != 0:
+            root.after(1, tick, remaining)
+
+    root.bind("<KeyPress>", on_key_press)
+    root.bind("<KeyRelease>", on_key_release)
+    root.after(0, tick, max_steps)
+    root.mainloop()
+
+
+def main() -> None:
+    args = argparser.parse_args()
+
+    labels = load_symbols(args.file)[0] if args.file.endswith(".himg") else None
+    emulator = CPUEmulator(load_rom(args.file), labels, args.translate)
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        emulator.ram[int(address)] = int(value) & WORD_MASK
+
+    if args.headless:
+        start = time.perf_counter()
+        steps = emulator.run(args.steps)
+        elapsed = time.perf_counter() - start
+        state = "halted" if emulator.halted else "stopped"
+        print(
+            f"{state} after {steps} instructions in {elapsed:.3f}s "
+            f"({steps / elapsed / 1e6 if elapsed else 0.0:.2f}M instructions/s)"
+        )
+    else:
+        run_with_screen(emulator, args.steps)
+
+    for ram_range in args.ram:
+        start_address, _, end_address = ram_range.partition(":")
+        first = int(start_address)
+        last = int(end_address) if end_address else first
+        for address in range(first, last + 1):
+            print(f"RAM[{address}] = {to_signed(emulator.ram[address])}")
+
+    if args.screenshot:
+        emulator.write_screenshot(args.screenshot)
+
+
+if __name__ == "__main__":
+    main()
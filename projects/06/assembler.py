@@ -1,13 +1,47 @@
 import argparse
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+from enum import Enum
+from functools import lru_cache
+from itertools import permutations
+from typing import Dict, Iterable, List, Tuple
+
+
+class OutputFormat(str, Enum):
+    TEXT = "text"
+    BIN = "bin"
+    IMAGE = "image"
+
+    def __str__(self) -> str:
+        return self.value
+
 
 parser = argparse.ArgumentParser(description="Assembler for Hack Assembly Language")
 parser.add_argument(
     "-f",
     "--file",
-    help=".asm file to be assembled. This file is assumed to be error-free. The output will be a .hack file with the same name as the input file.",
+    help=".asm file to be assembled. This file is assumed to be error-free. The output will be a .hack file (or .bin/.himg, see --format) with the same name as the input file.",
     required=True,
     type=str,
 )
+parser.add_argument(
+    "-F",
+    "--format",
+    choices=[OutputFormat.TEXT, OutputFormat.BIN, OutputFormat.IMAGE],
+    type=OutputFormat,
+    default=OutputFormat.TEXT,
+    help="output format. text = .hack with one 16-bit binary string per line, bin = .bin with raw little-endian uint16 words, image = .himg with a symbol table header followed by the raw words. (default: %(default)s)",
+)
+parser.add_argument(
+    "-s",
+    "--stats",
+    help="print C-instruction encoding cache statistics after assembling.",
+    action="store_true",
+)
 
 SYMBOL_TABLE = {
     "SP": 0,
@@ -88,58 +122,212 @@ JUMP_TABLE = {
     "JMP": "111",
 }
 
-if __name__ == "__main__":
+_COMP_CODES = {comp: int(bits, 2) for comp, bits in COMP_TABLE.items()}
+_DEST_CODES = {dest: int(bits, 2) for dest, bits in DEST_TABLE.items()}
+_JUMP_CODES = {jump: int(bits, 2) for jump, bits in JUMP_TABLE.items()}
+
+# Accept equivalent spellings (e.g. A+D for D+A, DM for MD) with a single lookup
+for comp, code in list(_COMP_CODES.items()):
+    if len(comp) == 3 and comp[1] in "+&|" and comp[0] != comp[2]:
+        _COMP_CODES.setdefault(f"{comp[2]}{comp[1]}{comp[0]}", code)
+for dest, code in list(_DEST_CODES.items()):
+    if dest != "null":
+        for permutation in permutations(dest):
+            _DEST_CODES.setdefault("".join(permutation), code)
+
+C_INSTRUCTION_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=C_INSTRUCTION_CACHE_SIZE)
+def encode_c_instruction(line: str) -> int:
+    dest = "null"
+    jump = "null"
+    if "=" in line:
+        dest, line = line.split("=")
+    if ";" in line:
+        line, jump = line.split(";")
+    comp = line
+    return (
+        0b111 << 13
+        | _COMP_CODES[comp] << 6
+        | _DEST_CODES[dest] << 3
+        | _JUMP_CODES[jump]
+    )
+
+
+def first_pass(lines: Iterable[str], symbol_table: Dict[str, int]) -> List[str]:
+    instructions: List[str] = []
+    for line in lines:
+        line = line.strip()
+        # Ignore comments and empty lines
+        if line.startswith("//") or line == "":
+            continue
+        # Handle label symbols
+        if line.startswith("(") and line.endswith(")"):
+            symbol = line[1:-1]
+            symbol_table[symbol] = len(instructions)
+            continue
+        # Handle inline comments
+        if "//" in line:
+            line = line.split("//")[0].strip()
+        instructions.append(line)
+
+    return instructions
+
+
+def assemble_program(
+    lines: Iterable[str],
+) -> Tuple[List[int], Dict[str, int], Dict[str, int]]:
+    labels: Dict[str, int] = {}
+    instructions = first_pass(lines, labels)
+    symbol_table = {**SYMBOL_TABLE, **labels}
+
+    # Second Pass
+    words: List[int] = []
+    append = words.append
+    variables: Dict[str, int] = {}
+    next_available_address = 16
+    for line in instructions:
+        # A-Instruction
+        if line[0] == "@":
+            symbol = line[1:]
+            if symbol.isdigit():
+                value = int(symbol)
+            elif symbol in symbol_table:
+                value = symbol_table[symbol]
+            # Handle new variable symbols
+            else:
+                value = next_available_address
+                symbol_table[symbol] = next_available_address
+                variables[symbol] = next_available_address
+                next_available_address += 1
+            append(value)
+        # C-Instruction
+        else:
+            append(encode_c_instruction(line))
+
+    return words, labels, variables
+
+
+def assemble(lines: Iterable[str]) -> List[int]:
+    return assemble_program(lines)[0]
+
+
+def write_hack(words: List[int], file: str) -> None:
+    with open(file, "w") as t_file:
+        t_file.write("".join(f"{word:016b}\n" for word in words))
+
+
+def _words_to_le_bytes(words: Iterable[int]) -> bytes:
+    rom = array("H", words)
+    if sys.byteorder == "big":
+        rom.byteswap()
+    return rom.tobytes()
+
+
+def write_bin(words: List[int], file: str) -> None:
+    with open(file, "wb") as t_file:
+        t_file.write(_words_to_le_bytes(words))
+
+
+# Image layout (all little-endian):
+#   header   magic, version, word count, symbols size, ROM offset (IMAGE_HEADER)
+#   symbols  UTF-8 lines of "L <label> <rom address>" or "V <variable> <ram address>"
+#   padding  zeros up to ROM offset, which is aligned to IMAGE_ALIGNMENT bytes
+#   ROM      word count uint16 words
+IMAGE_MAGIC = b"HACK"
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct("<4sHxxIII")
+IMAGE_ALIGNMENT = 16
+
+
+def write_image(
+    words: List[int], labels: Dict[str, int], variables: Dict[str, int], file: str
+) -> None:
+    symbols = "".join(
+        [f"L {label} {address}\n" for label, address in labels.items()]
+        + [f"V {variable} {address}\n" for variable, address in variables.items()]
+    ).encode()
+    rom_offset = -(-(IMAGE_HEADER.size + len(symbols)) // IMAGE_ALIGNMENT)
+    rom_offset *= IMAGE_ALIGNMENT
+    header = IMAGE_HEADER.pack(
+        IMAGE_MAGIC, IMAGE_VERSION, len(words), len(symbols), rom_offset
+    )
+    padding = bytes(rom_offset - len(header) - len(symbols))
+    with open(file, "wb") as t_file:
+        t_file.write(header + symbols + padding + _words_to_le_bytes(words))
+
+
+def _read_image_header(buffer: bytes) -> Tuple[int, int, int]:
+    magic, version, word_count, symbols_size, rom_offset = IMAGE_HEADER.unpack_from(
+        buffer
+    )
+    if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+        raise ValueError(f"Unsupported image (magic: {magic!r}, version: {version})")
+    return word_count, symbols_size, rom_offset
+
+
+def load_rom(file: str) -> array:
+    if os.path.splitext(file)[1] == ".hack":
+        with open(file, "r") as s_file:
+            return array("H", (int(line, 2) for line in s_file if line.strip()))
+
+    rom = array("H")
+    if os.path.getsize(file) == 0:
+        return rom
+    with open(file, "rb") as s_file:
+        with mmap.mmap(s_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if buffer[: len(IMAGE_MAGIC)] == IMAGE_MAGIC:
+                word_count, _, start = _read_image_header(buffer[: IMAGE_HEADER.size])
+                end = start + 2 * word_count
+            else:
+                start, end = 0, len(buffer)
+            rom.frombytes(buffer[start:end])
+    if sys.byteorder == "big":
+        rom.byteswap()
+    return rom
+
+
+def load_symbols(file: str) -> Tuple[Dict[str, int], Dict[str, int]]:
+    labels: Dict[str, int] = {}
+    variables: Dict[str, int] = {}
+    with open(file, "rb") as s_file:
+        buffer = s_file.read(IMAGE_HEADER.size)
+        _, symbols_size, _ = _read_image_header(buffer)
+        symbols = s_file.read(symbols_size).decode()
+    for line in symbols.splitlines():
+        kind, symbol, address = line.split(" ")
+        if kind == "L":
+            labels[symbol] = int(address)
+        elif kind == "V":
+            variables[symbol] = int(address)
+        else:
+            raise ValueError(f"Invalid symbol entry: {line}")
+    return labels, variables
+
+
+def main() -> None:
     args = parser.parse_args()
     file_name = args.file.rsplit(".", 1)[0]
 
-    # First Pass
-    instruction_count = 0
     with open(args.file, "r") as s_file:
-        with open(f"{file_name}.clean.asm", "w") as t_file:
-            for line in s_file:
-                line = line.strip()
-                # Ignore comments and empty lines
-                if line.startswith("//") or line == "":
-                    continue
-                # Handle label symbols
-                if line.startswith("(") and line.endswith(")"):
-                    symbol = line[1:-1]
-                    SYMBOL_TABLE[symbol] = instruction_count
-                    continue
-                # Handle inline comments
-                if "//" in line:
-                    line = line.split("//")[0].strip()
-                t_file.write(f"{line}\n")
-                instruction_count += 1
+        words, labels, variables = assemble_program(s_file)
+    if args.format == OutputFormat.TEXT:
+        write_hack(words, f"{file_name}.hack")
+    elif args.format == OutputFormat.BIN:
+        write_bin(words, f"{file_name}.bin")
+    elif args.format == OutputFormat.IMAGE:
+        write_image(words, labels, variables, f"{file_name}.himg")
 
-    # Second Pass
-    next_available_address = 16
-    with open(f"{file_name}.clean.asm", "r") as s_file:
-        with open(f"{file_name}.hack", "w") as t_file:
-            for line in s_file:
-                line = line.strip()
-                # A-Instruction
-                if line.startswith("@"):
-                    symbol = line[1:]
-                    if symbol.isdigit():
-                        value = int(symbol)
-                    elif symbol in SYMBOL_TABLE:
-                        value = SYMBOL_TABLE[symbol]
-                    # Handle new variable symbols
-                    else:
-                        value = next_available_address
-                        SYMBOL_TABLE[symbol] = next_available_address
-                        next_available_address += 1
-                    t_file.write(f"0{value:015b}\n")
-                # C-Instruction
-                else:
-                    dest = "null"
-                    jump = "null"
-                    if "=" in line:
-                        dest, line = line.split("=")
-                    if ";" in line:
-                        line, jump = line.split(";")
-                    comp = line
-                    t_file.write(
-                        f"111{COMP_TABLE[comp]}{DEST_TABLE[dest]}{JUMP_TABLE[jump]}\n"
-                    )
+    if args.stats:
+        info = encode_c_instruction.cache_info()
+        lookups = info.hits + info.misses
+        hit_rate = info.hits / lookups if lookups else 0.0
+        print(
+            f"C-instruction cache: {info.hits} hits, {info.misses} misses, "
+            f"{info.currsize}/{info.maxsize} entries ({hit_rate:.1%} hit rate)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,556 @@
+import argparse
+import sys
+import time
+
+from array import array
+from typing import Dict, List, Optional, Set, Tuple
+
+from VMEmulator import (
+    ADD,
+    AND,
+    ARG,
+    CALL,
+    EQ,
+    FUNCTION,
+    GOTO,
+    GT,
+    HALT,
+    IF_GOTO,
+    LCL,
+    LT,
+    NEG,
+    NOT,
+    OR,
+    POP_DIRECT,
+    POP_SEGMENT,
+    POP_TEMP,
+    PUSH_CONSTANT,
+    PUSH_DIRECT,
+    PUSH_SEGMENT,
+    RAM_SIZE,
+    RETURN,
+    SUB,
+    THAT,
+    THIS,
+    VMProgram,
+    load_program,
+)
+
+argparser = argparse.ArgumentParser(
+    description="Ahead-of-time compiler from Jack VM code to Python",
+    prog="VMCompiler",
+)
+argparser.add_argument(
+    "target",
+    help=".vm file or folder containing .vm files to be compiled and run. The program starts at the entry function and runs until it halts, i.e. reaches Sys.halt or a jump to itself.",
+    type=str,
+)
+argparser.add_argument(
+    "-e",
+    "--entry",
+    help="function to start the program at. (default: %(default)s)",
+    type=str,
+    default="Sys.init",
+)
+argparser.add_argument(
+    "-o",
+    "--output",
+    help="also write the generated Python source to this file. It expects the RAM array in a global named ram and the ProgramHalted exception class.",
+    type=str,
+    default=None,
+)
+argparser.add_argument(
+    "--set",
+    help="set RAM[ADDRESS] to VALUE before running, e.g. --set 8000=5. Can be repeated.",
+    action="append",
+    default=[],
+    metavar="ADDRESS=VALUE",
+)
+argparser.add_argument(
+    "--ram",
+    help="print RAM[START..END] (inclusive) as signed values after running, e.g. --ram 8000:8001. Can be repeated.",
+    action="append",
+    default=[],
+    metavar="START[:END]",
+)
+
+# Python expressions computing VM arithmetic on signed 16-bit words. Comparisons use
+# the wrapped difference of their operands, like the translated Hack code does.
+_BINARY_EXPRESSIONS = {
+    ADD: "((({x} + {y}) + 32768) & 65535) - 32768",
+    SUB: "((({x} - {y}) + 32768) & 65535) - 32768",
+    AND: "{x} & {y}",
+    OR: "{x} | {y}",
+}
+
+_COMPARISON_EXPRESSIONS = {
+    EQ: "{x} == {y}",
+    GT: "0 < (({x} - {y}) & 65535) < 32768",
+    LT: "(({x} - {y}) & 65535) >= 32768",
+}
+
+_BINARY_OPCODES = {*_BINARY_EXPRESSIONS, *_COMPARISON_EXPRESSIONS}
+
+# Pointer segment addresses, kept in the Python locals this and that
+_POINTERS = {THIS: "this", THAT: "that"}
+
+MAX_RECURSION_DEPTH = 30000
+
+
+class ProgramHalted(Exception):
+    pass
+
+
+class StackEntry:
+    # A value on the VM stack, held as a Python expression until it has to be stored
+    # in its stack slot. Boolean entries are Python bools standing for -1 and 0.
+    __slots__ = ("expression", "is_boolean", "is_stored")
+
+    def __init__(
+        self, expression: str, is_boolean: bool = False, is_stored: bool = False
+    ) -> None:
+        self.expression = expression
+        self.is_boolean = is_boolean
+        self.is_stored = is_stored
+
+    def as_word(self) -> str:
+        if self.is_boolean:
+            return f"-({self.expression})"
+        elif self.expression.isidentifier() or self.expression.isdigit():
+            return self.expression
+        return f"({self.expression})"
+
+    def as_condition(self) -> str:
+        return f"({self.expression})"
+
+
+class FunctionCompiler:
+    # Translates the commands of one VM function into a Python function. Stack slots,
+    # local and argument segments and the THIS and THAT pointers become Python locals;
+    # temp and static segments and the heap stay in the shared RAM array. Jumps go
+    # through a block number dispatched in a loop when the function has any.
+    def __init__(
+        self,
+        program: VMProgram,
+        name: str,
+        start: int,
+        end: int,
+        function_names: Dict[int, str],
+    ) -> None:
+        self.__program = program
+        self.__name = name
+        self.__start = start
+        self.__end = end
+        self.__function_names = function_names
+        self.__blocks = self.__find_blocks()
+        self.__block_ends = dict(zip(self.__blocks, self.__blocks[1:] + [end]))
+        self.__entry_depths = self.__find_entry_depths()
+        # Pointers read before this function sets them, whose initial value is the
+        # caller's, are passed in as parameters
+        self.inherited_pointers: Set[int] = set()
+        self.n_args = 1 + max(
+            (
+                program.arg2[index]
+                for index in range(start, end)
+                if program.opcodes[index] in {PUSH_SEGMENT, POP_SEGMENT}
+                and program.arg1[index] == ARG
+            ),
+            default=-1,
+        )
+        self.__stack: List[StackEntry] = []
+        self.__lines: List[str] = []
+
+    def __find_blocks(self) -> List[int]:
+        opcodes, arg1 = self.__program.opcodes, self.__program.arg1
+        leaders = {self.__start}
+        for index in range(self.__start, self.__end):
+            if opcodes[index] in {GOTO, IF_GOTO}:
+                target = arg1[index]
+                if not self.__start < target <= self.__end:
+                    raise ValueError(
+                        f"Jump out of function {self.__name} at command {index}"
+                    )
+                leaders.add(target)
+                leaders.add(index + 1)
+            elif opcodes[index] in {RETURN, HALT}:
+                leaders.add(index + 1)
+        return sorted(leader for leader in leaders if leader < self.__end)
+
+    def __block_end(self, block: int) -> int:
+        return self.__block_ends[block]
+
+    def __stack_effect(self, index: int) -> int:
+        opcode = self.__program.opcodes[index]
+        if opcode in {PUSH_SEGMENT, PUSH_CONSTANT, PUSH_DIRECT}:
+            return 1
+        elif opcode in {POP_SEGMENT, POP_DIRECT, POP_TEMP, IF_GOTO}:
+            return -1
+        elif opcode in _BINARY_OPCODES:
+            return -1
+        elif opcode == CALL:
+            return 1 - self.__program.arg2[index]
+        return 0
+
+    def __successors(self, block: int) -> List[int]:
+        opcodes, arg1 = self.__program.opcodes, self.__program.arg1
+        end = self.__block_end(block)
+        last = opcodes[end - 1]
+        if last in {RETURN, HALT}:
+            successors = []
+        elif last == GOTO:
+            successors = [arg1[end - 1]]
+        elif last == IF_GOTO:
+            successors = [arg1[end - 1], end]
+        else:
+            successors = [end]
+        return [successor for successor in successors if successor < self.__end]
+
+    def __find_entry_depths(self) -> Dict[int, int]:
+        # The stack depth at the start of each block must not depend on the path taken
+        depths = {self.__start: 0}
+        pending = [self.__start]
+        while pending:
+            block = pending.pop()
+            depth = depths[block]
+            for index in range(block, self.__block_end(block)):
+                depth += self.__stack_effect(index)
+                if depth < 0:
+                    raise ValueError(f"Stack underflow in {self.__name}")
+            for successor in self.__successors(block):
+                if successor not in depths:
+                    depths[successor] = depth
+                    pending.append(successor)
+                elif depths[successor] != depth:
+                    raise ValueError(
+                        f"Stack depth of {self.__name} is not statically known at "
+                        f"command {successor}"
+                    )
+        return depths
+
+    def find_pointer_reads(self, inherits: Dict[str, Set[int]]) -> Set[int]:
+        # Pointers that may be read before being set, counting calls to functions
+        # that inherit them as reads
+        opcodes, arg1 = self.__program.opcodes, self.__program.arg1
+        read: Set[int] = set()
+        set_on_entry: Dict[int, Set[int]] = {self.__start: set()}
+        pending = [self.__start]
+        while pending:
+            block = pending.pop()
+            written = set(set_on_entry[block])
+            for index in range(block, self.__block_end(block)):
+                opcode, address = opcodes[index], arg1[index]
+                used: Set[int] = set()
+                if opcode in {PUSH_SEGMENT, POP_SEGMENT} and address in _POINTERS:
+                    used = {address}
+                elif opcode == PUSH_DIRECT and address in _POINTERS:
+                    used = {address}
+                elif opcode == CALL:
+                    used = inherits.get(self.__function_names.get(address, ""), set())
+                read |= used - written
+                if opcode == POP_DIRECT and address in _POINTERS:
+                    written.add(address)
+            for successor in self.__successors(block):
+                if successor not in set_on_entry:
+                    set_on_entry[successor] = written
+                    pending.append(successor)
+                elif not set_on_entry[successor] <= written:
+                    set_on_entry[successor] = set_on_entry[successor] & written
+                    pending.append(successor)
+        return read
+
+    def __push(self, expression: str, is_boolean: bool = False) -> None:
+        self.__stack.append(StackEntry(expression, is_boolean))
+
+    def __pop(self) -> StackEntry:
+        return self.__stack.pop()
+
+    def __store_stack(self, indent: str, constants: bool = False) -> None:
+        # Evaluates pending entries, in the order they were pushed, into their slots
+        # before anything that could change what they read. Constants only need to be
+        # stored at the end of a block, where the next block expects them in slots.
+        for depth, entry in enumerate(self.__stack):
+            if not entry.is_stored and (constants or not entry.expression.isdigit()):
+                self.__lines.append(f"{indent}s{depth} = {entry.as_word()}")
+                self.__stack[depth] = StackEntry(f"s{depth}", is_stored=True)
+
+    def __segment(self, address: int, index: int) -> str:
+        if address == LCL:
+            return f"l{index}"
+        elif address == ARG:
+            return f"a{index}"
+        pointer = _POINTERS[address]
+        return f"ram[{pointer} + {index}]" if index else f"ram[{pointer}]"
+
+    def __direct(self, address: int) -> str:
+        return _POINTERS.get(address, f"ram[{address}]")
+
+    def __compile_call(
+        self, index: int, indent: str, functions: Dict[str, "FunctionCompiler"]
+    ) -> None:
+        program = self.__program
+        name = self.__function_names[program.arg1[index]]
+        callee = functions[name]
+        n_args = program.arg2[index]
+        arguments = (
+            [entry.as_word() for entry in self.__stack[-n_args:]] if n_args else []
+        )
+        del self.__stack[len(self.__stack) - n_args :]
+        self.__store_stack(indent)
+        arguments += ["0"] * (callee.n_args - n_args)
+        arguments += [
+            _POINTERS[pointer] for pointer in sorted(callee.inherited_pointers)
+        ]
+        depth = len(self.__stack)
+        self.__lines.append(
+            f"{indent}s{depth} = f{program.functions[name]}({', '.join(arguments)})"
+        )
+        self.__stack.append(StackEntry(f"s{depth}", is_stored=True))
+
+    def __compile_block(
+        self, block: int, indent: str, functions: Dict[str, "FunctionCompiler"]
+    ) -> None:
+        program = self.__program
+        opcodes, arg1, arg2 = program.opcodes, program.arg1, program.arg2
+        lines = self.__lines
+        self.__stack = [
+            StackEntry(f"s{depth}", is_stored=True)
+            for depth in range(self.__entry_depths[block])
+        ]
+        end = self.__block_end(block)
+        is_dispatched = len(self.__blocks) > 1
+        for index in range(block, end):
+            opcode = opcodes[index]
+            if opcode == PUSH_CONSTANT:
+                self.__push(str(arg1[index]))
+            elif opcode == PUSH_SEGMENT:
+                self.__push(self.__segment(arg1[index], arg2[index]))
+            elif opcode == PUSH_DIRECT:
+                self.__push(self.__direct(arg1[index]))
+            elif opcode in {POP_SEGMENT, POP_DIRECT, POP_TEMP}:
+                value = self.__pop().as_word()
+                self.__store_stack(indent)
+                if opcode == POP_SEGMENT:
+                    target = self.__segment(arg1[index], arg2[index])
+                else:
+                    target = self.__direct(arg1[index])
+                lines.append(f"{indent}{target} = {value}")
+            elif opcode in _BINARY_EXPRESSIONS or opcode in _COMPARISON_EXPRESSIONS:
+                y, x = self.__pop(), self.__pop()
+                if opcode in {AND, OR} and x.is_boolean and y.is_boolean:
+                    operator = "&" if opcode == AND else "|"
+                    self.__push(
+                        f"{x.as_condition()} {operator} {y.as_condition()}", True
+                    )
+                elif opcode in _BINARY_EXPRESSIONS:
+                    self.__push(
+                        _BINARY_EXPRESSIONS[opcode].format(x=x.as_word(), y=y.as_word())
+                    )
+                else:
+                    self.__push(
+                        _COMPARISON_EXPRESSIONS[opcode].format(
+                            x=x.as_word(), y=y.as_word()
+                        ),
+                        True,
+                    )
+            elif opcode == NEG:
+                x = self.__pop()
+                if x.expression.isdigit():
+                    # Negative constants, which push constant cannot express
+                    self.__push(f"-{x.expression}")
+                else:
+                    self.__push(f"((32768 - {x.as_word()}) & 65535) - 32768")
+            elif opcode == NOT:
+                x = self.__pop()
+                if x.is_boolean:
+                    self.__push(f"not {x.as_condition()}", True)
+                else:
+                    self.__push(f"~{x.as_word()}")
+            elif opcode == CALL:
+                self.__compile_call(index, indent, functions)
+            elif opcode == FUNCTION:
+                pass
+            elif opcode == RETURN:
+                value = self.__pop().as_word()
+                self.__store_stack(indent)
+                lines.append(f"{indent}return {value}")
+                return
+            elif opcode == HALT:
+                self.__store_stack(indent)
+                lines.append(f"{indent}raise ProgramHalted")
+                return
+            elif opcode == GOTO:
+                self.__store_stack(indent, True)
+                self.__jump(arg1[index], block, indent)
+                return
+            elif opcode == IF_GOTO:
+                condition = self.__pop().as_condition()
+                self.__store_stack(indent, True)
+                lines.append(f"{indent}if {condition}:")
+                self.__jump(arg1[index], block, indent + "    ")
+                lines.append(f"{indent}else:")
+                self.__jump(end, block, indent + "    ")
+                return
+            else:
+                raise ValueError(f"Invalid opcode {opcode} in {self.__name}")
+        self.__store_stack(indent, True)
+        if is_dispatched or end == self.__end:
+            self.__jump(end, block, indent)
+
+    def __jump(self, target: int, block: int, indent: str) -> None:
+        if target == self.__end:
+            # The VM would run on into the next function, which compiled Jack code
+            # never does
+            self.__lines.append(
+                f'{indent}raise RuntimeError("Ran past the end of {self.__name}")'
+            )
+            return
+        # Forward jumps fall through the dispatch checks of the blocks in between
+        self.__lines.append(f"{indent}b = {target}")
+        if target <= block:
+            self.__lines.append(f"{indent}continue")
+
+    def compile(self, functions: Dict[str, "FunctionCompiler"]) -> List[str]:
+        self.__lines = []
+        if len(self.__blocks) == 1:
+            self.__compile_block(self.__start, "    ", functions)
+        else:
+            self.__lines.append(f"    b = {self.__start}")
+            self.__lines.append("    while True:")
+            for block in self.__blocks:
+                # Blocks only reachable through a jump into the middle of nowhere, like
+                # code after a return, are left out
+                if block not in self.__entry_depths:
+                    continue
+                self.__lines.append(f"        if b == {block}:")
+                self.__compile_block(block, "            ", functions)
+
+        program = self.__program
+        n_locals = (
+            program.arg1[self.__start]
+            if program.opcodes[self.__start] == FUNCTION
+            else 0
+        )
+        parameters = [f"a{index}=0" for index in range(self.n_args)]
+        parameters += [
+            f"{_POINTERS[pointer]}=0" for pointer in sorted(self.inherited_pointers)
+        ]
+        parameters.append("ram=ram")
+        header = [
+            f"def f{self.__start}({', '.join(parameters)}):",
+            f"    # {self.__name}",
+        ]
+        variables = [f"l{index}" for index in range(n_locals)]
+        variables += [
+            _POINTERS[pointer]
+            for pointer in sorted(_POINTERS)
+            if pointer not in self.inherited_pointers
+        ]
+        variables += [f"s{depth}" for depth in range(self.max_depth())]
+        if variables:
+            header.append(f"    {' = '.join(variables)} = 0")
+        return header + self.__lines
+
+    def max_depth(self) -> int:
+        depth = 0
+        for block in self.__entry_depths:
+            current = self.__entry_depths[block]
+            for index in range(block, self.__block_end(block)):
+                current += max(self.__stack_effect(index), 0)
+                depth = max(depth, current)
+        return depth
+
+
+class CompiledProgram:
+    def __init__(self, program: VMProgram) -> None:
+        self.program = program
+        self.ram = array("h", bytes(2 * RAM_SIZE))
+        self.halted = False
+        self.source = self.__generate()
+        self.__namespace: Dict[str, object] = {
+            "ram": self.ram,
+            "ProgramHalted": ProgramHalted,
+        }
+        exec(compile(self.source, "<vm program>", "exec"), self.__namespace)
+
+    def __generate(self) -> str:
+        program = self.program
+        function_names = {index: name for name, index in program.functions.items()}
+        starts = sorted(function_names)
+        functions: Dict[str, FunctionCompiler] = {}
+        for position, start in enumerate(starts):
+            end = starts[position + 1] if position + 1 < len(starts) else len(program)
+            name = function_names[start]
+            functions[name] = FunctionCompiler(
+                program, name, start, end, function_names
+            )
+
+        # Argument counts come from call sites too, since a function need not read
+        # all of its arguments
+        for index, opcode in enumerate(program.opcodes):
+            if opcode == CALL and program.arg1[index] in function_names:
+                callee = functions[function_names[program.arg1[index]]]
+                callee.n_args = max(callee.n_args, program.arg2[index])
+            elif opcode == CALL:
+                raise ValueError(f"Call to a label at command {index}")
+
+        inherits: Dict[str, Set[int]] = {name: set() for name in functions}
+        changed = True
+        while changed:
+            changed = False
+            for name, function in functions.items():
+                reads = function.find_pointer_reads(inherits)
+                if reads != inherits[name]:
+                    inherits[name] = reads
+                    changed = True
+        for name, function in functions.items():
+            function.inherited_pointers = inherits[name]
+
+        lines: List[str] = []
+        for function in functions.values():
+            lines.extend(function.compile(functions))
+            lines.append("")
+        return "\n".join(lines) + "\n"
+
+    def run(self, entry: str = "Sys.init") -> None:
+        if entry not in self.program.functions:
+            raise ValueError(f"Undefined function: {entry}")
+        function = self.__namespace[f"f{self.program.functions[entry]}"]
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, MAX_RECURSION_DEPTH))
+        try:
+            function()  # type: ignore[operator]
+        except ProgramHalted:
+            self.halted = True
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+
+def main() -> None:
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    compiled = CompiledProgram(load_program(args.target))
+    compile_time = time.perf_counter() - start
+    if args.output:
+        with open(args.output, "w") as o_file:
+            o_file.write(compiled.source)
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        compiled.ram[int(address)] = (int(value) + 0x8000) % 0x10000 - 0x8000
+
+    start = time.perf_counter()
+    compiled.run(args.entry)
+    elapsed = time.perf_counter() - start
+    state = "halted" if compiled.halted else "returned"
+    print(f"compiled in {compile_time:.3f}s, {state} after {elapsed:.3f}s")
+
+    for ram_range in args.ram:
+        start_address, _, end_address = ram_range.partition(":")
+        first = int(start_address)
+        last = int(end_address) if end_address else first
+        for address in range(first, last + 1):
+            print(f"RAM[{address}] = {compiled.ram[address]}")
+
+
+if __name__ == "__main__":
+    main()
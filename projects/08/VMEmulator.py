@@ -0,0 +1,592 @@
+import argparse
+import os
+import time
+
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+
+from VMTranslator import list_vm_files
+
+argparser = argparse.ArgumentParser(
+    description="Emulator for Jack VM Code",
+    prog="VMEmulator",
+)
+argparser.add_argument(
+    "target",
+    help=".vm file or folder containing .vm files to be run. A folder is bootstrapped like VMTranslator does (SP=256, call Sys.init).",
+    type=str,
+)
+argparser.add_argument(
+    "-n",
+    "--steps",
+    help="maximum number of VM commands to execute. (default: run until the program halts)",
+    type=int,
+    default=None,
+)
+argparser.add_argument(
+    "--native-os",
+    help="run hot Jack OS functions (Math.multiply, Math.divide, Memory.alloc, Memory.deAlloc, String.appendChar, Screen.drawHorizontalLine, Screen.drawRectangle) as native Python code with the same RAM effects.",
+    action="store_true",
+)
+argparser.add_argument(
+    "--set",
+    help="set RAM[ADDRESS] to VALUE before running, e.g. --set 0=256. Can be repeated.",
+    action="append",
+    default=[],
+    metavar="ADDRESS=VALUE",
+)
+argparser.add_argument(
+    "--ram",
+    help="print RAM[START..END] (inclusive) as signed values after running, e.g. --ram 256:260. Can be repeated.",
+    action="append",
+    default=[],
+    metavar="START[:END]",
+)
+
+RAM_SIZE = 32768
+WORD_MASK = 0xFFFF
+SIGN_BIT = 0x8000
+
+SP = 0
+LCL = 1
+ARG = 2
+THIS = 3
+THAT = 4
+R13 = 13
+R14 = 14
+R15 = 15
+TEMP = 5
+STATIC = 16
+
+# Opcodes, ordered roughly by how often compiled Jack code executes them
+PUSH_SEGMENT = 0  # arg1 = segment pointer address, arg2 = index
+PUSH_CONSTANT = 1  # arg1 = value
+PUSH_DIRECT = 2  # arg1 = RAM address (static, pointer and temp segments)
+POP_SEGMENT = 3  # arg1 = segment pointer address, arg2 = index
+POP_DIRECT = 4  # arg1 = RAM address (static and pointer segments)
+ADD = 5
+SUB = 6
+NEG = 7
+EQ = 8
+GT = 9
+LT = 10
+AND = 11
+OR = 12
+NOT = 13
+GOTO = 14  # arg1 = command index
+IF_GOTO = 15  # arg1 = command index
+CALL = 16  # arg1 = command index of the function, arg2 = number of arguments
+FUNCTION = 17  # arg1 = number of local variables
+RETURN = 18
+HALT = 19
+POP_TEMP = 20  # arg1 = RAM address
+CALL_NATIVE = 21  # same operands as CALL, for functions with a native implementation
+
+_ARITHMETIC_OPCODES = {
+    "add": ADD,
+    "sub": SUB,
+    "neg": NEG,
+    "eq": EQ,
+    "gt": GT,
+    "lt": LT,
+    "and": AND,
+    "or": OR,
+    "not": NOT,
+}
+
+_SEGMENT_POINTER_ADDRESSES = {
+    "local": LCL,
+    "argument": ARG,
+    "this": THIS,
+    "that": THAT,
+}
+
+_POINTER_ADDRESSES = {
+    "0": THIS,
+    "1": THAT,
+}
+
+
+class VMProgram:
+    # VM commands held as parallel arrays of opcodes and operands. Labels and function
+    # names are resolved to command indexes, and static variables to RAM addresses in
+    # order of first use, the same order in which the assembler allocates them.
+    def __init__(self) -> None:
+        self.opcodes = array("B")
+        self.arg1 = array("i")
+        self.arg2 = array("i")
+        self.functions: Dict[str, int] = {}
+        self.statics: Dict[str, int] = {}
+        self.bootstrapped = False
+        self.__labels: Dict[str, int] = {}
+        self.__unresolved: List[Tuple[int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    def __emit(self, opcode: int, arg1: int = 0, arg2: int = 0) -> None:
+        self.opcodes.append(opcode)
+        self.arg1.append(arg1)
+        self.arg2.append(arg2)
+
+    def __emit_jump(self, opcode: int, label: str, arg2: int = 0) -> None:
+        self.__unresolved.append((len(self.opcodes), label))
+        self.__emit(opcode, 0, arg2)
+
+    def __static_address(self, file_name: str, index: str) -> int:
+        symbol = f"{file_name}.{index}"
+        if symbol not in self.statics:
+            self.statics[symbol] = STATIC + len(self.statics)
+        return self.statics[symbol]
+
+    def bootstrap(self) -> None:
+        self.bootstrapped = True
+        self.__emit_jump(CALL, "Sys.init", 0)
+
+    def load(self, src_file: str, file_name: str) -> None:
+        current_function = ""
+        with open(src_file, "r") as s_file:
+            for line in s_file:
+                line = line.strip()
+                if not line or line.startswith("//"):
+                    continue
+                if "//" in line:
+                    line = line.split("//")[0].strip()
+                cmd, *args = line.split()
+                if cmd in {"push", "pop"}:
+                    segment, index = args
+                    if segment == "constant" and cmd == "push":
+                        self.__emit(PUSH_CONSTANT, int(index))
+                    elif segment in _SEGMENT_POINTER_ADDRESSES:
+                        self.__emit(
+                            PUSH_SEGMENT if cmd == "push" else POP_SEGMENT,
+                            _SEGMENT_POINTER_ADDRESSES[segment],
+                            int(index),
+                        )
+                    else:
+                        if segment == "static":
+                            address = self.__static_address(file_name, index)
+                        elif segment == "pointer":
+                            address = _POINTER_ADDRESSES[index]
+                        elif segment == "temp":
+                            address = TEMP + int(index)
+                        else:
+                            raise ValueError(f"Invalid segment: {segment}")
+                        if cmd == "push":
+                            self.__emit(PUSH_DIRECT, address)
+                        elif segment == "temp":
+                            self.__emit(POP_TEMP, address)
+                        else:
+                            self.__emit(POP_DIRECT, address)
+                elif cmd in _ARITHMETIC_OPCODES:
+                    self.__emit(_ARITHMETIC_OPCODES[cmd])
+                elif cmd in {"label", "goto", "if-goto"}:
+                    label = args[0]
+                    if current_function:
+                        label = f"{current_function}${label}"
+                    if cmd == "label":
+                        self.__labels[label] = len(self.opcodes)
+                    else:
+                        self.__emit_jump(GOTO if cmd == "goto" else IF_GOTO, label)
+                elif cmd == "function":
+                    current_function = args[0]
+                    self.functions[current_function] = len(self.opcodes)
+                    self.__emit(FUNCTION, int(args[1]))
+                elif cmd == "call":
+                    self.__emit_jump(CALL, args[0], int(args[1]))
+                elif cmd == "return":
+                    self.__emit(RETURN)
+                else:
+                    raise ValueError(f"Invalid command: {cmd}")
+
+    def link(self) -> None:
+        # Resolve jump targets, and mark self-loops and the Jack OS Sys.halt as halting
+        targets = {**self.__labels, **self.functions}
+        if "Sys.halt" in self.functions:
+            self.opcodes[self.functions["Sys.halt"]] = HALT
+        for index, label in self.__unresolved:
+            if label not in targets:
+                raise ValueError(f"Undefined label or function: {label}")
+            self.arg1[index] = targets[label]
+            if self.opcodes[index] == GOTO and targets[label] == index:
+                self.opcodes[index] = HALT
+        self.__unresolved.clear()
+
+
+# Native implementations of hot Jack OS functions (projects/12). Each one follows its
+# .jack source step by step on 16-bit words, including the wrapped-difference
+# comparisons of the translated code, so the RAM outside the call's own stack frame
+# ends up exactly as if the VM code had run. A native returns None instead of a value
+# when the Jack code would call Sys.error, and the VM function is run instead.
+NativeFunction = Callable[[List[int], List[int]], Optional[int]]
+
+
+def _lt(x: int, y: int) -> bool:
+    return (x - y) & WORD_MASK >= SIGN_BIT
+
+
+def _gt(x: int, y: int) -> bool:
+    return 0 < (x - y) & WORD_MASK < SIGN_BIT
+
+
+def _math_multiply(ram: List[int], args: List[int]) -> Optional[int]:
+    x, y = args
+    return (x * y) & WORD_MASK
+
+
+def _divide(x: int, y: int) -> int:
+    abs_x = -x & WORD_MASK if x & SIGN_BIT else x
+    abs_y = -y & WORD_MASK if y & SIGN_BIT else y
+    if _gt(abs_y, abs_x) or abs_y & SIGN_BIT:
+        return 0
+    twice_abs_y = (2 * abs_y) & WORD_MASK
+    q = _divide(abs_x, twice_abs_y)
+    if _lt((abs_x - twice_abs_y * q) & WORD_MASK, abs_y):
+        r = (2 * q) & WORD_MASK
+    else:
+        r = (2 * q + 1) & WORD_MASK
+    if (x & SIGN_BIT and _gt(y, 0)) or (_gt(x, 0) and y & SIGN_BIT):
+        return -r & WORD_MASK
+    return r
+
+
+def _math_divide(ram: List[int], args: List[int]) -> Optional[int]:
+    x, y = args
+    if y == 0:
+        return None
+    return _divide(x, y)
+
+
+def _memory_alloc(heap_base: int) -> NativeFunction:
+    def alloc(ram: List[int], args: List[int]) -> Optional[int]:
+        (size,) = args
+        if size & SIGN_BIT:
+            return None
+        required_size = (size + 2) & WORD_MASK
+        segment = ram[heap_base]
+        block_size = ram[segment + 1]
+        while _lt(block_size, required_size):
+            segment = ram[segment]
+            if segment == 0:
+                return None
+            block_size = ram[segment + 1]
+        new_block_size = (block_size - required_size) & WORD_MASK
+        ram[segment + 1] = new_block_size
+        new_segment = (segment + 2 + new_block_size) & WORD_MASK
+        ram[new_segment] = 0
+        ram[new_segment + 1] = size
+        return (new_segment + 2) & WORD_MASK
+
+    return alloc
+
+
+def _memory_de_alloc(heap_base: int) -> NativeFunction:
+    def de_alloc(ram: List[int], args: List[int]) -> Optional[int]:
+        (o,) = args
+        segment = (o - 2) & WORD_MASK
+        block_size = ram[segment + 1]
+        previous = ram[heap_base]
+        following = ram[previous]
+        while following != 0 and _lt(following, segment):
+            previous = following
+            following = ram[following]
+        ram[previous] = segment
+        ram[segment] = following
+        if (segment + block_size + 2) & WORD_MASK == following:
+            ram[segment + 1] = (block_size + ram[following + 1] + 2) & WORD_MASK
+            ram[segment] = ram[following]
+        if (previous + ram[previous + 1] + 2) & WORD_MASK == segment:
+            ram[previous + 1] = (ram[previous + 1] + block_size + 2) & WORD_MASK
+            ram[previous] = ram[segment]
+        return 0
+
+    return de_alloc
+
+
+def _string_append_char(ram: List[int], args: List[int]) -> Optional[int]:
+    this, c = args
+    # Fields: contents, maximumLength, currentLength
+    contents, maximum_length, current_length = ram[this : this + 3]
+    if current_length == maximum_length:
+        return None
+    ram[(contents + current_length) & WORD_MASK] = c
+    ram[this + 2] = (current_length + 1) & WORD_MASK
+    return this
+
+
+def _fill_row(ram: List[int], row: int, left: int, right: int, color: int) -> None:
+    # Set (or clear) pixels left..right of the screen row starting at address row
+    x = left
+    while x <= right:
+        word = x >> 4
+        last = min(right, (word << 4) | 15)
+        mask = ((1 << ((last & 15) + 1)) - 1) ^ ((1 << (x & 15)) - 1)
+        if color:
+            ram[row + word] |= mask
+        else:
+            ram[row + word] &= mask ^ WORD_MASK
+        x = last + 1
+
+
+def _screen_draw_horizontal_line(color: int, screen: int) -> NativeFunction:
+    def draw_horizontal_line(ram: List[int], args: List[int]) -> Optional[int]:
+        left_x, right_x, y = args
+        if not _lt(left_x, (right_x + 1) & WORD_MASK):
+            return 0
+        if left_x & SIGN_BIT or _gt(right_x, 511) or y & SIGN_BIT or _gt(y, 255):
+            return None
+        _fill_row(ram, ram[screen] + 32 * y, left_x, right_x, ram[color])
+        return 0
+
+    return draw_horizontal_line
+
+
+def _screen_draw_rectangle(color: int, screen: int) -> NativeFunction:
+    def draw_rectangle(ram: List[int], args: List[int]) -> Optional[int]:
+        x1, y1, x2, y2 = args
+        for coordinate, maximum in ((x1, 511), (y1, 255), (x2, 511), (y2, 255)):
+            if coordinate & SIGN_BIT or _gt(coordinate, maximum):
+                return None
+        for y in range(y1, y2 + 1):
+            _fill_row(ram, ram[screen] + 32 * y, x1, x2, ram[color])
+        return 0
+
+    return draw_rectangle
+
+
+def _assigned_static(
+    program: "VMProgram", function: str, opcode: int, arg1: int, arg2: int = 0
+) -> Optional[int]:
+    # RAM address of the static variable that function pops the value of the given
+    # push command into, or None if it has no such pop
+    if function not in program.functions:
+        return None
+    index = program.functions[function] + 1
+    while index + 1 < len(program) and program.opcodes[index] != FUNCTION:
+        if (
+            program.opcodes[index] == opcode
+            and program.arg1[index] == arg1
+            and program.arg2[index] == arg2
+            and program.opcodes[index + 1] == POP_DIRECT
+            and program.arg1[index + 1] >= STATIC
+        ):
+            return program.arg1[index + 1]
+        index += 1
+    return None
+
+
+def native_os_functions(program: "VMProgram") -> Dict[str, NativeFunction]:
+    natives: Dict[str, NativeFunction] = {
+        "Math.multiply": _math_multiply,
+        "Math.divide": _math_divide,
+        "String.appendChar": _string_append_char,
+    }
+    # The statics the Memory and Screen natives share with the VM code are found by
+    # what the OS stores in them, not by their declaration order: the heap base that
+    # Memory.init sets to 2048, the base address that Screen.init sets to 16384 and
+    # the color that Screen.setColor sets from its argument. Without them the VM code
+    # of those functions runs instead.
+    heap_base = _assigned_static(program, "Memory.init", PUSH_CONSTANT, 2048)
+    if heap_base is not None:
+        natives["Memory.alloc"] = _memory_alloc(heap_base)
+        natives["Memory.deAlloc"] = _memory_de_alloc(heap_base)
+    screen = _assigned_static(program, "Screen.init", PUSH_CONSTANT, 16384)
+    color = _assigned_static(program, "Screen.setColor", PUSH_SEGMENT, ARG, 0)
+    if screen is not None and color is not None:
+        natives["Screen.drawHorizontalLine"] = _screen_draw_horizontal_line(
+            color, screen
+        )
+        natives["Screen.drawRectangle"] = _screen_draw_rectangle(color, screen)
+    return {
+        name: native for name, native in natives.items() if name in program.functions
+    }
+
+
+class VMEmulator:
+    def __init__(self, program: VMProgram, native_os: bool = False) -> None:
+        self.program = program
+        self.ram = [0] * RAM_SIZE
+        self.pc = 0
+        self.halted = False
+        self.steps = 0
+        if program.bootstrapped:
+            self.ram[SP] = 256
+        # Calls to natively implemented functions get their own opcode, keyed by the
+        # command index of the function
+        self.opcodes = array("B", program.opcodes)
+        self.natives: Dict[int, NativeFunction] = {}
+        if native_os:
+            for name, native in native_os_functions(program).items():
+                self.natives[program.functions[name]] = native
+            for index, opcode in enumerate(self.opcodes):
+                if opcode == CALL and program.arg1[index] in self.natives:
+                    self.opcodes[index] = CALL_NATIVE
+
+    def run(self, max_steps: Optional[int] = None) -> int:
+        if self.halted:
+            return 0
+        opcodes = self.opcodes
+        natives = self.natives
+        arg1 = self.program.arg1
+        arg2 = self.program.arg2
+        size = len(opcodes)
+        ram = self.ram
+        pc = self.pc
+        # SP is kept in a local and only written back to RAM[0] when the run stops
+        sp = ram[SP]
+        limit = max_steps if max_steps is not None else 1 << 62
+        steps = 0
+        while steps < limit:
+            if pc >= size:
+                self.halted = True
+                break
+            op = opcodes[pc]
+            steps += 1
+            pc += 1
+            if op == PUSH_SEGMENT:
+                ram[sp] = ram[ram[arg1[pc - 1]] + arg2[pc - 1]]
+                sp += 1
+            elif op == PUSH_CONSTANT:
+                ram[sp] = arg1[pc - 1]
+                sp += 1
+            elif op == PUSH_DIRECT:
+                ram[sp] = ram[arg1[pc - 1]]
+                sp += 1
+            elif op == POP_SEGMENT:
+                # The translated code computes the target address through R13
+                address = ram[R13] = ram[arg1[pc - 1]] + arg2[pc - 1]
+                sp -= 1
+                ram[address] = ram[sp]
+            elif op == POP_DIRECT:
+                sp -= 1
+                ram[arg1[pc - 1]] = ram[sp]
+            elif op == POP_TEMP:
+                address = ram[R13] = arg1[pc - 1]
+                sp -= 1
+                ram[address] = ram[sp]
+            elif op == ADD:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] + ram[sp]) & WORD_MASK
+            elif op == SUB:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] - ram[sp]) & WORD_MASK
+            elif op == NEG:
+                ram[sp - 1] = -ram[sp - 1] & WORD_MASK
+            elif op == EQ:
+                # The translated code calls a shared routine that keeps its return
+                # address in R15, here a command index as for calls
+                ram[R15] = pc
+                sp -= 1
+                ram[sp - 1] = WORD_MASK if ram[sp - 1] == ram[sp] else 0
+            elif op == GT:
+                # Compare the 16-bit difference like the translated code does
+                ram[R15] = pc
+                sp -= 1
+                difference = (ram[sp - 1] - ram[sp]) & WORD_MASK
+                ram[sp - 1] = WORD_MASK if 0 < difference < SIGN_BIT else 0
+            elif op == LT:
+                ram[R15] = pc
+                sp -= 1
+                difference = (ram[sp - 1] - ram[sp]) & WORD_MASK
+                ram[sp - 1] = WORD_MASK if difference >= SIGN_BIT else 0
+            elif op == AND:
+                sp -= 1
+                ram[sp - 1] &= ram[sp]
+            elif op == OR:
+                sp -= 1
+                ram[sp - 1] |= ram[sp]
+            elif op == NOT:
+                ram[sp - 1] ^= WORD_MASK
+            elif op == GOTO:
+                pc = arg1[pc - 1]
+            elif op == IF_GOTO:
+                sp -= 1
+                if ram[sp]:
+                    pc = arg1[pc - 1]
+            elif op == CALL or op == CALL_NATIVE:
+                if op == CALL_NATIVE:
+                    n_args = arg2[pc - 1]
+                    value = natives[arg1[pc - 1]](ram, ram[sp - n_args : sp])
+                    if value is not None:
+                        sp -= n_args
+                        ram[sp] = value
+                        sp += 1
+                        continue
+                # The return address is a command index rather than a ROM address
+                ram[sp] = pc
+                ram[sp + 1] = ram[LCL]
+                ram[sp + 2] = ram[ARG]
+                ram[sp + 3] = ram[THIS]
+                ram[sp + 4] = ram[THAT]
+                sp += 5
+                ram[ARG] = sp - 5 - arg2[pc - 1]
+                ram[LCL] = sp
+                pc = arg1[pc - 1]
+            elif op == FUNCTION:
+                for _ in range(arg1[pc - 1]):
+                    ram[sp] = 0
+                    sp += 1
+            elif op == RETURN:
+                frame = ram[LCL]
+                return_address = ram[R14] = ram[frame - 5]
+                arg = ram[ARG]
+                ram[arg] = ram[sp - 1]
+                sp = arg + 1
+                ram[THAT] = ram[frame - 1]
+                ram[THIS] = ram[frame - 2]
+                ram[ARG] = ram[frame - 3]
+                ram[LCL] = ram[frame - 4]
+                ram[R13] = frame - 4
+                pc = return_address
+            elif op == HALT:
+                steps -= 1
+                pc -= 1
+                self.halted = True
+                break
+        ram[SP] = sp
+        self.pc = pc
+        self.steps += steps
+        return steps
+
+
+def load_program(target: str) -> VMProgram:
+    program = VMProgram()
+    if os.path.isdir(target):
+        program.bootstrap()
+    for src_file, file_name in list_vm_files(target):
+        program.load(src_file, file_name)
+    program.link()
+    return program
+
+
+def to_signed(value: int) -> int:
+    return value - 0x10000 if value & SIGN_BIT else value
+
+
+def main() -> None:
+    args = argparser.parse_args()
+
+    emulator = VMEmulator(load_program(args.target), args.native_os)
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        emulator.ram[int(address)] = int(value) & WORD_MASK
+
+    start = time.perf_counter()
+    steps = emulator.run(args.steps)
+    elapsed = time.perf_counter() - start
+    state = "halted" if emulator.halted else "stopped"
+    print(
+        f"{state} after {steps} VM commands in {elapsed:.3f}s "
+        f"({steps / elapsed / 1e6 if elapsed else 0.0:.2f}M commands/s)"
+    )
+
+    for ram_range in args.ram:
+        start_address, _, end_address = ram_range.partition(":")
+        first = int(start_address)
+        last = int(end_address) if end_address else first
+        for address in range(first, last + 1):
+            print(f"RAM[{address}] = {to_signed(emulator.ram[address])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+from enum import Enum
+from typing import Iterable, Iterator, TextIO
+
+
+class Opcode(str, Enum):
+    PUSH = "push"
+    POP = "pop"
+    ADD = "add"
+    SUB = "sub"
+    NEG = "neg"
+    EQ = "eq"
+    GT = "gt"
+    LT = "lt"
+    AND = "and"
+    OR = "or"
+    NOT = "not"
+    LABEL = "label"
+    GOTO = "goto"
+    IF_GOTO = "if-goto"
+    FUNCTION = "function"
+    CALL = "call"
+    RETURN = "return"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+ARITHMETIC_OPCODES = frozenset(
+    {
+        Opcode.ADD,
+        Opcode.SUB,
+        Opcode.NEG,
+        Opcode.EQ,
+        Opcode.GT,
+        Opcode.LT,
+        Opcode.AND,
+        Opcode.OR,
+        Opcode.NOT,
+    }
+)
+BRANCH_OPCODES = frozenset({Opcode.LABEL, Opcode.GOTO, Opcode.IF_GOTO})
+# Opcodes whose text form has a second, numeric argument
+INDEXED_OPCODES = frozenset({Opcode.PUSH, Opcode.POP, Opcode.FUNCTION, Opcode.CALL})
+
+OPCODES = {opcode.value: opcode for opcode in Opcode}
+# Looking the text up is several times faster than Opcode.value, which matters when
+# translating a whole program
+OPCODE_NAMES = {opcode: opcode.value for opcode in Opcode}
+
+
+class Instruction:
+    # One VM command, passed between the Jack compiler and the VM translator without
+    # going through text. arg is the segment of push/pop, the label of a branch or the
+    # function name of function/call; index is the segment index of push/pop, the
+    # number of locals of function and the number of arguments of call.
+    __slots__ = ("opcode", "arg", "index")
+
+    def __init__(self, opcode: Opcode, arg: str = "", index: int = 0) -> None:
+        self.opcode = opcode
+        self.arg = arg
+        self.index = index
+
+    def __str__(self) -> str:
+        name = OPCODE_NAMES[self.opcode]
+        if self.opcode in INDEXED_OPCODES:
+            return f"{name} {self.arg} {self.index}"
+        if self.opcode in BRANCH_OPCODES:
+            return f"{name} {self.arg}"
+        return name
+
+    def __repr__(self) -> str:
+        return f"Instruction({self})"
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Instruction):
+            return NotImplemented
+        return (
+            self.opcode == other.opcode
+            and self.arg == other.arg
+            and self.index == other.index
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.opcode, self.arg, self.index))
+
+
+def parse_instruction(line: str) -> Instruction:
+    # Parses one VM command without comments or surrounding whitespace
+    fields = line.split()
+    opcode = OPCODES.get(fields[0])
+    if opcode is None:
+        raise ValueError(f"Invalid command: {fields[0]}")
+    if opcode in INDEXED_OPCODES:
+        if len(fields) != 3:
+            raise ValueError(f"Invalid command: {line}")
+        return Instruction(opcode, fields[1], int(fields[2]))
+    if opcode in BRANCH_OPCODES:
+        if len(fields) != 2:
+            raise ValueError(f"Invalid command: {line}")
+        return Instruction(opcode, fields[1])
+    if len(fields) != 1:
+        raise ValueError(f"Invalid command: {line}")
+    return Instruction(opcode)
+
+
+def parse_vm(lines: Iterable[str]) -> Iterator[Instruction]:
+    # Parses VM text, e.g. an open .vm file, skipping blank lines and comments
+    for line in lines:
+        if "//" in line:
+            line = line.split("//")[0]
+        line = line.strip()
+        if line:
+            yield parse_instruction(line)
+
+
+def write_vm(instructions: Iterable[Instruction], file: TextIO) -> None:
+    file.write("".join(f"{instruction}\n" for instruction in instructions))
@@ -0,0 +1,498 @@
+import argparse
+import os
+
+from typing import Dict, List, Optional, Set, Tuple
+
+from VMInstruction import (
+    OPCODE_NAMES,
+    Instruction,
+    Opcode,
+    parse_vm,
+    write_vm,
+)
+
+argparser = argparse.ArgumentParser(
+    description="Optimizer for Jack VM Code, rewriting .vm files into shorter equivalent ones"
+)
+argparser.add_argument(
+    "target",
+    help=".vm file or folder containing .vm files to be optimized. Every function is optimized on its own, and its instruction count before and after is reported.",
+    type=str,
+)
+output_group = argparser.add_mutually_exclusive_group(required=True)
+output_group.add_argument(
+    "-o",
+    "--output",
+    help="folder to write the optimized .vm files to.",
+    type=str,
+)
+output_group.add_argument(
+    "-i",
+    "--in-place",
+    help="overwrite the input files with the optimized ones.",
+    action="store_true",
+)
+
+
+class VMOptimizer:
+    # Rewrites the instructions of each function into an equivalent, shorter sequence.
+    # Control is assumed to enter a function only at its start, as the VM language
+    # requires; anything else a rewrite relies on is checked first.
+
+    # Stack effect of each instruction that does not branch
+    _STACK_EFFECTS = {
+        "push": 1,
+        "pop": -1,
+        "add": -1,
+        "sub": -1,
+        "eq": -1,
+        "gt": -1,
+        "lt": -1,
+        "and": -1,
+        "or": -1,
+        "neg": 0,
+        "not": 0,
+    }
+
+    _WORD_MAX = 32767
+
+    def __init__(self) -> None:
+        # Instruction counts of each optimized function (or file outside of functions),
+        # before and after
+        self.function_stats: Dict[str, Tuple[int, int]] = {}
+
+    @property
+    def instructions_before(self) -> int:
+        return sum(before for before, _ in self.function_stats.values())
+
+    @property
+    def instructions_after(self) -> int:
+        return sum(after for _, after in self.function_stats.values())
+
+    def saved(self) -> int:
+        return self.instructions_before - self.instructions_after
+
+    def optimize(
+        self, instructions: List[Instruction], file_name: str = ""
+    ) -> List[Instruction]:
+        # Each function is optimized on its own; code before the first function keeps
+        # its place and is reported under file_name
+        units: List[List[Instruction]] = [[]]
+        for instruction in instructions:
+            if OPCODE_NAMES[instruction.opcode] == "function":
+                units.append([])
+            units[-1].append(instruction)
+
+        optimized: List[Instruction] = []
+        for unit in units:
+            if not unit:
+                continue
+            if OPCODE_NAMES[unit[0].opcode] == "function":
+                name = unit[0].arg
+                code = [unit[0]] + self._optimize_code(unit[1:])
+            else:
+                name = file_name
+                code = self._optimize_code(unit)
+            self.function_stats[name] = (len(unit), len(code))
+            optimized.extend(code)
+
+        return optimized
+
+    def _optimize_code(self, code: List[Instruction]) -> List[Instruction]:
+        temp_is_scratch = self._is_temp_scratch(code)
+        changed = True
+        while changed:
+            code, peephole_changed = self._peephole(code, temp_is_scratch)
+            code, threading_changed = self._thread_jumps(code)
+            code, unreachable_changed = self._remove_unreachable(code)
+            code, labels_changed = self._remove_unused_labels(code)
+            code, fusion_changed = self._fuse_negated_branches(code)
+            changed = (
+                peephole_changed
+                or threading_changed
+                or unreachable_changed
+                or labels_changed
+                or fusion_changed
+            )
+        return code
+
+    @staticmethod
+    def _is(instruction: Instruction, cmd: str, arg: Optional[str] = None) -> bool:
+        return OPCODE_NAMES[instruction.opcode] == cmd and (
+            arg is None or instruction.arg == arg
+        )
+
+    def _is_constant(
+        self, instruction: Instruction, value: Optional[int] = None
+    ) -> bool:
+        return self._is(instruction, "push", "constant") and (
+            value is None or instruction.index == value
+        )
+
+    def _is_temp(self, instruction: Instruction, cmd: str) -> bool:
+        return self._is(instruction, cmd, "temp") and instruction.index == 0
+
+    def _is_temp_scratch(self, code: List[Instruction]) -> bool:
+        # True if temp 0 is only read right after it is written, as the Jack compiler
+        # does: pop temp 0; [pop pointer 1;] push temp 0[; push temp 0]. A pop/push
+        # pair of temp 0 can then be dropped without anything else missing the value.
+        for i, instruction in enumerate(code):
+            if not self._is_temp(instruction, "push"):
+                continue
+            j = i - 1
+            while j >= 0 and self._is_temp(code[j], "push"):
+                j -= 1
+            if j >= 0 and self._is(code[j], "pop", "pointer") and code[j].index == 1:
+                j -= 1
+            if j < 0 or not self._is_temp(code[j], "pop"):
+                return False
+        return True
+
+    def _operand_start(self, code: List[Instruction], end: int) -> Optional[int]:
+        # Index of the first instruction of the expression whose value code[end]
+        # leaves on top of the stack. Only expressions built from pushes and
+        # arithmetic are recognised: anything that pops into memory, calls or
+        # branches makes the result None.
+        depth = 0
+        for i in range(end, -1, -1):
+            cmd = OPCODE_NAMES[code[i].opcode]
+            if cmd not in self._STACK_EFFECTS or cmd == "pop":
+                return None
+            depth += self._STACK_EFFECTS[cmd]
+            if depth == 1:
+                return i
+        return None
+
+    def _is_boolean(self, code: List[Instruction], end: int) -> bool:
+        # True if the value code[end] leaves on top of the stack is always 0 or -1
+        if end < 0:
+            return False
+        cmd = OPCODE_NAMES[code[end].opcode]
+        if cmd in {"eq", "gt", "lt"}:
+            return True
+        if cmd == "not":
+            return self._is_boolean(code, end - 1)
+        if cmd in {"and", "or"}:
+            start = self._operand_start(code, end - 1)
+            return (
+                start is not None
+                and self._is_boolean(code, end - 1)
+                and self._is_boolean(code, start - 1)
+            )
+        if cmd == "neg":
+            return end > 0 and self._is_constant(code[end - 1], 1)
+        return self._is_constant(code[end], 0)
+
+    def _fold_constants(self, out: List[Instruction]) -> bool:
+        # push constant a; push constant b; <op> => push constant (a <op> b)
+        cmd = OPCODE_NAMES[out[-1].opcode]
+        if (
+            cmd not in {"add", "sub", "and", "or"}
+            or len(out) < 3
+            or not self._is_constant(out[-3])
+            or not self._is_constant(out[-2])
+        ):
+            return False
+        a, b = out[-3].index, out[-2].index
+        if cmd == "add":
+            value = a + b
+        elif cmd == "sub":
+            value = a - b
+        elif cmd == "and":
+            value = a & b
+        else:
+            value = a | b
+        if not 0 <= value <= self._WORD_MAX:
+            return False
+        out[-3:] = [Instruction(Opcode.PUSH, "constant", value)]
+        return True
+
+    def _reorder_array_store(self, out: List[Instruction]) -> bool:
+        # <address>; E; pop temp 0; pop pointer 1; push temp 0; pop that 0
+        #   => <address>; pop pointer 1; E; pop that 0
+        # when E neither reads THAT nor pops, so it can run after THAT is set
+        if len(out) < 5 or not (
+            self._is_temp(out[-4], "pop")
+            and self._is(out[-3], "pop", "pointer")
+            and out[-3].index == 1
+            and self._is_temp(out[-2], "push")
+            and self._is(out[-1], "pop", "that")
+            and out[-1].index == 0
+        ):
+            return False
+        start = self._operand_start(out, len(out) - 5)
+        if start is None:
+            return False
+        expression = out[start:-4]
+        if any(
+            instruction.arg == "that"
+            or (instruction.arg == "pointer" and instruction.index == 1)
+            for instruction in expression
+        ):
+            return False
+        out[start:] = [out[-3]] + expression + [out[-1]]
+        return True
+
+    def _rewrite_tail(self, out: List[Instruction], temp_is_scratch: bool) -> bool:
+        # Applies one rewrite to the end of out, returning whether it did
+        last = out[-1]
+        cmd = OPCODE_NAMES[last.opcode]
+        previous = out[-2] if len(out) >= 2 else None
+        if previous is not None:
+            previous_cmd = OPCODE_NAMES[previous.opcode]
+            # push x; pop x
+            if (
+                cmd == "pop"
+                and previous_cmd == "push"
+                and previous.arg == last.arg
+                and previous.index == last.index
+            ):
+                del out[-2:]
+                return True
+            # not; not and neg; neg
+            if cmd in {"not", "neg"} and previous_cmd == cmd:
+                del out[-2:]
+                return True
+            # x + 0, x - 0 and x | 0
+            if cmd in {"add", "sub", "or"} and self._is_constant(previous, 0):
+                del out[-2:]
+                return True
+            # goto L; label L
+            if cmd == "label" and previous_cmd == "goto" and previous.arg == last.arg:
+                del out[-2]
+                return True
+            # Branches on a constant condition
+            if cmd == "if-goto" and self._is_constant(previous):
+                if previous.index == 0:
+                    del out[-2:]
+                else:
+                    out[-2:] = [Instruction(Opcode.GOTO, last.arg)]
+                return True
+        if len(out) >= 3 and self._is_constant(out[-3], 1) and self._is(out[-2], "neg"):
+            # x & true
+            if cmd == "and":
+                del out[-3:]
+                return True
+            # ~true
+            if cmd == "not":
+                out[-3:] = [Instruction(Opcode.PUSH, "constant", 0)]
+                return True
+            # Branch on true
+            if cmd == "if-goto":
+                out[-3:] = [Instruction(Opcode.GOTO, last.arg)]
+                return True
+        if len(out) >= 3 and self._is_constant(out[-3], 0) and self._is(out[-2], "not"):
+            # Branch on ~false
+            if cmd == "if-goto":
+                out[-3:] = [Instruction(Opcode.GOTO, last.arg)]
+                return True
+        if self._fold_constants(out):
+            return True
+        if temp_is_scratch and cmd == "pop" and self._reorder_array_store(out):
+            return True
+        return False
+
+    def _peephole(
+        self, code: List[Instruction], temp_is_scratch: bool
+    ) -> Tuple[List[Instruction], bool]:
+        # Rewrites are applied to the end of the output as it grows, so that each
+        # rewrite can enable another one on the instructions before it
+        out: List[Instruction] = []
+        changed = False
+        for instruction in code:
+            out.append(instruction)
+            while out and self._rewrite_tail(out, temp_is_scratch):
+                changed = True
+        return out, changed
+
+    def _thread_jumps(self, code: List[Instruction]) -> Tuple[List[Instruction], bool]:
+        # goto L / if-goto L, where L is followed by goto M => goto M / if-goto M
+        label_positions = {
+            instruction.arg: i
+            for i, instruction in enumerate(code)
+            if self._is(instruction, "label")
+        }
+
+        def final_target(label: str) -> str:
+            seen: Set[str] = set()
+            while label not in seen and label in label_positions:
+                seen.add(label)
+                i = label_positions[label] + 1
+                while i < len(code) and self._is(code[i], "label"):
+                    i += 1
+                if i == len(code) or not self._is(code[i], "goto"):
+                    break
+                label = code[i].arg
+            return label
+
+        out: List[Instruction] = []
+        changed = False
+        for instruction in code:
+            cmd = OPCODE_NAMES[instruction.opcode]
+            if cmd in {"goto", "if-goto"}:
+                target = final_target(instruction.arg)
+                if target != instruction.arg:
+                    instruction = Instruction(instruction.opcode, target)
+                    changed = True
+            out.append(instruction)
+        return out, changed
+
+    def _remove_unreachable(
+        self, code: List[Instruction]
+    ) -> Tuple[List[Instruction], bool]:
+        # Nothing after a goto or a return runs until the next label
+        out: List[Instruction] = []
+        reachable = True
+        for instruction in code:
+            cmd = OPCODE_NAMES[instruction.opcode]
+            if cmd == "label":
+                reachable = True
+            if reachable:
+                out.append(instruction)
+            if cmd in {"goto", "return"}:
+                reachable = False
+        return out, len(out) != len(code)
+
+    def _remove_unused_labels(
+        self, code: List[Instruction]
+    ) -> Tuple[List[Instruction], bool]:
+        targets = {
+            instruction.arg
+            for instruction in code
+            if OPCODE_NAMES[instruction.opcode] in {"goto", "if-goto"}
+        }
+        out = [
+            instruction
+            for instruction in code
+            if not self._is(instruction, "label") or instruction.arg in targets
+        ]
+        return out, len(out) != len(code)
+
+    def _fuse_negated_branches(
+        self, code: List[Instruction]
+    ) -> Tuple[List[Instruction], bool]:
+        # The Jack compiler branches past the body of an if or while on ~condition:
+        #   <condition>; not; if-goto L; A; label L; B
+        # When the condition is a boolean, A ends with a goto or return and the code
+        # ends with one too, A can move to the end of the code instead, so that the
+        # branch jumps into it on the condition itself:
+        #   <condition>; if-goto L; B; ...; label L; A
+        if not code or OPCODE_NAMES[code[-1].opcode] not in {"goto", "return"}:
+            return code, False
+        references: Dict[str, int] = {}
+        for instruction in code:
+            if OPCODE_NAMES[instruction.opcode] in {"goto", "if-goto"}:
+                references[instruction.arg] = references.get(instruction.arg, 0) + 1
+
+        for i in range(1, len(code) - 1):
+            branch = code[i + 1]
+            if not (
+                self._is(code[i], "not")
+                and self._is(branch, "if-goto")
+                and references[branch.arg] == 1
+                and self._is_boolean(code, i - 1)
+            ):
+                continue
+            for j in range(i + 2, len(code)):
+                if self._is(code[j], "label", branch.arg):
+                    break
+            else:
+                continue
+            if OPCODE_NAMES[code[j - 1].opcode] not in {"goto", "return"}:
+                continue
+            fused = code[:i] + [branch] + code[j + 1 :] + [code[j]] + code[i + 2 : j]
+            return fused, True
+
+        return code, False
+
+
+def remove_dead_functions(
+    files: List[Tuple[str, List[Instruction]]], entry: str = "Sys.init"
+) -> Tuple[List[Tuple[str, List[Instruction]]], List[Tuple[str, List[Instruction]]]]:
+    # Drops every function that no chain of calls from entry (or from code outside of
+    # functions) reaches. Takes the (file name, instructions) of every file of the
+    # program, and returns those of the files without the dead functions and those of
+    # each dead function. Nothing is dropped if entry is not defined.
+    calls: Dict[str, Set[str]] = {}
+    reachable_from = {entry}
+    for _, instructions in files:
+        function: Optional[str] = None
+        for instruction in instructions:
+            cmd = OPCODE_NAMES[instruction.opcode]
+            if cmd == "function":
+                function = instruction.arg
+                calls.setdefault(function, set())
+            elif cmd == "call":
+                if function is None:
+                    reachable_from.add(instruction.arg)
+                else:
+                    calls[function].add(instruction.arg)
+    if entry not in calls:
+        return files, []
+
+    reachable: Set[str] = set()
+    pending = list(reachable_from)
+    while pending:
+        function = pending.pop()
+        if function not in reachable:
+            reachable.add(function)
+            pending.extend(calls.get(function, ()))
+
+    live_files: List[Tuple[str, List[Instruction]]] = []
+    dead_functions: List[Tuple[str, List[Instruction]]] = []
+    for file_name, instructions in files:
+        live: List[Instruction] = []
+        dead: Optional[List[Instruction]] = None
+        for instruction in instructions:
+            if OPCODE_NAMES[instruction.opcode] == "function":
+                if instruction.arg in reachable:
+                    dead = None
+                else:
+                    dead = []
+                    dead_functions.append((file_name, dead))
+            if dead is None:
+                live.append(instruction)
+            else:
+                dead.append(instruction)
+        live_files.append((file_name, live))
+
+    return live_files, dead_functions
+
+
+def vm_size_in_bytes(instructions: List[Instruction]) -> int:
+    # Size of the instructions as .vm text
+    return sum(len(f"{instruction}\n") for instruction in instructions)
+
+
+def main() -> None:
+    # VMTranslator imports this module, so it can only be imported once both are loaded
+    from VMTranslator import list_vm_files
+
+    args = argparser.parse_args()
+
+    optimizer = VMOptimizer()
+    for src_file, file_name in list_vm_files(args.target):
+        with open(src_file, "r") as vm_file:
+            instructions = list(parse_vm(vm_file))
+
+        file_optimizer = VMOptimizer()
+        instructions = file_optimizer.optimize(instructions, file_name)
+        for name, (before, after) in file_optimizer.function_stats.items():
+            print(f"{name}: {before} -> {after} instructions")
+        optimizer.function_stats.update(file_optimizer.function_stats)
+
+        dst_file = src_file
+        if not args.in_place:
+            os.makedirs(args.output, exist_ok=True)
+            dst_file = os.path.join(args.output, os.path.basename(src_file))
+        with open(dst_file, "w") as vm_file:
+            write_vm(instructions, vm_file)
+
+    print(
+        f"Total: {optimizer.instructions_before} -> "
+        f"{optimizer.instructions_after} instructions (saved {optimizer.saved()})"
+    )
+
+
+if __name__ == "__main__":
+    main()
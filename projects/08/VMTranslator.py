@@ -1,9 +1,17 @@
 import argparse
 import os
-import random
-import string
 
-from io import TextIOWrapper
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from VMInstruction import (
+    ARITHMETIC_OPCODES,
+    BRANCH_OPCODES,
+    OPCODE_NAMES,
+    Instruction,
+    parse_vm,
+)
+from VMOptimizer import VMOptimizer, remove_dead_functions, vm_size_in_bytes
 
 argparser = argparse.ArgumentParser(description="Translator for Jack VM Code")
 argparser.add_argument(
@@ -11,6 +19,42 @@ argparser.add_argument(
     help=".vm file or folder containing .vm files to be translated. The output will be a .asm file with the same name as the input file or folder.",
     type=str,
 )
+argparser.add_argument(
+    "-O",
+    "--optimize",
+    help="run a peephole optimization pass over the generated assembly and report how many instructions it saved.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-V",
+    "--optimize-vm",
+    help="optimize the VM code of each function before translating it (see VMOptimizer.py), and report how many VM instructions it saved in each file.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-d",
+    "--dead-functions",
+    help="drop every function that no chain of calls from Sys.init reaches before translating a folder, and report the .vm bytes and ROM words saved.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-j",
+    "--jobs",
+    help="number of processes translating the .vm files of a folder concurrently. Defaults to the number of CPUs.",
+    type=int,
+    default=os.cpu_count() or 1,
+)
+argparser.add_argument(
+    "--no-comments",
+    help="do not write the VM command each block of assembly was translated from as a comment.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-t",
+    "--trampolines",
+    help="emit one shared $$CALL and $$RETURN routine that every call and return jumps into, instead of inlining the frame handling, and report the ROM size of each file before and after.",
+    action="store_true",
+)
 
 
 class VMParser:
@@ -60,8 +104,8 @@ class VMParser:
     }
 
     _POINTER_NUM_TO_THIS_THAT_MAP = {
-        "0": "THIS",
-        "1": "THAT",
+        0: "THIS",
+        1: "THAT",
     }
 
     _SEGMENT_NAME_TO_POINTER_MAP = {
@@ -71,62 +115,255 @@ class VMParser:
         "that": "THAT",
     }
 
-    _CURRENT_FUNCTION = ""
+    # Push LCL, ARG, THIS and THAT of the caller, after its return address
+    _SAVE_CALLER_FRAME = (
+        [
+            "@LCL",
+            "D=M",
+        ]
+        + _PUSH_DATA_TO_STACK
+        + [
+            "@ARG",
+            "D=M",
+        ]
+        + _PUSH_DATA_TO_STACK
+        + [
+            "@THIS",
+            "D=M",
+        ]
+        + _PUSH_DATA_TO_STACK
+        + [
+            "@THAT",
+            "D=M",
+        ]
+        + _PUSH_DATA_TO_STACK
+    )
+
+    _GET_SAVED_FRAME_ADDR_FROM_R13 = [
+        "@R13",
+        "M=M-1",
+        "A=M",
+        "D=M",
+    ]
+
+    # Copy the return value to ARG[0], restore the caller's frame and jump back to it
+    _RETURN_TO_CALLER = (
+        [
+            "@LCL",
+            "D=M",
+            "@R13",  # Store endFrame in R13
+            "M=D",
+            "@5",
+            "A=D-A",
+            "D=M",
+            "@R14",  # Store returnAddr in R14
+            "M=D",
+        ]
+        + _POP_DATA_FROM_STACK
+        + [
+            "@ARG",
+            "A=M",
+            "M=D",
+            "@ARG",
+            "D=M+1",
+            "@SP",
+            "M=D",
+        ]
+        + _GET_SAVED_FRAME_ADDR_FROM_R13
+        + [
+            "@THAT",
+            "M=D",
+        ]
+        + _GET_SAVED_FRAME_ADDR_FROM_R13
+        + [
+            "@THIS",
+            "M=D",
+        ]
+        + _GET_SAVED_FRAME_ADDR_FROM_R13
+        + [
+            "@ARG",
+            "M=D",
+        ]
+        + _GET_SAVED_FRAME_ADDR_FROM_R13
+        + [
+            "@LCL",
+            "M=D",
+        ]
+        + [
+            "@R14",
+            "A=M",
+            "0;JMP",
+        ]
+    )
+
+    # Shared call routine: D holds the return address, R13 the callee and R14 nArgs + 5
+    _SHARED_CALL_ROUTINE = (
+        [
+            "($$CALL)",
+        ]
+        + _PUSH_DATA_TO_STACK
+        + _SAVE_CALLER_FRAME
+        + [
+            "@R14",
+            "D=M",
+            "@SP",
+            "D=M-D",
+            "@ARG",
+            "M=D",
+            "@SP",
+            "D=M",
+            "@LCL",
+            "M=D",
+            "@R13",
+            "A=M",
+            "0;JMP",
+        ]
+    )
+
+    _SHARED_RETURN_ROUTINE = [
+        "($$RETURN)",
+    ] + _RETURN_TO_CALLER
+
+    # Shared eq/gt/lt routines take the return address in D and pop their two operands
+    _SHARED_COMPARISON_ROUTINE = (
+        [
+            "@R15",
+            "M=D",
+        ]
+        + _ADDRESS_BINARY_OPERANDS
+        + [
+            "D=M-D",
+            "M=-1",
+        ]
+    )
+
+    _SHARED_COMPARISON_ROUTINE_RETURN = [
+        "($$COMPARE_FALSE)",
+        "@SP",
+        "A=M-1",
+        "M=0",
+        "($$COMPARE_RETURN)",
+        "@R15",
+        "A=M",
+        "0;JMP",
+    ]
 
-    _FUNCTION_RETURN_COUNTER_MAP = {"0": 0}
+    # Program code must not run into the shared routines placed after it
+    _HALT = [
+        "($$HALT)",
+        "@$$HALT",
+        "0;JMP",
+    ]
 
-    def __init__(self, src_file: str, dst_file: str, file_name: str) -> None:
+    def __init__(
+        self,
+        src_file: str,
+        file_name: str,
+        trampolines: bool = False,
+        comments: bool = True,
+    ) -> None:
         self._src_file = src_file
-        self._dst_file = dst_file
         self._file_name = file_name
+        self._trampolines = trampolines
+        self._comments = comments
+        # Translated lines are collected here, to be written out with a single write
+        self.lines: List[str] = []
+        # Label state is per file, so that files can be translated independently
+        self._current_function = ""
+        self._function_return_counter_map: Dict[str, int] = {}
+        self._function_comparison_counter_map: Dict[str, int] = {}
+        # Instructions saved by jumping into the shared call and return routines
+        self._trampoline_savings = 0
+        self.shared_routines: Set[str] = set()
+
+    @staticmethod
+    def _count_instructions(operations: List[str]) -> int:
+        return sum(1 for line in operations if not line.startswith(("//", "(")))
+
+    @property
+    def rom_size(self) -> int:
+        return self._count_instructions(self.lines)
+
+    @property
+    def inline_rom_size(self) -> int:
+        # ROM size if calls and returns had been inlined
+        return self.rom_size + self._trampoline_savings
+
+    def _comment(self, comment: str) -> None:
+        if self._comments:
+            self.lines.append(f"// {comment}")
+
+    def _shared_routine(self, routine: str) -> List[str]:
+        if routine == "$$CALL":
+            return self._SHARED_CALL_ROUTINE
+        if routine == "$$RETURN":
+            return self._SHARED_RETURN_ROUTINE
+        if routine == "$$COMPARE_RETURN":
+            return self._SHARED_COMPARISON_ROUTINE_RETURN
+        cmd = routine[2:].lower()
+        return (
+            [f"({routine})"]
+            + self._SHARED_COMPARISON_ROUTINE
+            + [
+                "@$$COMPARE_RETURN",
+                f"D;{self._ARITHMETIC_AND_LOGICAL_COMMANDS_TO_HACK_ASSEMBLY_LANGUAGE_MAP[cmd]}",
+                "@$$COMPARE_FALSE",
+                "0;JMP",
+            ]
+        )
+
+    def add_shared_routines(self, routines: Set[str]) -> None:
+        if not routines:
+            return
+        # $$COMPARE_RETURN is the common tail of the comparison routines
+        if routines & {"$$EQ", "$$GT", "$$LT"}:
+            routines = routines | {"$$COMPARE_RETURN"}
+        self._comment("Shared routines")
+        self.lines.extend(self._HALT)
+        for routine in sorted(routines - {"$$COMPARE_RETURN"}) + sorted(
+            routines & {"$$COMPARE_RETURN"}
+        ):
+            self.lines.extend(self._shared_routine(routine))
 
     def bootstrap(self) -> None:
-        with open(self._dst_file, "a") as dst_file:
-            bootstrap_code = [
-                "// Bootstrap code",
-                "@256",
-                "D=A",
-                "@SP",
-                "M=D",
-            ]
-            dst_file.write("\n".join(bootstrap_code) + "\n")
-            self._CURRENT_FUNCTION = "Sys.init"
-            self._FUNCTION_RETURN_COUNTER_MAP["Sys.init"] = 0
-            self._parse_function("call Sys.init 0", dst_file)
+        self._comment("Bootstrap code")
+        bootstrap_code = [
+            "@256",
+            "D=A",
+            "@SP",
+            "M=D",
+        ]
+        self.lines.extend(bootstrap_code)
+        # The return label gets its own scope, apart from the calls made by Sys.init
+        self._current_function = "$$BOOTSTRAP"
+        self._parse_function("call", "Sys.init", 0)
 
     def parse(self) -> None:
         with open(self._src_file, "r") as src_file:
-            with open(self._dst_file, "a") as dst_file:
-                for line in src_file:
-                    line = line.strip()
-                    if not line or line.startswith("//"):
-                        continue
-                    if "//" in line:
-                        line = line.split("//")[0].strip()
-                    dst_file.write(f"// {line}\n")
-                    cmd = line.split(" ")[0]
-                    if cmd == "push":
-                        self._parse_push(line, dst_file)
-                    elif cmd == "pop":
-                        self._parse_pop(line, dst_file)
-                    elif (
-                        cmd
-                        in self._ARITHMETIC_AND_LOGICAL_COMMANDS_TO_HACK_ASSEMBLY_LANGUAGE_MAP
-                    ):
-                        self._parse_arithmetic_or_logical(cmd, dst_file)
-                    elif cmd in {"label", "goto", "if-goto"}:
-                        self._parse_branch(line, dst_file)
-                    elif cmd in {"call", "function", "return"}:
-                        if cmd == "function":
-                            function_name = line.split(" ")[1]
-                            self._CURRENT_FUNCTION = function_name
-                            self._FUNCTION_RETURN_COUNTER_MAP[function_name] = 0
-                        self._parse_function(line, dst_file)
-                    else:
-                        raise ValueError(f"Invalid command: {cmd}")
-
-    def _parse_push(self, line: str, dst_file: TextIOWrapper) -> None:
-        _, segment, index = line.split(" ")
+            self.parse_instructions(parse_vm(src_file))
+
+    def parse_instructions(self, instructions: Iterable[Instruction]) -> None:
+        # Translates VM instructions that are already in memory, e.g. straight from
+        # the Jack compiler, so that no VM text has to be written and parsed back
+        for instruction in instructions:
+            opcode = instruction.opcode
+            cmd = OPCODE_NAMES[opcode]
+            if self._comments:
+                self._comment(str(instruction))
+            if cmd == "push":
+                self._parse_push(instruction.arg, instruction.index)
+            elif cmd == "pop":
+                self._parse_pop(instruction.arg, instruction.index)
+            elif opcode in ARITHMETIC_OPCODES:
+                self._parse_arithmetic_or_logical(cmd)
+            elif opcode in BRANCH_OPCODES:
+                self._parse_branch(cmd, instruction.arg)
+            else:
+                if cmd == "function":
+                    self._current_function = instruction.arg
+                self._parse_function(cmd, instruction.arg, instruction.index)
+
+    def _parse_push(self, segment: str, index: int) -> None:
         if segment == "constant":
             SET_DATA_TO_D = [
                 f"@{index}",
@@ -162,10 +399,9 @@ class VMParser:
             raise ValueError(f"Invalid segment: {segment}")
 
         OUTPUT_OPERATIONS = SET_DATA_TO_D + self._PUSH_DATA_TO_STACK
-        dst_file.write("\n".join(OUTPUT_OPERATIONS) + "\n")
+        self.lines.extend(OUTPUT_OPERATIONS)
 
-    def _parse_pop(self, line: str, dst_file: TextIOWrapper) -> None:
-        _, segment, index = line.split(" ")
+    def _parse_pop(self, segment: str, index: int) -> None:
         if segment in self._SEGMENT_NAME_TO_POINTER_MAP:
             SET_ADDRESS_TO_R13 = [
                 f"@{index}",
@@ -212,9 +448,9 @@ class VMParser:
         OUTPUT_OPERATIONS = (
             SET_ADDRESS_TO_R13 + self._POP_DATA_FROM_STACK + SET_DATA_FROM_D
         )
-        dst_file.write("\n".join(OUTPUT_OPERATIONS) + "\n")
+        self.lines.extend(OUTPUT_OPERATIONS)
 
-    def _parse_arithmetic_or_logical(self, cmd: str, dst_file: TextIOWrapper) -> None:
+    def _parse_arithmetic_or_logical(self, cmd: str) -> None:
         if cmd in {"add", "sub", "neg", "and", "or", "not"}:
             OUTPUT_OPERATIONS = (
                 self._ADDRESS_BINARY_OPERANDS
@@ -224,32 +460,28 @@ class VMParser:
                 f"M={self._ARITHMETIC_AND_LOGICAL_COMMANDS_TO_HACK_ASSEMBLY_LANGUAGE_MAP[cmd]}",
             ]
         elif cmd in {"eq", "gt", "lt"}:
-            letters = string.ascii_uppercase
-            label = "".join(random.choice(letters) for _ in range(8))
-            if self._CURRENT_FUNCTION:
-                label = f"{self._CURRENT_FUNCTION}${label}"
-            OUTPUT_OPERATIONS = self._ADDRESS_BINARY_OPERANDS + [
-                "D=M-D",
-                "M=0",
-                f"@{label}_IF_TRUE",
-                f"D;{self._ARITHMETIC_AND_LOGICAL_COMMANDS_TO_HACK_ASSEMBLY_LANGUAGE_MAP[cmd]}",
-                f"@{label}_END",
+            # Labels are numbered per function (or per file outside of functions)
+            scope = self._current_function or self._file_name
+            counter = self._function_comparison_counter_map.get(scope, 0)
+            self._function_comparison_counter_map[scope] = counter + 1
+            return_addr_label = f"{scope}$$cmp.{counter}"
+            routine = f"$${cmd.upper()}"
+            self.shared_routines.add(routine)
+            OUTPUT_OPERATIONS = [
+                f"@{return_addr_label}",
+                "D=A",
+                f"@{routine}",
                 "0;JMP",
-                f"({label}_IF_TRUE)",
-                "@SP",
-                "A=M-1",
-                "M=-1",
-                f"({label}_END)",
+                f"({return_addr_label})",
             ]
         else:
             raise ValueError(f"Invalid command: {cmd}")
 
-        dst_file.write("\n".join(OUTPUT_OPERATIONS) + "\n")
+        self.lines.extend(OUTPUT_OPERATIONS)
 
-    def _parse_branch(self, line: str, dst_file: TextIOWrapper) -> None:
-        cmd, label = line.split(" ")
-        if self._CURRENT_FUNCTION:
-            label = f"{self._CURRENT_FUNCTION}${label}"
+    def _parse_branch(self, cmd: str, label: str) -> None:
+        if self._current_function:
+            label = f"{self._current_function}${label}"
         if cmd == "label":
             OUTPUT_OPERATIONS = [
                 f"({label})",
@@ -267,44 +499,27 @@ class VMParser:
         else:
             raise ValueError(f"Invalid command: {cmd}")
 
-        dst_file.write("\n".join(OUTPUT_OPERATIONS) + "\n")
+        self.lines.extend(OUTPUT_OPERATIONS)
 
-    def _parse_function(self, line: str, dst_file: TextIOWrapper) -> None:
-        cmd = line.split(" ")[0]
+    def _parse_function(
+        self, cmd: str, function_name: str = "", count: int = 0
+    ) -> None:
         if cmd == "call":
-            _, function_name, num_args = line.split(" ")
-            return_addr_label = f"{self._CURRENT_FUNCTION}$ret.{self._FUNCTION_RETURN_COUNTER_MAP[self._CURRENT_FUNCTION]}"
-            self._FUNCTION_RETURN_COUNTER_MAP[self._CURRENT_FUNCTION] += 1
+            scope = self._current_function or self._file_name
+            counter = self._function_return_counter_map.get(scope, 0)
+            self._function_return_counter_map[scope] = counter + 1
+            return_addr_label = f"{scope}$ret.{counter}"
             OUTPUT_OPERATIONS = (
                 [
                     f"@{return_addr_label}",
                     "D=A",
                 ]
                 + self._PUSH_DATA_TO_STACK
-                + [
-                    "@LCL",
-                    "D=M",
-                ]
-                + self._PUSH_DATA_TO_STACK
-                + [
-                    "@ARG",
-                    "D=M",
-                ]
-                + self._PUSH_DATA_TO_STACK
-                + [
-                    "@THIS",
-                    "D=M",
-                ]
-                + self._PUSH_DATA_TO_STACK
-                + [
-                    "@THAT",
-                    "D=M",
-                ]
-                + self._PUSH_DATA_TO_STACK
+                + self._SAVE_CALLER_FRAME
                 + [
                     "@SP",
                     "D=M",
-                    f"@{int(num_args) + 5}",
+                    f"@{count + 5}",
                     "D=D-A",
                     "@ARG",
                     "M=D",
@@ -317,8 +532,24 @@ class VMParser:
                     f"({return_addr_label})",
                 ]
             )
+            if self._trampolines:
+                self.shared_routines.add("$$CALL")
+                SHARED_OPERATIONS = [
+                    f"@{function_name}",
+                    "D=A",
+                    "@R13",
+                    "M=D",
+                    f"@{count + 5}",
+                    "D=A",
+                    "@R14",
+                    "M=D",
+                    f"@{return_addr_label}",
+                    "D=A",
+                    "@$$CALL",
+                    "0;JMP",
+                    f"({return_addr_label})",
+                ]
         elif cmd == "function":
-            _, function_name, num_vars = line.split(" ")
             OUTPUT_OPERATIONS = [
                 f"({function_name})",
             ] + [
@@ -327,104 +558,336 @@ class VMParser:
                 "M=0",
                 "@SP",
                 "M=M+1",
-            ] * int(num_vars)
+            ] * count
         elif cmd == "return":
-            GET_SAVED_FRAME_ADDR_FROM_R13 = [
-                "@R13",
-                "M=M-1",
-                "A=M",
-                "D=M",
-            ]
-            OUTPUT_OPERATIONS = (
-                [
-                    "@LCL",
-                    "D=M",
-                    "@R13",  # Store endFrame in R13
-                    "M=D",
-                    "@5",
-                    "A=D-A",
-                    "D=M",
-                    "@R14",  # Store returnAddr in R14
-                    "M=D",
-                ]
-                + self._POP_DATA_FROM_STACK
-                + [
-                    "@ARG",
-                    "A=M",
-                    "M=D",
-                    "@ARG",
-                    "D=M+1",
-                    "@SP",
-                    "M=D",
-                ]
-                + GET_SAVED_FRAME_ADDR_FROM_R13
-                + [
-                    "@THAT",
-                    "M=D",
-                ]
-                + GET_SAVED_FRAME_ADDR_FROM_R13
-                + [
-                    "@THIS",
-                    "M=D",
-                ]
-                + GET_SAVED_FRAME_ADDR_FROM_R13
-                + [
-                    "@ARG",
-                    "M=D",
-                ]
-                + GET_SAVED_FRAME_ADDR_FROM_R13
-                + [
-                    "@LCL",
-                    "M=D",
-                ]
-                + [
-                    "@R14",
-                    "A=M",
+            OUTPUT_OPERATIONS = self._RETURN_TO_CALLER
+            if self._trampolines:
+                self.shared_routines.add("$$RETURN")
+                SHARED_OPERATIONS = [
+                    "@$$RETURN",
                     "0;JMP",
                 ]
-            )
         else:
             raise ValueError(f"Invalid command: {cmd}")
 
-        dst_file.write("\n".join(OUTPUT_OPERATIONS) + "\n")
+        if self._trampolines and cmd != "function":
+            self._trampoline_savings += self._count_instructions(
+                OUTPUT_OPERATIONS
+            ) - self._count_instructions(SHARED_OPERATIONS)
+            self.lines.extend(SHARED_OPERATIONS)
+        else:
+            self.lines.extend(OUTPUT_OPERATIONS)
+
+
+class AsmOptimizer:
+    # Peephole rewrites over the instruction templates emitted by VMParser. At every
+    # VM command boundary A and D are dead, so a rewrite may leave them (and the
+    # scratch registers R13/R14 and the stack above SP) with different values as long
+    # as the next instruction is an A-instruction or a label.
+    _PUSH_DATA_TO_STACK = VMParser._PUSH_DATA_TO_STACK
+    _POP_DATA_FROM_STACK = VMParser._POP_DATA_FROM_STACK
+    _ADDRESS_BINARY_OPERANDS = VMParser._ADDRESS_BINARY_OPERANDS
+    _ADDRESS_UNARY_OPERAND = VMParser._ADDRESS_UNARY_OPERAND
+    _STORE_D_THROUGH_R13 = ["@R13", "A=M", "M=D"]
+    _SEGMENT_POINTERS = set(VMParser._SEGMENT_NAME_TO_POINTER_MAP.values())
+
+    # Largest segment index that is cheaper to reach by incrementing A than via R13
+    _MAX_INCREMENTED_INDEX = 5
+
+    def __init__(self) -> None:
+        self.instructions_before = 0
+        self.instructions_after = 0
+
+    @staticmethod
+    def _count_instructions(lines: List[str]) -> int:
+        return sum(1 for line in lines if not line.startswith(("//", "(")))
+
+    @staticmethod
+    def _is_a_dead(lines: List[str], i: int) -> bool:
+        return i >= len(lines) or lines[i].startswith(("@", "("))
+
+    def _match(self, lines: List[str], i: int, pattern: List[str]) -> bool:
+        return lines[i : i + len(pattern)] == pattern
+
+    def _rewrite(self, lines: List[str], i: int) -> Optional[Tuple[int, List[str]]]:
+        # Returns the number of lines replaced at i and their replacement
+        push = self._PUSH_DATA_TO_STACK
+        pop = self._POP_DATA_FROM_STACK
+        line = lines[i]
+
+        if self._match(lines, i, push):
+            j = i + len(push)
+            # push, pop: D already holds the value
+            if self._match(lines, j, pop) and self._is_a_dead(lines, j + len(pop)):
+                return len(push) + len(pop), []
+            # push, binary operation: keep the pushed value in D
+            if self._match(lines, j, self._ADDRESS_BINARY_OPERANDS):
+                return len(push) + len(self._ADDRESS_BINARY_OPERANDS), ["@SP", "A=M-1"]
+            # push, unary operation: apply it to D before pushing
+            if (
+                self._match(lines, j, self._ADDRESS_UNARY_OPERAND)
+                and j + 2 < len(lines)
+                and lines[j + 2] in {"M=-M", "M=!M"}
+                and self._is_a_dead(lines, j + 3)
+            ):
+                operation = lines[j + 2].replace("M", "D")[2:]
+                return len(push) + 3, ["@SP", "A=M", f"M={operation}"] + push[3:]
+            # push, pop to a segment: park the value in R14 instead of on the stack
+            address = lines[j : j + 6]
+            k = j + 6
+            if (
+                len(address) == 6
+                and address[0][1:].isdigit()
+                and address[1:] == ["D=A", address[2], "D=M+D", "@R13", "M=D"]
+                and address[2][1:] in self._SEGMENT_POINTERS
+                and self._match(lines, k, pop)
+                and self._match(lines, k + len(pop), self._STORE_D_THROUGH_R13)
+            ):
+                return len(push) + 6 + len(pop) + 3, (
+                    ["@R14", "M=D"]
+                    + address
+                    + ["@R14", "D=M"]
+                    + self._STORE_D_THROUGH_R13
+                )
+
+        # pop to a segment or temp: address it directly instead of through R13
+        address = lines[i : i + 6]
+        j = i + 6
+        if (
+            len(address) == 6
+            and line[1:].isdigit()
+            and address[1] == "D=A"
+            and address[4:] == ["@R13", "M=D"]
+            and self._match(lines, j, pop)
+            and self._match(lines, j + len(pop), self._STORE_D_THROUGH_R13)
+        ):
+            index = int(line[1:])
+            if address[2:4] == ["@5", "D=A+D"]:
+                return 6 + len(pop) + 3, pop + [f"@{5 + index}", "M=D"]
+            if (
+                address[2][1:] in self._SEGMENT_POINTERS
+                and address[3] == "D=M+D"
+                and index <= self._MAX_INCREMENTED_INDEX
+            ):
+                return 6 + len(pop) + 3, pop + (
+                    [address[2], "A=M"] + ["A=A+1"] * index + ["M=D"]
+                )
+
+        # push constant 1, add/sub: increment or decrement in place
+        if (
+            line == "@1"
+            and lines[i + 1 : i + 4] == ["D=A", "@SP", "A=M-1"]
+            and i + 4 < len(lines)
+            and lines[i + 4] in {"M=D+M", "M=M-D"}
+        ):
+            return 5, ["@SP", "A=M-1", "M=M+1" if lines[i + 4] == "M=D+M" else "M=M-1"]
+
+        # Dead A-instruction: immediately overwritten, or followed by a label
+        if (
+            line.startswith("@")
+            and i + 1 < len(lines)
+            and lines[i + 1].startswith(("@", "("))
+        ):
+            return 1, []
+
+        return None
+
+    def optimize(self, lines: List[str]) -> List[str]:
+        # Comments are dropped, as the rewrites cross VM command boundaries
+        lines = [line for line in lines if line and not line.startswith("//")]
+        self.instructions_before += self._count_instructions(lines)
+        is_changed = True
+        while is_changed:
+            is_changed = False
+            optimized: List[str] = []
+            i = 0
+            while i < len(lines):
+                rewrite = self._rewrite(lines, i)
+                if rewrite is None:
+                    optimized.append(lines[i])
+                    i += 1
+                else:
+                    length, replacement = rewrite
+                    optimized.extend(replacement)
+                    i += length
+                    is_changed = True
+            lines = optimized
+        self.instructions_after += self._count_instructions(lines)
+        return lines
+
+    def saved(self) -> int:
+        return self.instructions_before - self.instructions_after
+
+
+def list_vm_files(target: str) -> List[Tuple[str, str]]:
+    # (source file, file name used for static symbols) of each .vm file to translate
+    if os.path.isdir(target):
+        return [
+            (os.path.join(target, file), os.path.splitext(file)[0])
+            for file in sorted(os.listdir(target))
+            if file.endswith(".vm")
+        ]
+    file_name, _ = os.path.splitext(os.path.basename(target))
+    return [(target, file_name)]
+
+
+def load_file(
+    src_file: str, file_name: str, optimize_vm: bool = False
+) -> Tuple[List[Instruction], Tuple[int, int]]:
+    # Reads one .vm file; run in a worker process. Also returns the number of VM
+    # instructions before and after optimizing them.
+    with open(src_file, "r") as vm_file:
+        instructions = list(parse_vm(vm_file))
+    vm_size = (len(instructions), len(instructions))
+    if optimize_vm:
+        optimizer = VMOptimizer()
+        instructions = optimizer.optimize(instructions, file_name)
+        vm_size = (optimizer.instructions_before, optimizer.instructions_after)
+    return instructions, vm_size
+
+
+def translate_instructions(
+    instructions: List[Instruction], file_name: str, trampolines: bool, comments: bool
+) -> Tuple[List[str], int, Set[str]]:
+    # Translates the instructions of one .vm file in memory; run in a worker process
+    parser = VMParser("", file_name, trampolines, comments)
+    parser.parse_instructions(instructions)
+    return parser.lines, parser.inline_rom_size, parser.shared_routines
+
+
+def translate_file(
+    src_file: str,
+    file_name: str,
+    trampolines: bool,
+    comments: bool,
+    optimize_vm: bool = False,
+) -> Tuple[List[str], int, Set[str], Tuple[int, int]]:
+    instructions, vm_size = load_file(src_file, file_name, optimize_vm)
+    lines, inline_rom_size, shared_routines = translate_instructions(
+        instructions, file_name, trampolines, comments
+    )
+    return lines, inline_rom_size, shared_routines, vm_size
+
+
+def rom_size_of(
+    functions: List[Tuple[str, List[Instruction]]], trampolines: bool
+) -> int:
+    # ROM words the functions translate to, before any assembly optimization
+    size = 0
+    for file_name, instructions in functions:
+        parser = VMParser("", file_name, trampolines, False)
+        parser.parse_instructions(instructions)
+        size += parser.rom_size
+    return size
+
+
+def run_jobs(
+    function: Callable[..., Any], jobs: int, *arguments: List[Any]
+) -> List[Any]:
+    # Maps function over the arguments in up to jobs worker processes
+    if jobs > 1 and len(arguments[0]) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(function, *arguments))
+    return list(map(function, *arguments))
 
 
 def main() -> None:
     args = argparser.parse_args()
 
     is_dir = os.path.isdir(args.target)
-    files_to_parse = []
     if is_dir:
         dir_name = os.path.basename(args.target)
         dst_file = f"{args.target}/{dir_name}.asm"
-        if os.path.exists(dst_file):
-            os.remove(dst_file)
-
-        parser = VMParser("", dst_file, "")
-        parser.bootstrap()
-
-        for file in os.listdir(args.target):
-            if file.endswith(".vm"):
-                file_name, _ = os.path.splitext(file)
-
-                src_file = os.path.join(args.target, file)
-
-                files_to_parse.append((src_file, dst_file, file_name))
     else:
         file_path, _ = os.path.splitext(args.target)
-        file_name = os.path.basename(args.target)
-        file_name, _ = os.path.splitext(file_name)
-
-        src_file = args.target
         dst_file = f"{file_path}.asm"
-        if os.path.exists(dst_file):
-            os.remove(dst_file)
 
-        files_to_parse.append((src_file, dst_file, file_name))
+    vm_files = list_vm_files(args.target)
+    src_files = [src_file for src_file, _ in vm_files]
+    file_names = [file_name for _, file_name in vm_files]
+    trampolines = [args.trampolines] * len(vm_files)
+    comments = [not args.no_comments] * len(vm_files)
+    optimize_vm = [args.optimize_vm] * len(vm_files)
+    if args.dead_functions and not is_dir:
+        argparser.error("--dead-functions needs a folder, entered through Sys.init")
+    if args.dead_functions:
+        # The call graph spans every file, so the files are read before any is
+        # translated
+        loaded = run_jobs(load_file, args.jobs, src_files, file_names, optimize_vm)
+        files, dead_functions = remove_dead_functions(
+            [
+                (file_name, instructions)
+                for file_name, (instructions, _) in zip(file_names, loaded)
+            ]
+        )
+        vm_bytes = sum(
+            vm_size_in_bytes(instructions) for _, instructions in dead_functions
+        )
+        print(
+            f"dead functions: removed {len(dead_functions)}, saving {vm_bytes} "
+            f".vm bytes and {rom_size_of(dead_functions, args.trampolines)} ROM words"
+        )
+        translated = run_jobs(
+            translate_instructions,
+            args.jobs,
+            [instructions for _, instructions in files],
+            file_names,
+            trampolines,
+            comments,
+        )
+        results = [
+            (*translation, vm_size)
+            for translation, (_, vm_size) in zip(translated, loaded)
+        ]
+    else:
+        results = run_jobs(
+            translate_file,
+            args.jobs,
+            src_files,
+            file_names,
+            trampolines,
+            comments,
+            optimize_vm,
+        )
+
+    lines: List[str] = []
+    shared_routines: Set[str] = set()
+    if is_dir:
+        parser = VMParser("", "", args.trampolines, not args.no_comments)
+        parser.bootstrap()
+        lines.extend(parser.lines)
+        shared_routines |= parser.shared_routines
+        if args.trampolines:
+            print(f"bootstrap: {parser.inline_rom_size} -> {parser.rom_size} words")
+
+    for file_name, (file_lines, inline_rom_size, file_routines, vm_size) in zip(
+        file_names, results
+    ):
+        lines.extend(file_lines)
+        shared_routines |= file_routines
+        if args.optimize_vm:
+            print(f"{file_name}.vm: {vm_size[0]} -> {vm_size[1]} VM instructions")
+        if args.trampolines:
+            rom_size = VMParser._count_instructions(file_lines)
+            print(f"{file_name}.vm: {inline_rom_size} -> {rom_size} words")
+
+    parser = VMParser("", "", args.trampolines, not args.no_comments)
+    parser.add_shared_routines(shared_routines)
+    lines.extend(parser.lines)
+    if args.trampolines:
+        print(f"shared routines: {parser.rom_size} words")
+
+    if args.optimize:
+        optimizer = AsmOptimizer()
+        lines = optimizer.optimize(lines)
+        print(
+            f"{dst_file}: {optimizer.instructions_before} -> "
+            f"{optimizer.instructions_after} instructions "
+            f"(saved {optimizer.saved()})"
+        )
 
-    for src_file, dst_file, file_name in files_to_parse:
-        parser = VMParser(src_file, dst_file, file_name)
-        parser.parse()
+    with open(dst_file, "w") as asm_file:
+        asm_file.write("\n".join(lines) + "\n")
 
 
 if __name__ == "__main__":
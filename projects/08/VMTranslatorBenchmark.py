@@ -0,0 +1,145 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from typing import List
+
+from VMTranslator import list_vm_files, translate_file
+
+argparser = argparse.ArgumentParser(
+    description="Benchmark for VMTranslator throughput in VM lines per second"
+)
+argparser.add_argument(
+    "targets",
+    help=".vm files or folders containing .vm files to translate. Defaults to FunctionCalls/StaticsTest and the generated inputs.",
+    type=str,
+    nargs="*",
+)
+argparser.add_argument(
+    "-l",
+    "--lines",
+    help="sizes in VM lines of the generated inputs.",
+    type=int,
+    nargs="+",
+    default=[10_000, 100_000],
+)
+argparser.add_argument(
+    "-r",
+    "--repeat",
+    help="number of timed runs per target; the fastest one is reported.",
+    type=int,
+    default=5,
+)
+
+# Commands a generated function body is drawn from, in the mix the Jack compiler emits
+_GENERATED_COMMANDS = [
+    "push constant {n}",
+    "push local {i}",
+    "push argument {i}",
+    "push this {i}",
+    "push that {i}",
+    "push static {i}",
+    "push temp {i}",
+    "push pointer {p}",
+    "pop local {i}",
+    "pop argument {i}",
+    "pop this {i}",
+    "pop that {i}",
+    "pop static {i}",
+    "pop temp {i}",
+    "pop pointer {p}",
+    "add",
+    "sub",
+    "neg",
+    "eq",
+    "gt",
+    "lt",
+    "and",
+    "or",
+    "not",
+    "call Gen.f{f} {i}",
+]
+
+
+def generate_vm_file(path: str, num_lines: int) -> None:
+    rng = random.Random(num_lines)
+    lines: List[str] = []
+    function = 0
+    while len(lines) < num_lines:
+        lines.append(f"function Gen.f{function} 4")
+        lines.append(f"label LOOP_{function}")
+        for _ in range(50):
+            lines.append(
+                rng.choice(_GENERATED_COMMANDS).format(
+                    n=rng.randrange(32768),
+                    i=rng.randrange(8),
+                    p=rng.randrange(2),
+                    f=rng.randrange(function + 1),
+                )
+            )
+        lines.append(f"if-goto LOOP_{function}")
+        lines.append("return")
+        function += 1
+    with open(path, "w") as vm_file:
+        vm_file.write("\n".join(lines) + "\n")
+
+
+def count_vm_lines(target: str) -> int:
+    num_lines = 0
+    for src_file, _ in list_vm_files(target):
+        with open(src_file, "r") as vm_file:
+            for line in vm_file:
+                line = line.strip()
+                if line and not line.startswith("//"):
+                    num_lines += 1
+    return num_lines
+
+
+def benchmark(target: str, comments: bool, repeat: int) -> float:
+    # Best time of translating every file of the target and writing one .asm file
+    best = float("inf")
+    with tempfile.TemporaryDirectory() as dst_dir:
+        dst_file = os.path.join(dst_dir, "out.asm")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            lines: List[str] = []
+            for src_file, file_name in list_vm_files(target):
+                file_lines, _, _, _ = translate_file(
+                    src_file, file_name, False, comments
+                )
+                lines.extend(file_lines)
+            with open(dst_file, "w") as asm_file:
+                asm_file.write("\n".join(lines) + "\n")
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as generated_dir:
+        targets = args.targets
+        if not targets:
+            targets = [
+                os.path.join(os.path.dirname(__file__), "FunctionCalls", "StaticsTest")
+            ]
+            for num_lines in args.lines:
+                path = os.path.join(generated_dir, f"Gen{num_lines}.vm")
+                generate_vm_file(path, num_lines)
+                targets.append(path)
+
+        for target in targets:
+            num_lines = count_vm_lines(target)
+            for comments in (True, False):
+                elapsed = benchmark(target, comments, args.repeat)
+                print(
+                    f"{os.path.basename(target)}: {num_lines} lines, "
+                    f"{'with' if comments else 'without'} comments: "
+                    f"{num_lines / elapsed:,.0f} lines/s"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,48 @@
 import argparse
+import hashlib
+import json
 import os
+import pickle
 import re
+import sys
 
-from collections import deque
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from typing import Any, Deque, Dict, List, Optional, Tuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+# The VM instructions are shared with the VM translator in project 08
+sys.path.insert(
+    1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "08")
+)
+
+from VMInstruction import OPCODES, Instruction, Opcode, write_vm
+
+# Sidecar index of the build cache, stored next to the compiled .jack files
+CACHE_INDEX_FILE = ".jackcache.json"
+
+
+def hash_file(file: str) -> str:
+    with open(file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Pickled class ASTs, stored in a folder next to the compiled .jack files
+AST_CACHE_DIR = ".jackast"
+
+# Any change to the compiler invalidates the build cache
+COMPILER_VERSION = hash_file(__file__)
 
 XML_OUTPUT = {
     "<": "&lt;",
@@ -85,32 +123,109 @@ class ArithmeticCommand(str, Enum):
 
 
 class Compiler:
-    def __init__(self, src_file: str, dst_file: str) -> None:
+    def __init__(
+        self,
+        src_file: str,
+        dst_file: str,
+        use_ast: bool = False,
+        ast_cache_dir: Optional[str] = None,
+        optimize: bool = False,
+        pool_strings: bool = False,
+        class_index: Optional["ClassIndex"] = None,
+    ) -> None:
         self.__src_file = src_file
         self.__dst_file = dst_file
+        self.__use_ast = use_ast or optimize or pool_strings or class_index is not None
+        self.__ast_cache_dir = ast_cache_dir
+        self.__optimize = optimize
+        self.__pool_strings = pool_strings
+        self.__class_index = class_index
+        # Math.multiply and Math.divide calls removed by the optimizer
+        self.eliminated_calls: Dict[str, int] = {}
 
     def compile(self, mode: CompilerMode) -> None:
+        if mode != CompilerMode.TOKENIZE and self.__use_ast:
+            node = load_class(self.__src_file, self.__ast_cache_dir)
+            if self.__optimize:
+                optimizer = AstOptimizer()
+                optimizer.optimize(node)
+                self.eliminated_calls = optimizer.eliminated_calls
+            generator = Generator(self.__dst_file)
+            CodeGenerator(generator, self.__pool_strings, self.__class_index).generate(
+                node
+            )
+            generator.write()
+            return
+
+        tokens = TokenStream.from_file(self.__src_file)
         if mode == CompilerMode.TOKENIZE:
-            tokenizer = Tokenizer(self.__src_file)
+            token_types = TokenStream.TOKEN_TYPES
+            lines = ["<tokens>"]
+            for kind, token in zip(tokens.kinds, tokens.values):
+                if token in XML_OUTPUT:
+                    token = XML_OUTPUT[token]
+                token_type = token_types[kind]
+                lines.append(f"<{token_type}> {token} </{token_type}>")
+            lines.append("</tokens>")
             with open(self.__dst_file, "w") as t_file:
-                t_file.write("<tokens>\n")
-                while tokenizer.has_more_tokens():
-                    tokenizer.advance()
-                    token_type, token = tokenizer.get_current_token()
-                    if token in XML_OUTPUT:
-                        token = XML_OUTPUT[token]
-                    t_file.write(f"<{token_type}> {token} </{token_type}>\n")
-                t_file.write("</tokens>\n")
-            del tokenizer
+                t_file.write("\n".join(lines) + "\n")
         elif mode == CompilerMode.PARSE or mode == CompilerMode.GENERATE:
-            tokenizer = Tokenizer(self.__src_file)
+            tokenizer = Tokenizer(tokens)
             parser = Parser(self.__dst_file, tokenizer)
             parser.parse()
-            del parser
-            del tokenizer
+            parser.write()
+
+
+class BuildCache:
+    # options names the command-line options that change the output, so that files
+    # compiled with other options are not mistaken for up to date
+    def __init__(self, index_file: str, options: str = "") -> None:
+        self.__index_file = index_file
+        self.__options = options
+        self.__entries: Dict[str, Dict[str, str]] = {}
+        self.__source_hashes: Dict[str, str] = {}
+        if os.path.exists(index_file):
+            try:
+                with open(index_file, "r") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+            if index.get("version") == COMPILER_VERSION:
+                self.__entries = index.get("entries", {})
+
+    def __key(self, src_file: str, mode: CompilerMode) -> str:
+        return f"{os.path.basename(src_file)}:{mode}{self.__options}"
+
+    def __source_hash(self, src_file: str) -> str:
+        if src_file not in self.__source_hashes:
+            self.__source_hashes[src_file] = hash_file(src_file)
+        return self.__source_hashes[src_file]
+
+    def is_up_to_date(self, src_file: str, dst_file: str, mode: CompilerMode) -> bool:
+        entry = self.__entries.get(self.__key(src_file, mode))
+        if entry is None or not os.path.exists(dst_file):
+            return False
+        return entry["source"] == self.__source_hash(src_file) and entry[
+            "output"
+        ] == hash_file(dst_file)
+
+    def update(self, src_file: str, dst_file: str, mode: CompilerMode) -> None:
+        self.__entries[self.__key(src_file, mode)] = {
+            "source": self.__source_hash(src_file),
+            "output": hash_file(dst_file),
+        }
+
+    def save(self) -> None:
+        with open(self.__index_file, "w") as f:
+            json.dump(
+                {"version": COMPILER_VERSION, "entries": self.__entries},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
 
 
-class Tokenizer:
+class TokenStream:
     __LEXICONS = {
         TokenType.KEYWORD: {
             "class",
@@ -158,190 +273,196 @@ class Tokenizer:
         },
     }
 
-    __DIGIT_PATTERN = r"[\d]+"
-
-    __IDENTIFIER_PATTERN = r"[a-zA-Z_][\w]*"
-    __IDENTIFIER_REGEX = re.compile(rf"{__IDENTIFIER_PATTERN}")
+    __MAX_INT_CONST = 32767
 
-    __SYMBOLS_PATTERN = "|".join(f"\{s}" for s in __LEXICONS[TokenType.SYMBOL])
+    # Token types in the order of their codes in TokenStream.kinds
+    TOKEN_TYPES = list(TokenType)
 
-    __COMPOSITE_REGEX = re.compile(
-        rf"{__SYMBOLS_PATTERN}|{__IDENTIFIER_PATTERN}|{__DIGIT_PATTERN}"
-    )
-
-    __QUOTE_PATTERN = r'"'
-    __QUOTE_REGEX = re.compile(rf"{__QUOTE_PATTERN}")
-
-    __TOKENS_QUEUE: Deque[Tuple[TokenType, str]] = deque()
+    __KEYWORD = TOKEN_TYPES.index(TokenType.KEYWORD)
+    __SYMBOL = TOKEN_TYPES.index(TokenType.SYMBOL)
+    __INT_CONST = TOKEN_TYPES.index(TokenType.INT_CONST)
+    __STRING_CONST = TOKEN_TYPES.index(TokenType.STRING_CONST)
+    __IDENTIFIER = TOKEN_TYPES.index(TokenType.IDENTIFIER)
 
-    __CURRENT_TOKEN: Tuple[Optional[TokenType], str] = (None, "")
+    # Token type code of every keyword and symbol; any other word is an identifier
+    __WORD_KINDS = {
+        **dict.fromkeys(__LEXICONS[TokenType.KEYWORD], __KEYWORD),
+        **dict.fromkeys(__LEXICONS[TokenType.SYMBOL], __SYMBOL),
+    }
 
-    def __init__(self, file: str) -> None:
-        self.__file = open(file, "r")
+    # Each match skips whitespace and comments, then captures one token. The token is
+    # empty at the end of the text, so that trailing comments are skipped too rather
+    # than failing the match and being rescanned from inside.
+    __MASTER_REGEX = re.compile(
+        r"""
+        (?P<skipped>(?:\s+|//[^\n]*|/\*.*?\*/)*+)
+        (?P<token>[A-Za-z_]\w*|\d+|"[^"\n]*"|/\*|\S|\Z)
+        """,
+        re.ASCII | re.DOTALL | re.VERBOSE,
+    )
 
-    def __del__(self) -> None:
-        self.__file.close()
+    def __init__(self, text: str) -> None:
+        # Token i has type TOKEN_TYPES[kinds[i]] and value values[i], and spans
+        # lengths[i] characters of the source starting at offsets[i]
+        self.text = text
+        self.kinds = array("B")
+        self.offsets = array("I")
+        self.lengths = array("I")
+        self.values: List[str] = []
+        self.__line_starts: Optional[array] = None
+        self.__tokenize()
+
+    @classmethod
+    def from_file(cls, file: str) -> "TokenStream":
+        with open(file, "r") as f:
+            return cls(f.read())
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __tokenize(self) -> None:
+        # Single pass over the whole text
+        word_kinds = self.__WORD_KINDS
+        identifier = self.__IDENTIFIER
+        kinds: List[int] = []
+        offsets: List[int] = []
+        values = self.values
+        intern = sys.intern
+        offset = 0
+        for skipped, token in self.__MASTER_REGEX.findall(self.text):
+            if not token:
+                break
+            offset += len(skipped)
+            kind = word_kinds.get(token)
+            if kind is None:
+                first = token[0]
+                if first.isascii() and (first.isalpha() or first == "_"):
+                    kind = identifier
+                elif "0" <= first <= "9":
+                    if (len(token) > 1 and first == "0") or int(
+                        token
+                    ) > self.__MAX_INT_CONST:
+                        raise Exception(
+                            f"Invalid token: {token} ({self.describe_offset(offset)})"
+                        )
+                    kind = self.__INT_CONST
+                elif first == '"' and len(token) > 1:
+                    kinds.append(self.__STRING_CONST)
+                    offsets.append(offset)
+                    values.append(intern(token[1:-1]))
+                    offset += len(token)
+                    continue
+                elif token == "/*":
+                    raise Exception(
+                        f"Unclosed comment ({self.describe_offset(offset)})"
+                    )
+                elif token == '"':
+                    raise Exception(f"Unclosed quote ({self.describe_offset(offset)})")
+                else:
+                    raise Exception(
+                        f"Invalid token: {token} ({self.describe_offset(offset)})"
+                    )
+            kinds.append(kind)
+            offsets.append(offset)
+            values.append(intern(token))
+            offset += len(token)
+
+        self.kinds = array("B", kinds)
+        self.offsets = array("I", offsets)
+        # Only string constants differ in length from their value, by the quotes
+        self.lengths = array("I", map(len, values))
+        for i, kind in enumerate(kinds):
+            if kind == self.__STRING_CONST:
+                self.lengths[i] += 2
+
+    def position_of_offset(self, offset: int) -> Tuple[int, int]:
+        # (line, column) of a source offset, both starting at 1
+        if self.__line_starts is None:
+            self.__line_starts = array(
+                "I", [0] + [m.end() for m in re.finditer("\n", self.text)]
+            )
+        line = bisect_right(self.__line_starts, offset)
+        return line, offset - self.__line_starts[line - 1] + 1
 
-    def __is_token_a_keyword(self, token: str) -> bool:
-        return token in self.__LEXICONS[TokenType.KEYWORD]
+    def position(self, index: int) -> Tuple[int, int]:
+        return self.position_of_offset(self.offsets[index])
 
-    def __is_token_a_symbol(self, token: str) -> bool:
-        return token in self.__LEXICONS[TokenType.SYMBOL]
+    def describe_offset(self, offset: int) -> str:
+        line, column = self.position_of_offset(offset)
+        return f"line: {line}, column: {column}"
 
-    def __is_token_an_integer_constant(self, token: str) -> bool:
-        if len(token) > 1 and token.startswith("0"):
-            return False
+    def token_type(self, index: int) -> TokenType:
+        return self.TOKEN_TYPES[self.kinds[index]]
 
-        return token.isdigit() and int(token) >= 0 and int(token) <= 32767
-
-    def __is_token_a_string_constant(self, token: str) -> bool:
-        return token.startswith('"') and token.endswith('"')
-
-    def __is_token_an_identifier(self, token: str) -> bool:
-        return self.__IDENTIFIER_REGEX.fullmatch(token) is not None
-
-    def __check_token_type(self, token: str) -> Optional[TokenType]:
-        if self.__is_token_a_keyword(token):
-            return TokenType.KEYWORD
-        elif self.__is_token_a_symbol(token):
-            return TokenType.SYMBOL
-        elif self.__is_token_an_integer_constant(token):
-            return TokenType.INT_CONST
-        elif self.__is_token_a_string_constant(token):
-            return TokenType.STRING_CONST
-        elif self.__is_token_an_identifier(token):
-            return TokenType.IDENTIFIER
-        else:
-            return None
-
-    def __update_tokens_queue(self) -> None:
-        if self.__file.closed:
-            raise Exception(f"${self.__file.name} is closed.")
-        if self.__TOKENS_QUEUE:
-            raise Exception(f"Tokens queue is not empty.")
-
-        is_read_next = True
-        line = ""
-        while is_read_next:
-            line = self.__file.readline()
-            # EOF returns an empty string
-            if not line:
-                return
-
-            line = line.strip()
-            if not line or line.startswith("//"):
-                continue
-            elif line.startswith("/*") or line.startswith("/**"):
-                s_line = line
-                while not line.endswith("*/"):
-                    line = self.__file.readline()
-                    # EOF returns an empty string
-                    if not line:
-                        raise Exception(f"Unclosed comment (line: {s_line})")
-                    line = line.strip()
-                continue
-
-            is_read_next = False
-
-            if "//" in line:
-                line = line.split("//")[0].strip()
-
-        tokens: List[str] = []
-        # Handle string constants
-        # Preserve everything inside each non-overlapping pair of double quotes
-        # Number of double quotes must be even
-        # Split the rest of the line by whitespace
-        # e.g. greeting = "Hello, World!"; => [greeting, =, "Hello, World!", ;]
-        if '"' in line:
-            quote_indexes = [m.start() for m in self.__QUOTE_REGEX.finditer(line)]
-            if len(quote_indexes) % 2 != 0:
-                raise Exception(f"Unclosed quote (line: {line})")
-            if quote_indexes[0] != 0:
-                tokens = tokens + line[: quote_indexes[0]].split()
-            for i in range(0, len(quote_indexes), 2):
-                start = quote_indexes[i]
-                end = quote_indexes[i + 1] + 1
-                tokens.append(line[start:end])
-                if i + 2 < len(quote_indexes):
-                    tokens = tokens + line[end : quote_indexes[i + 2]].split()
-            if quote_indexes[-1] != len(line) - 1:
-                tokens = tokens + line[quote_indexes[-1] + 1 :].split()
-        else:
-            tokens = line.split()
-
-        for token in tokens:
-            token_type = self.__check_token_type(token)
-            if token_type:
-                if token_type == TokenType.STRING_CONST:
-                    token = token.strip('"')
-                self.__TOKENS_QUEUE.append((token_type, token))
-            # Handle composite tokens (i.e. combinations of multiple token types)
-            # Break down composite tokens into sub-tokens
-            # Will not contain string constants
-            # e.g. (foo.bar() => ( foo . bar ( )
-            else:
-                invalid_tokens = self.__COMPOSITE_REGEX.sub("", token)
-                if invalid_tokens:
-                    raise Exception(
-                        f"Invalid token: {token} (invalid tokens: {invalid_tokens})"
-                    )
 
-                sub_tokens = (m.span() for m in self.__COMPOSITE_REGEX.finditer(token))
-                for start, end in sub_tokens:
-                    sub_token = token[start:end]
-                    token_type = self.__check_token_type(sub_token)
-                    if token_type:
-                        self.__TOKENS_QUEUE.append((token_type, sub_token))
-                    else:
-                        raise Exception(f"Invalid token: {sub_token}")
+class Tokenizer:
+    def __init__(self, tokens: TokenStream) -> None:
+        # Per-instance, so that files can be tokenized concurrently
+        self.__tokens = tokens
+        self.__token_types = TokenStream.TOKEN_TYPES
+        self.__next_token_index = 0
+        self.__current_token_index = -1
+        self.__current_token: Tuple[Optional[TokenType], str] = (None, "")
 
     def advance(self) -> None:
-        if self.__TOKENS_QUEUE:
-            self.__CURRENT_TOKEN = self.__TOKENS_QUEUE.popleft()
+        i = self.__next_token_index
+        if i < len(self.__tokens.kinds):
+            self.__current_token = (
+                self.__token_types[self.__tokens.kinds[i]],
+                self.__tokens.values[i],
+            )
+            self.__current_token_index = i
+            self.__next_token_index = i + 1
         else:
-            self.__CURRENT_TOKEN = (None, "")
+            self.__current_token = (None, "")
 
     def get_current_token(self) -> Tuple[Optional[TokenType], str]:
-        return self.__CURRENT_TOKEN
+        return self.__current_token
+
+    def get_current_position(self) -> Tuple[int, int]:
+        # (line, column) of the current token, both starting at 1
+        if self.__current_token_index < 0:
+            return (0, 0)
+        return self.__tokens.position(self.__current_token_index)
+
+    def describe_current_position(self) -> str:
+        line, column = self.get_current_position()
+        return f"line: {line}, column: {column}"
 
     def peek_next_token(self) -> Tuple[Optional[TokenType], str]:
-        if self.__TOKENS_QUEUE:
-            return self.__TOKENS_QUEUE[0]
+        i = self.__next_token_index
+        if i < len(self.__tokens.kinds):
+            return (self.__token_types[self.__tokens.kinds[i]], self.__tokens.values[i])
         else:
             return (None, "")
 
     def has_more_tokens(self) -> bool:
-        if self.__TOKENS_QUEUE:
-            return True
-        else:
-            self.__update_tokens_queue()
-            return bool(self.__TOKENS_QUEUE)
+        return self.__next_token_index < len(self.__tokens.kinds)
 
 
 class Parser:
     def __init__(self, file: str, tokenizer: Tokenizer) -> None:
-        self.__file = open(file, "w")
         self.__tokenizer = tokenizer
         self.__generator = Generator(file)
         self.__current_class = ""
         self.__current_subroutine_kind = ""
         self.__current_subroutine_name = ""
         self.__class_symbol_table = SymbolTable()
-        self.__subroutine_symbol_table = SymbolTable()
+        self.__subroutine_symbol_table = SymbolTable(self.__class_symbol_table)
         self.__if_label_counter = 0
         self.__while_label_counter = 0
 
         if self.__tokenizer.has_more_tokens():
             self.__tokenizer.advance()
 
-    def __del__(self) -> None:
-        self.__file.close()
+    def write(self) -> None:
+        self.__generator.write()
 
     def __process(self, expected_token: str) -> None:
         token_type, token = self.__tokenizer.get_current_token()
         if token != expected_token:
             raise Exception(
-                f"Expected token: {expected_token}, but got: {token} (token type: {token_type})"
+                f"Expected token: {expected_token}, but got: {token} (token type: {token_type}, {self.__tokenizer.describe_current_position()})"
             )
         if self.__tokenizer.has_more_tokens():
             self.__tokenizer.advance()
@@ -356,7 +477,7 @@ class Parser:
         stored_kind, stored_type, stored_index = None, None, None
         if token_type != TokenType.IDENTIFIER:
             raise Exception(
-                f"Expected token type: {TokenType.IDENTIFIER}, but got: {token_type} (token: {token})"
+                f"Expected token type: {TokenType.IDENTIFIER}, but got: {token_type} (token: {token}, {self.__tokenizer.describe_current_position()})"
             )
         # Variable declaration
         if is_declaration:
@@ -382,17 +503,14 @@ class Parser:
                 raise Exception(f"Invalid identifier kind: {kind}")
         # Variable usage
         else:
-            if token in self.__subroutine_symbol_table:
-                stored_kind = self.__subroutine_symbol_table.kind_of(token)
-                stored_type = self.__subroutine_symbol_table.type_of(token)
-                stored_index = self.__subroutine_symbol_table.index_of(token)
-            elif token in self.__class_symbol_table:
-                stored_kind = self.__class_symbol_table.kind_of(token)
-                stored_type = self.__class_symbol_table.type_of(token)
-                stored_index = self.__class_symbol_table.index_of(token)
-            # Safe to assume identifier is class name or subroutine name
-            else:
-                pass
+            symbol = self.__subroutine_symbol_table.resolve(token)
+            # Otherwise safe to assume identifier is class name or subroutine name
+            if symbol is not None:
+                stored_kind, stored_type, stored_index = (
+                    symbol.kind,
+                    symbol.type,
+                    symbol.index,
+                )
 
         if self.__tokenizer.has_more_tokens():
             self.__tokenizer.advance()
@@ -428,7 +546,7 @@ class Parser:
         self.__process(";")
 
     def __compile_subroutine_dec(self) -> None:
-        self.__subroutine_symbol_table.reset()
+        self.__subroutine_symbol_table = SymbolTable(self.__class_symbol_table)
         self.__current_subroutine_kind = self.__tokenizer.get_current_token()[1]
         self.__process(self.__current_subroutine_kind)
         if self.__current_subroutine_kind == SubroutineKind.METHOD:
@@ -765,9 +883,576 @@ class Parser:
         self.__compile_class()
 
 
-class SymbolTable:
+class Node:
+    __slots__: Tuple[str, ...] = ()
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{slot}={getattr(self, slot)!r}" for slot in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def walk(self) -> Iterator["Node"]:
+        # Yields the node and all of its descendants, depth first
+        yield self
+        for slot in self.__slots__:
+            value = getattr(self, slot)
+            if isinstance(value, Node):
+                yield from value.walk()
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, Node):
+                        yield from item.walk()
+
+
+class Expression(Node):
+    __slots__ = ()
+
+
+class IntegerConstant(Expression):
+    __slots__ = ("value",)
+
+    def __init__(self, value: int) -> None:
+        self.value = value
+
+
+class StringConstant(Expression):
+    __slots__ = ("value",)
+
+    def __init__(self, value: str) -> None:
+        self.value = value
+
+
+class KeywordConstant(Expression):
+    __slots__ = ("keyword",)
+
+    def __init__(self, keyword: str) -> None:
+        self.keyword = keyword
+
+
+class VariableReference(Expression):
+    __slots__ = ("name",)
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+class ArrayReference(Expression):
+    __slots__ = ("name", "index")
+
+    def __init__(self, name: str, index: Expression) -> None:
+        self.name = name
+        self.index = index
+
+
+class SubroutineCall(Expression):
+    # receiver is the variable or class name before the dot, if any
+    __slots__ = ("receiver", "name", "arguments")
+
+    def __init__(
+        self, receiver: Optional[str], name: str, arguments: List[Expression]
+    ) -> None:
+        self.receiver = receiver
+        self.name = name
+        self.arguments = arguments
+
+
+class UnaryOperation(Expression):
+    __slots__ = ("operator", "operand")
+
+    def __init__(self, operator: str, operand: Expression) -> None:
+        self.operator = operator
+        self.operand = operand
+
+
+class BinaryOperation(Expression):
+    # Jack has no operator precedence: a + b * c is (a + b) * c
+    __slots__ = ("operator", "left", "right")
+
+    def __init__(self, operator: str, left: Expression, right: Expression) -> None:
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+
+class LeftShift(Expression):
+    # operand * 2 ** amount, computed by doubling instead of calling Math.multiply
+    __slots__ = ("operand", "amount")
+
+    def __init__(self, operand: Expression, amount: int) -> None:
+        self.operand = operand
+        self.amount = amount
+
+
+class Statement(Node):
+    __slots__ = ()
+
+
+class LetStatement(Statement):
+    __slots__ = ("name", "index", "value")
+
+    def __init__(
+        self, name: str, index: Optional[Expression], value: Expression
+    ) -> None:
+        self.name = name
+        self.index = index
+        self.value = value
+
+
+class IfStatement(Statement):
+    __slots__ = ("condition", "then_statements", "else_statements")
+
+    def __init__(
+        self,
+        condition: Expression,
+        then_statements: List[Statement],
+        else_statements: Optional[List[Statement]],
+    ) -> None:
+        self.condition = condition
+        self.then_statements = then_statements
+        self.else_statements = else_statements
+
+
+class WhileStatement(Statement):
+    __slots__ = ("condition", "statements")
+
+    def __init__(self, condition: Expression, statements: List[Statement]) -> None:
+        self.condition = condition
+        self.statements = statements
+
+
+class DoStatement(Statement):
+    __slots__ = ("call",)
+
+    def __init__(self, call: Expression) -> None:
+        self.call = call
+
+
+class ReturnStatement(Statement):
+    __slots__ = ("value",)
+
+    def __init__(self, value: Optional[Expression]) -> None:
+        self.value = value
+
+
+class VariableDeclaration(Node):
+    __slots__ = ("kind", "type", "names")
+
+    def __init__(self, kind: IdentifierKind, type: str, names: List[str]) -> None:
+        self.kind = kind
+        self.type = type
+        self.names = names
+
+
+class SubroutineDeclaration(Node):
+    # parameters are (type, name) pairs
+    __slots__ = ("kind", "return_type", "name", "parameters", "locals", "statements")
+
+    def __init__(
+        self,
+        kind: SubroutineKind,
+        return_type: str,
+        name: str,
+        parameters: List[Tuple[str, str]],
+        locals: List[VariableDeclaration],
+        statements: List[Statement],
+    ) -> None:
+        self.kind = kind
+        self.return_type = return_type
+        self.name = name
+        self.parameters = parameters
+        self.locals = locals
+        self.statements = statements
+
+
+class ClassDeclaration(Node):
+    __slots__ = ("name", "class_variables", "subroutines")
+
+    def __init__(
+        self,
+        name: str,
+        class_variables: List[VariableDeclaration],
+        subroutines: List[SubroutineDeclaration],
+    ) -> None:
+        self.name = name
+        self.class_variables = class_variables
+        self.subroutines = subroutines
+
+
+class AstParser:
+    __OPERATORS = {"+", "-", "*", "/", "&", "|", "<", ">", "="}
+
+    __KEYWORD_CONSTANTS = {"true", "false", "null", "this"}
+
+    def __init__(self, tokenizer: Tokenizer) -> None:
+        self.__tokenizer = tokenizer
+        if self.__tokenizer.has_more_tokens():
+            self.__tokenizer.advance()
+
+    def __current(self) -> str:
+        return self.__tokenizer.get_current_token()[1]
+
+    def __process(self, expected_token: str) -> None:
+        token_type, token = self.__tokenizer.get_current_token()
+        if token != expected_token:
+            raise Exception(
+                f"Expected token: {expected_token}, but got: {token} (token type: {token_type}, {self.__tokenizer.describe_current_position()})"
+            )
+        if self.__tokenizer.has_more_tokens():
+            self.__tokenizer.advance()
+
+    def __process_identifier(self) -> str:
+        token_type, token = self.__tokenizer.get_current_token()
+        if token_type != TokenType.IDENTIFIER:
+            raise Exception(
+                f"Expected token type: {TokenType.IDENTIFIER}, but got: {token_type} (token: {token}, {self.__tokenizer.describe_current_position()})"
+            )
+        if self.__tokenizer.has_more_tokens():
+            self.__tokenizer.advance()
+
+        return token
+
+    def __process_type(self) -> str:
+        token_type, token = self.__tokenizer.get_current_token()
+        if token_type == TokenType.KEYWORD and token in {"int", "char", "boolean"}:
+            self.__process(token)
+            return token
+
+        return self.__process_identifier()
+
+    def __parse_variable_declaration(self, kind: IdentifierKind) -> VariableDeclaration:
+        self.__process(self.__current())
+        type = self.__process_type()
+        names = [self.__process_identifier()]
+        while self.__current() == ",":
+            self.__process(",")
+            names.append(self.__process_identifier())
+        self.__process(";")
+
+        return VariableDeclaration(kind, type, names)
+
+    def __parse_class(self) -> ClassDeclaration:
+        self.__process("class")
+        name = self.__process_identifier()
+        self.__process("{")
+        class_variables = []
+        while self.__current() in {IdentifierKind.STATIC, IdentifierKind.FIELD}:
+            class_variables.append(
+                self.__parse_variable_declaration(IdentifierKind(self.__current()))
+            )
+        subroutines = []
+        while self.__current() in {
+            SubroutineKind.CONSTRUCTOR,
+            SubroutineKind.FUNCTION,
+            SubroutineKind.METHOD,
+        }:
+            subroutines.append(self.__parse_subroutine())
+        self.__process("}")
+
+        return ClassDeclaration(name, class_variables, subroutines)
+
+    def __parse_subroutine(self) -> SubroutineDeclaration:
+        kind = SubroutineKind(self.__current())
+        self.__process(kind)
+        if self.__current() == "void":
+            self.__process("void")
+            return_type = "void"
+        else:
+            return_type = self.__process_type()
+        name = self.__process_identifier()
+        self.__process("(")
+        parameters = []
+        while self.__current() != ")":
+            type = self.__process_type()
+            parameters.append((type, self.__process_identifier()))
+            if self.__current() == ",":
+                self.__process(",")
+        self.__process(")")
+        self.__process("{")
+        locals = []
+        while self.__current() == "var":
+            locals.append(self.__parse_variable_declaration(IdentifierKind.LCL))
+        statements = self.__parse_statements()
+        self.__process("}")
+
+        return SubroutineDeclaration(
+            kind, return_type, name, parameters, locals, statements
+        )
+
+    def __parse_statements(self) -> List[Statement]:
+        statements: List[Statement] = []
+        while True:
+            token = self.__current()
+            if token == "let":
+                statements.append(self.__parse_let())
+            elif token == "if":
+                statements.append(self.__parse_if())
+            elif token == "while":
+                statements.append(self.__parse_while())
+            elif token == "do":
+                self.__process("do")
+                statements.append(DoStatement(self.__parse_expression()))
+                self.__process(";")
+            elif token == "return":
+                self.__process("return")
+                value = None
+                if self.__current() != ";":
+                    value = self.__parse_expression()
+                self.__process(";")
+                statements.append(ReturnStatement(value))
+            else:
+                return statements
+
+    def __parse_block(self) -> List[Statement]:
+        self.__process("{")
+        statements = self.__parse_statements()
+        self.__process("}")
+
+        return statements
+
+    def __parse_let(self) -> LetStatement:
+        self.__process("let")
+        name = self.__process_identifier()
+        index = None
+        if self.__current() == "[":
+            self.__process("[")
+            index = self.__parse_expression()
+            self.__process("]")
+        self.__process("=")
+        value = self.__parse_expression()
+        self.__process(";")
+
+        return LetStatement(name, index, value)
+
+    def __parse_if(self) -> IfStatement:
+        self.__process("if")
+        self.__process("(")
+        condition = self.__parse_expression()
+        self.__process(")")
+        then_statements = self.__parse_block()
+        else_statements = None
+        if self.__current() == "else":
+            self.__process("else")
+            else_statements = self.__parse_block()
+
+        return IfStatement(condition, then_statements, else_statements)
+
+    def __parse_while(self) -> WhileStatement:
+        self.__process("while")
+        self.__process("(")
+        condition = self.__parse_expression()
+        self.__process(")")
+
+        return WhileStatement(condition, self.__parse_block())
+
+    def __parse_expression(self) -> Expression:
+        expression = self.__parse_term()
+        while self.__current() in self.__OPERATORS:
+            operator = self.__current()
+            self.__process(operator)
+            expression = BinaryOperation(operator, expression, self.__parse_term())
+
+        return expression
+
+    def __parse_expression_list(self) -> List[Expression]:
+        expressions = []
+        if self.__current() != ")":
+            expressions.append(self.__parse_expression())
+            while self.__current() == ",":
+                self.__process(",")
+                expressions.append(self.__parse_expression())
+
+        return expressions
+
+    def __parse_term(self) -> Expression:
+        token_type, token = self.__tokenizer.get_current_token()
+        if token_type == TokenType.INT_CONST:
+            self.__process(token)
+            return IntegerConstant(int(token))
+        elif token_type == TokenType.STRING_CONST:
+            self.__process(token)
+            return StringConstant(token)
+        elif token_type == TokenType.KEYWORD and token in self.__KEYWORD_CONSTANTS:
+            self.__process(token)
+            return KeywordConstant(token)
+        elif token in {"-", "~"}:
+            self.__process(token)
+            return UnaryOperation(token, self.__parse_term())
+        elif token == "(":
+            self.__process("(")
+            expression = self.__parse_expression()
+            self.__process(")")
+            return expression
+
+        name = self.__process_identifier()
+        if self.__current() == ".":
+            self.__process(".")
+            subroutine_name = self.__process_identifier()
+            self.__process("(")
+            arguments = self.__parse_expression_list()
+            self.__process(")")
+            return SubroutineCall(name, subroutine_name, arguments)
+        elif self.__current() == "(":
+            self.__process("(")
+            arguments = self.__parse_expression_list()
+            self.__process(")")
+            return SubroutineCall(None, name, arguments)
+        elif self.__current() == "[":
+            self.__process("[")
+            index = self.__parse_expression()
+            self.__process("]")
+            return ArrayReference(name, index)
+
+        return VariableReference(name)
+
+    def parse(self) -> ClassDeclaration:
+        return self.__parse_class()
+
+
+def to_word(value: int) -> int:
+    # Wraps value to a signed 16-bit Hack word
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+
+def divide_words(x: int, y: int) -> int:
+    # Math.divide rounds towards zero
+    quotient = abs(x) // abs(y)
+    return quotient if (x < 0) == (y < 0) else -quotient
+
+
+class AstOptimizer:
+    __BINARY_FOLDERS: Dict[str, Callable[[int, int], int]] = {
+        "+": lambda x, y: x + y,
+        "-": lambda x, y: x - y,
+        "*": lambda x, y: x * y,
+        "/": divide_words,
+        "&": lambda x, y: x & y,
+        "|": lambda x, y: x | y,
+        # The Hack platform compares the sign of the wrapped difference, so 30000 > -30000
+        # is false at runtime and must fold the same way
+        "<": lambda x, y: -1 if to_word(x - y) < 0 else 0,
+        ">": lambda x, y: -1 if to_word(x - y) > 0 else 0,
+        "=": lambda x, y: -1 if x == y else 0,
+    }
+
+    __UNARY_FOLDERS: Dict[str, Callable[[int], int]] = {
+        "-": lambda x: -x,
+        "~": lambda x: ~x,
+    }
+
+    __CALL_OPERATORS = {
+        "*": "Math.multiply",
+        "/": "Math.divide",
+    }
+
     def __init__(self) -> None:
-        self.__table: Dict[str, Dict[str, Any]] = {}
+        # Math.multiply and Math.divide calls removed from the last optimized class
+        self.eliminated_calls: Dict[str, int] = {}
+
+    def __count_calls(self, node: Node) -> Dict[str, int]:
+        calls = dict.fromkeys(self.__CALL_OPERATORS.values(), 0)
+        for child in node.walk():
+            if (
+                isinstance(child, BinaryOperation)
+                and child.operator in self.__CALL_OPERATORS
+            ):
+                calls[self.__CALL_OPERATORS[child.operator]] += 1
+
+        return calls
+
+    def __is_pure(self, node: Expression) -> bool:
+        # Subroutine calls, including the String.new behind string constants, may
+        # have side effects and cannot be dropped
+        return not any(
+            isinstance(child, (SubroutineCall, StringConstant)) for child in node.walk()
+        )
+
+    def __optimize(self, node: Node) -> Node:
+        for slot in node.__slots__:
+            value = getattr(node, slot)
+            if isinstance(value, Node):
+                setattr(node, slot, self.__optimize(value))
+            elif isinstance(value, list):
+                setattr(
+                    node,
+                    slot,
+                    [
+                        self.__optimize(item) if isinstance(item, Node) else item
+                        for item in value
+                    ],
+                )
+
+        if isinstance(node, UnaryOperation):
+            return self.__fold_unary(node)
+        elif isinstance(node, BinaryOperation):
+            return self.__fold_binary(node)
+        return node
+
+    def __fold_unary(self, node: UnaryOperation) -> Expression:
+        if isinstance(node.operand, IntegerConstant):
+            return IntegerConstant(
+                to_word(self.__UNARY_FOLDERS[node.operator](node.operand.value))
+            )
+
+        return node
+
+    def __fold_binary(self, node: BinaryOperation) -> Expression:
+        left, right, operator = node.left, node.right, node.operator
+        if isinstance(left, IntegerConstant) and isinstance(right, IntegerConstant):
+            # Leave divisions that fail or overflow at runtime to Math.divide
+            if operator != "/" or (
+                right.value != 0 and -0x8000 not in (left.value, right.value)
+            ):
+                return IntegerConstant(
+                    to_word(self.__BINARY_FOLDERS[operator](left.value, right.value))
+                )
+            return node
+
+        if isinstance(right, IntegerConstant):
+            constant, operand = right.value, left
+        elif isinstance(left, IntegerConstant) and operator in {"+", "*", "&", "|"}:
+            constant, operand = left.value, right
+        else:
+            return node
+
+        # Only the commutative operators get here with the constant on the left
+        if (
+            (constant == 0 and operator in {"+", "-", "|"})
+            or (constant == 1 and operator in {"*", "/"})
+            or (constant == -1 and operator == "&")
+        ):
+            return operand
+        elif constant == 0 and operator in {"*", "&"} and self.__is_pure(operand):
+            return IntegerConstant(0)
+        elif operator == "*" and constant > 1 and constant & (constant - 1) == 0:
+            amount = constant.bit_length() - 1
+            if isinstance(operand, LeftShift):
+                return LeftShift(operand.operand, operand.amount + amount)
+            return LeftShift(operand, amount)
+
+        return node
+
+    def optimize(self, node: ClassDeclaration) -> None:
+        calls_before = self.__count_calls(node)
+        self.__optimize(node)
+        calls_after = self.__count_calls(node)
+        self.eliminated_calls = {
+            name: calls_before[name] - calls_after[name] for name in calls_before
+        }
+
+
+class Symbol:
+    __slots__ = ("kind", "type", "index")
+
+    def __init__(self, kind: IdentifierKind, type: str, index: int) -> None:
+        self.kind = kind
+        self.type = type
+        self.index = index
+
+
+class SymbolTable:
+    # A scope: names not defined here are resolved in the parent scope
+    def __init__(self, parent: Optional["SymbolTable"] = None) -> None:
+        self.__parent = parent
+        self.__table: Dict[str, Symbol] = {}
         self.__indexCount = {
             IdentifierKind.STATIC: 0,
             IdentifierKind.FIELD: 0,
@@ -781,82 +1466,555 @@ class SymbolTable:
     def define(self, name: str, kind: IdentifierKind, type: str) -> None:
         if name in self.__table:
             raise Exception(f"Symbol {name} already defined.")
-        self.__table[name] = {
-            "kind": kind,
-            "type": type,
-            "index": self.__indexCount[kind],
-        }
+        self.__table[name] = Symbol(kind, type, self.__indexCount[kind])
         self.__indexCount[kind] += 1
 
-    def reset(self) -> None:
-        self.__table.clear()
-        self.__indexCount = {
-            IdentifierKind.STATIC: 0,
-            IdentifierKind.FIELD: 0,
-            IdentifierKind.ARG: 0,
-            IdentifierKind.LCL: 0,
-        }
-
     def var_count(self, kind: IdentifierKind) -> int:
         return self.__indexCount[kind]
 
-    def kind_of(self, name: str) -> Optional[IdentifierKind]:
-        if name in self.__table:
-            assert isinstance(self.__table[name]["kind"], IdentifierKind)
-            return self.__table[name]["kind"]
+    def resolve(self, name: str) -> Optional[Symbol]:
+        symbol_table: Optional[SymbolTable] = self
+        while symbol_table is not None:
+            symbol = symbol_table.__table.get(name)
+            if symbol is not None:
+                return symbol
+            symbol_table = symbol_table.__parent
 
         return None
 
-    def type_of(self, name: str) -> Optional[str]:
-        if name in self.__table:
-            assert isinstance(self.__table[name]["type"], str)
-            return self.__table[name]["type"]
+    def kind_of(self, name: str) -> Optional[IdentifierKind]:
+        symbol = self.resolve(name)
+        return symbol.kind if symbol is not None else None
 
-        return None
+    def type_of(self, name: str) -> Optional[str]:
+        symbol = self.resolve(name)
+        return symbol.type if symbol is not None else None
 
     def index_of(self, name: str) -> Optional[int]:
-        if name in self.__table:
-            assert isinstance(self.__table[name]["index"], int)
-            return self.__table[name]["index"]
+        symbol = self.resolve(name)
+        return symbol.index if symbol is not None else None
 
-        return None
+
+class SubroutineSignature(NamedTuple):
+    kind: SubroutineKind
+    return_type: str
+    parameter_types: Tuple[str, ...]
+
+
+class ClassIndex:
+    # Subroutine signatures of every class compiled together, for checks across classes
+    def __init__(self) -> None:
+        self.__classes: Dict[str, Dict[str, SubroutineSignature]] = {}
+
+    @classmethod
+    def from_directory(
+        cls, directory: str, cache_dir: Optional[str] = None
+    ) -> "ClassIndex":
+        index = cls()
+        for file in sorted(os.listdir(directory)):
+            if file.endswith(".jack"):
+                try:
+                    index.add(load_class(os.path.join(directory, file), cache_dir))
+                except Exception:
+                    # Reported when the file itself is compiled
+                    pass
+
+        return index
+
+    def __contains__(self, class_name: str) -> bool:
+        return class_name in self.__classes
+
+    def add(self, node: ClassDeclaration) -> None:
+        self.__classes[node.name] = {
+            subroutine.name: SubroutineSignature(
+                subroutine.kind,
+                subroutine.return_type,
+                tuple(type for type, _ in subroutine.parameters),
+            )
+            for subroutine in node.subroutines
+        }
+
+    def signature_of(
+        self, class_name: str, subroutine_name: str
+    ) -> Optional[SubroutineSignature]:
+        return self.__classes.get(class_name, {}).get(subroutine_name)
+
+    def digest(self) -> str:
+        # Changes whenever any signature does
+        return hashlib.sha256(repr(sorted(self.__classes.items())).encode()).hexdigest()
 
 
 class Generator:
-    def __init__(self, file: str) -> None:
-        self.__file = open(file, "w")
+    # Enum .value lookups are slow, and every instruction needs one
+    __SEGMENT_NAMES = {segment: segment.value for segment in SegmentPointer}
+    __ARITHMETIC_OPCODES = {
+        command: OPCODES[command.value] for command in ArithmeticCommand
+    }
+
+    def __init__(self, file: Optional[str] = None) -> None:
+        # The instructions are collected in memory. With a file they are written out
+        # as VM text by write(), once the whole class has been generated; without one
+        # a build can hand them straight to the VM translator.
+        self.instructions: List[Instruction] = []
+        self.__file = file
 
-    def __del__(self) -> None:
-        self.__file.close()
+    def write(self) -> None:
+        if self.__file is None:
+            raise Exception("Generator has no output file.")
+        with open(self.__file, "w") as vm_file:
+            write_vm(self.instructions, vm_file)
+
+    def __emit(self, instruction: Instruction) -> None:
+        self.instructions.append(instruction)
 
     def generate_push(self, segment: SegmentPointer, index: int) -> None:
-        self.__file.write(f"push {segment} {index}\n")
+        self.__emit(Instruction(Opcode.PUSH, self.__SEGMENT_NAMES[segment], index))
 
     def generate_pop(self, segment: SegmentPointer, index: int) -> None:
         if segment == SegmentPointer.CONST:
             raise Exception("Cannot pop to constant segment.")
-        self.__file.write(f"pop {segment} {index}\n")
+        self.__emit(Instruction(Opcode.POP, self.__SEGMENT_NAMES[segment], index))
 
     def generate_arithmetic(self, command: ArithmeticCommand) -> None:
-        self.__file.write(f"{command}\n")
+        self.__emit(Instruction(self.__ARITHMETIC_OPCODES[command]))
 
     def generate_label(self, label: str) -> None:
-        self.__file.write(f"label {label}\n")
+        self.__emit(Instruction(Opcode.LABEL, label))
 
     def generate_goto(self, label: str) -> None:
-        self.__file.write(f"goto {label}\n")
+        self.__emit(Instruction(Opcode.GOTO, label))
 
     def generate_if_goto(self, label: str) -> None:
-        self.__file.write(f"if-goto {label}\n")
+        self.__emit(Instruction(Opcode.IF_GOTO, label))
 
     def generate_call(self, name: str, n_args: int) -> None:
-        self.__file.write(f"call {name} {n_args}\n")
+        self.__emit(Instruction(Opcode.CALL, name, n_args))
 
     def generate_function(self, name: str, n_locals: int) -> None:
-        self.__file.write(f"function {name} {n_locals}\n")
+        self.__emit(Instruction(Opcode.FUNCTION, name, n_locals))
 
     def generate_return(self) -> None:
-        self.__file.write("return\n")
+        self.__emit(Instruction(Opcode.RETURN))
+
+
+class CodeGenerator:
+    __SEGMENTS = {
+        IdentifierKind.STATIC: SegmentPointer.STATIC,
+        IdentifierKind.FIELD: SegmentPointer.THIS,
+        IdentifierKind.ARG: SegmentPointer.ARG,
+        IdentifierKind.LCL: SegmentPointer.LCL,
+    }
+
+    __ARITHMETIC_OPERATORS = {
+        "+": ArithmeticCommand.ADD,
+        "-": ArithmeticCommand.SUB,
+        "&": ArithmeticCommand.AND,
+        "|": ArithmeticCommand.OR,
+        "<": ArithmeticCommand.LT,
+        ">": ArithmeticCommand.GT,
+        "=": ArithmeticCommand.EQ,
+    }
+
+    __CALL_OPERATORS = {
+        "*": "Math.multiply",
+        "/": "Math.divide",
+    }
+
+    # The Hack platform maps the static segment to RAM[16..255]. This only bounds one
+    # class; the segment is shared by every class of the program, which jackc build
+    # checks as a whole.
+    __MAX_STATICS = 240
+
+    def __init__(
+        self,
+        generator: Generator,
+        pool_strings: bool = False,
+        class_index: Optional[ClassIndex] = None,
+    ) -> None:
+        self.__generator = generator
+        self.__class_index = class_index
+        self.__current_class = ""
+        self.__class_symbol_table = SymbolTable()
+        self.__subroutine_symbol_table = SymbolTable(self.__class_symbol_table)
+        self.__if_label_counter = 0
+        self.__while_label_counter = 0
+        self.__pool_strings = pool_strings
+        # Static slot of each pooled string literal, and the literals used more than
+        # once, which are built by a shared function instead of at every use
+        self.__string_slots: Dict[str, int] = {}
+        self.__shared_strings: Set[str] = set()
+
+    def __resolve_variable(self, name: str) -> Symbol:
+        symbol = self.__subroutine_symbol_table.resolve(name)
+        if symbol is None:
+            raise Exception(f"Invalid identifier: {name} (kind: None, index: None)")
+        return symbol
+
+    def __push_variable(self, name: str) -> None:
+        symbol = self.__resolve_variable(name)
+        self.__generator.generate_push(self.__SEGMENTS[symbol.kind], symbol.index)
+
+    def __generate_class(self, node: ClassDeclaration) -> None:
+        self.__current_class = node.name
+        for declaration in node.class_variables:
+            for name in declaration.names:
+                self.__class_symbol_table.define(
+                    name, declaration.kind, declaration.type
+                )
+        if self.__pool_strings:
+            self.__allocate_strings(node)
+        for subroutine in node.subroutines:
+            self.__generate_subroutine(subroutine)
+        for value in self.__string_slots:
+            if value in self.__shared_strings:
+                self.__generator.generate_function(self.__string_function(value), 0)
+                self.__generate_pooled_string(value)
+                self.__generator.generate_return()
+
+    def __allocate_strings(self, node: ClassDeclaration) -> None:
+        # Gives each distinct literal a static slot after the declared statics
+        uses: Dict[str, int] = {}
+        for child in node.walk():
+            if isinstance(child, StringConstant):
+                uses[child.value] = uses.get(child.value, 0) + 1
+        first_slot = self.__class_symbol_table.var_count(IdentifierKind.STATIC)
+        if first_slot + len(uses) > self.__MAX_STATICS:
+            raise Exception(
+                f"Too many static variables to pool string literals: {node.name} "
+                f"(statics: {first_slot}, literals: {len(uses)})"
+            )
+        self.__string_slots = {value: first_slot + i for i, value in enumerate(uses)}
+        self.__shared_strings = {value for value, count in uses.items() if count > 1}
+
+    def __string_function(self, value: str) -> str:
+        return f"{self.__current_class}.$string.{self.__string_slots[value]}"
+
+    def __generate_pooled_string(self, value: str) -> None:
+        # Builds the literal into its static slot on first use, then pushes the slot
+        slot = self.__string_slots[value]
+        label = f"STRING_{slot}"
+        self.__generator.generate_push(SegmentPointer.STATIC, slot)
+        self.__generator.generate_if_goto(label)
+        self.__generate_string(value)
+        self.__generator.generate_pop(SegmentPointer.STATIC, slot)
+        self.__generator.generate_label(label)
+        self.__generator.generate_push(SegmentPointer.STATIC, slot)
+
+    def __generate_string(self, value: str) -> None:
+        self.__generator.generate_push(SegmentPointer.CONST, len(value))
+        self.__generator.generate_call("String.new", 1)
+        for c in value:
+            self.__generator.generate_push(SegmentPointer.CONST, ord(c))
+            self.__generator.generate_call("String.appendChar", 2)
+
+    def __generate_subroutine(self, node: SubroutineDeclaration) -> None:
+        self.__subroutine_symbol_table = SymbolTable(self.__class_symbol_table)
+        if node.kind == SubroutineKind.METHOD:
+            self.__subroutine_symbol_table.define(
+                "this", IdentifierKind.ARG, self.__current_class
+            )
+        for type, name in node.parameters:
+            self.__subroutine_symbol_table.define(name, IdentifierKind.ARG, type)
+        for declaration in node.locals:
+            for name in declaration.names:
+                self.__subroutine_symbol_table.define(
+                    name, IdentifierKind.LCL, declaration.type
+                )
+        self.__generator.generate_function(
+            f"{self.__current_class}.{node.name}",
+            self.__subroutine_symbol_table.var_count(IdentifierKind.LCL),
+        )
+        if node.kind == SubroutineKind.CONSTRUCTOR:
+            self.__generator.generate_push(
+                SegmentPointer.CONST,
+                self.__class_symbol_table.var_count(IdentifierKind.FIELD),
+            )
+            self.__generator.generate_call("Memory.alloc", 1)
+            self.__generator.generate_pop(SegmentPointer.POINTER, 0)
+        elif node.kind == SubroutineKind.METHOD:
+            self.__generator.generate_push(SegmentPointer.ARG, 0)
+            self.__generator.generate_pop(SegmentPointer.POINTER, 0)
+        self.__generate_statements(node.statements)
+
+    def __generate_statements(self, statements: List[Statement]) -> None:
+        for statement in statements:
+            if isinstance(statement, LetStatement):
+                self.__generate_let(statement)
+            elif isinstance(statement, IfStatement):
+                self.__generate_if(statement)
+            elif isinstance(statement, WhileStatement):
+                self.__generate_while(statement)
+            elif isinstance(statement, DoStatement):
+                self.__generate_expression(statement.call)
+                self.__generator.generate_pop(SegmentPointer.TEMP, 0)
+            elif isinstance(statement, ReturnStatement):
+                if statement.value is not None:
+                    self.__generate_expression(statement.value)
+                else:
+                    self.__generator.generate_push(SegmentPointer.CONST, 0)
+                self.__generator.generate_return()
+            else:
+                raise Exception(f"Invalid statement: {statement}")
+
+    def __generate_let(self, node: LetStatement) -> None:
+        symbol = self.__resolve_variable(node.name)
+        if node.index is not None:
+            self.__generator.generate_push(self.__SEGMENTS[symbol.kind], symbol.index)
+            self.__generate_expression(node.index)
+            self.__generator.generate_arithmetic(ArithmeticCommand.ADD)
+            self.__generate_expression(node.value)
+            self.__generator.generate_pop(SegmentPointer.TEMP, 0)
+            self.__generator.generate_pop(SegmentPointer.POINTER, 1)
+            self.__generator.generate_push(SegmentPointer.TEMP, 0)
+            self.__generator.generate_pop(SegmentPointer.THAT, 0)
+        else:
+            self.__generate_expression(node.value)
+            self.__generator.generate_pop(self.__SEGMENTS[symbol.kind], symbol.index)
+
+    def __generate_if(self, node: IfStatement) -> None:
+        label1 = f"IF_L1_{self.__if_label_counter}"
+        self.__if_label_counter += 1
+        label2 = f"IF_L2_{self.__if_label_counter}"
+        self.__if_label_counter += 1
+        self.__generate_expression(node.condition)
+        self.__generator.generate_arithmetic(ArithmeticCommand.NOT)
+        self.__generator.generate_if_goto(label1)
+        self.__generate_statements(node.then_statements)
+        if node.else_statements is not None:
+            self.__generator.generate_goto(label2)
+            self.__generator.generate_label(label1)
+            self.__generate_statements(node.else_statements)
+            self.__generator.generate_label(label2)
+        else:
+            self.__generator.generate_label(label1)
+
+    def __generate_while(self, node: WhileStatement) -> None:
+        label1 = f"WHILE_L1_{self.__while_label_counter}"
+        self.__while_label_counter += 1
+        label2 = f"WHILE_L2_{self.__while_label_counter}"
+        self.__while_label_counter += 1
+        self.__generator.generate_label(label1)
+        self.__generate_expression(node.condition)
+        self.__generator.generate_arithmetic(ArithmeticCommand.NOT)
+        self.__generator.generate_if_goto(label2)
+        self.__generate_statements(node.statements)
+        self.__generator.generate_goto(label1)
+        self.__generator.generate_label(label2)
+
+    def __generate_expression(self, node: Expression) -> None:
+        if isinstance(node, IntegerConstant):
+            self.__generate_integer(node.value)
+        elif isinstance(node, VariableReference):
+            self.__push_variable(node.name)
+        elif isinstance(node, BinaryOperation):
+            self.__generate_expression(node.left)
+            self.__generate_expression(node.right)
+            if node.operator in self.__ARITHMETIC_OPERATORS:
+                self.__generator.generate_arithmetic(
+                    self.__ARITHMETIC_OPERATORS[node.operator]
+                )
+            else:
+                self.__generator.generate_call(self.__CALL_OPERATORS[node.operator], 2)
+        elif isinstance(node, SubroutineCall):
+            self.__generate_call(node)
+        elif isinstance(node, ArrayReference):
+            self.__push_variable(node.name)
+            self.__generate_expression(node.index)
+            self.__generator.generate_arithmetic(ArithmeticCommand.ADD)
+            self.__generator.generate_pop(SegmentPointer.POINTER, 1)
+            self.__generator.generate_push(SegmentPointer.THAT, 0)
+        elif isinstance(node, LeftShift):
+            self.__generate_left_shift(node)
+        elif isinstance(node, UnaryOperation):
+            self.__generate_expression(node.operand)
+            if node.operator == "-":
+                self.__generator.generate_arithmetic(ArithmeticCommand.NEG)
+            else:
+                self.__generator.generate_arithmetic(ArithmeticCommand.NOT)
+        elif isinstance(node, KeywordConstant):
+            if node.keyword == "true":
+                self.__generator.generate_push(SegmentPointer.CONST, 1)
+                self.__generator.generate_arithmetic(ArithmeticCommand.NEG)
+            elif node.keyword in {"false", "null"}:
+                self.__generator.generate_push(SegmentPointer.CONST, 0)
+            else:
+                self.__generator.generate_push(SegmentPointer.POINTER, 0)
+        elif isinstance(node, StringConstant):
+            if node.value in self.__shared_strings:
+                self.__generator.generate_call(self.__string_function(node.value), 0)
+            elif node.value in self.__string_slots:
+                self.__generate_pooled_string(node.value)
+            else:
+                self.__generate_string(node.value)
+        else:
+            raise Exception(f"Invalid expression: {node}")
+
+    def __generate_integer(self, value: int) -> None:
+        # Folded constants may be negative, which push constant cannot express
+        if value >= 0:
+            self.__generator.generate_push(SegmentPointer.CONST, value)
+        elif value == -0x8000:
+            self.__generator.generate_push(SegmentPointer.CONST, 0x7FFF)
+            self.__generator.generate_arithmetic(ArithmeticCommand.NEG)
+            self.__generator.generate_push(SegmentPointer.CONST, 1)
+            self.__generator.generate_arithmetic(ArithmeticCommand.SUB)
+        else:
+            self.__generator.generate_push(SegmentPointer.CONST, -value)
+            self.__generator.generate_arithmetic(ArithmeticCommand.NEG)
+
+    def __generate_left_shift(self, node: LeftShift) -> None:
+        amount = node.amount
+        if isinstance(node.operand, VariableReference):
+            self.__push_variable(node.operand.name)
+            self.__push_variable(node.operand.name)
+            self.__generator.generate_arithmetic(ArithmeticCommand.ADD)
+            amount -= 1
+        else:
+            self.__generate_expression(node.operand)
+        for _ in range(amount):
+            self.__generator.generate_pop(SegmentPointer.TEMP, 0)
+            self.__generator.generate_push(SegmentPointer.TEMP, 0)
+            self.__generator.generate_push(SegmentPointer.TEMP, 0)
+            self.__generator.generate_arithmetic(ArithmeticCommand.ADD)
+
+    def __generate_call(self, node: SubroutineCall) -> None:
+        n_args = len(node.arguments)
+        if node.receiver is None:
+            # Method of the current object
+            self.__generator.generate_push(SegmentPointer.POINTER, 0)
+            class_name = self.__current_class
+            n_args += 1
+        else:
+            symbol = self.__subroutine_symbol_table.resolve(node.receiver)
+            if symbol is not None:
+                # Method of the object stored in a variable
+                self.__generator.generate_push(
+                    self.__SEGMENTS[symbol.kind], symbol.index
+                )
+                class_name = symbol.type
+                n_args += 1
+            else:
+                class_name = node.receiver
+        name = f"{class_name}.{node.name}"
+        if self.__class_index is not None and class_name in self.__class_index:
+            self.__check_call(class_name, node, n_args > len(node.arguments))
+        for argument in node.arguments:
+            self.__generate_expression(argument)
+        self.__generator.generate_call(name, n_args)
+
+    def __check_call(
+        self, class_name: str, node: SubroutineCall, is_method_call: bool
+    ) -> None:
+        assert self.__class_index is not None
+        name = f"{class_name}.{node.name}"
+        signature = self.__class_index.signature_of(class_name, node.name)
+        if signature is None:
+            raise Exception(f"Unknown subroutine: {name}")
+        if (signature.kind == SubroutineKind.METHOD) != is_method_call:
+            raise Exception(
+                f"Invalid call: {name} is a {signature.kind}, but was called "
+                f"{'on an object' if is_method_call else 'on its class'}"
+            )
+        if len(node.arguments) != len(signature.parameter_types):
+            raise Exception(
+                f"Invalid call: {name} expects {len(signature.parameter_types)} "
+                f"argument(s), but got {len(node.arguments)}"
+            )
+
+    def generate(self, node: ClassDeclaration) -> None:
+        self.__generate_class(node)
+
+
+class AstUnpickler(pickle.Unpickler):
+    # A tree pickled by the JackCompiler script names its classes __main__.*, one
+    # pickled by a module importing JackCompiler names them JackCompiler.*. Both are
+    # this module, whichever way it was loaded.
+    def find_class(self, module: str, name: str) -> Any:
+        if module in {"__main__", __name__}:
+            return getattr(sys.modules[__name__], name)
+        return super().find_class(module, name)
+
+
+def load_class(src_file: str, cache_dir: Optional[str] = None) -> ClassDeclaration:
+    # Parses a .jack file into an AST, reusing the copy pickled in cache_dir if the
+    # source and the compiler are unchanged
+    cache_file = None
+    if cache_dir is not None:
+        source_hash = hash_file(src_file)
+        cache_file = os.path.join(cache_dir, f"{os.path.basename(src_file)}.pickle")
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "rb") as f:
+                    version, cached_hash, node = AstUnpickler(f).load()
+                if version == COMPILER_VERSION and cached_hash == source_hash:
+                    assert isinstance(node, ClassDeclaration)
+                    return node
+            except (
+                AttributeError,
+                ImportError,
+                OSError,
+                ValueError,
+                pickle.UnpicklingError,
+            ):
+                pass
+
+    node = AstParser(Tokenizer(TokenStream.from_file(src_file))).parse()
+    if cache_dir is not None and cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file, "wb") as f:
+            pickle.dump(
+                (COMPILER_VERSION, source_hash, node),
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+
+    return node
+
+
+def generate_class(
+    node: ClassDeclaration,
+    optimize: bool = False,
+    pool_strings: bool = False,
+    class_index: Optional[ClassIndex] = None,
+) -> List[Instruction]:
+    # Generates the VM instructions of a parsed class in memory, for builds that
+    # hand them straight to the VM translator
+    if optimize:
+        AstOptimizer().optimize(node)
+    generator = Generator()
+    CodeGenerator(generator, pool_strings, class_index).generate(node)
+    return generator.instructions
+
+
+def compile_file(
+    src_file: str,
+    dst_file: str,
+    mode: CompilerMode,
+    use_ast: bool = False,
+    ast_cache_dir: Optional[str] = None,
+    optimize: bool = False,
+    pool_strings: bool = False,
+    class_index: Optional[ClassIndex] = None,
+) -> Tuple[Optional[str], Dict[str, int]]:
+    # Compiles one file, returning its error instead of raising and the calls removed
+    # by the optimizer; run in a worker process
+    try:
+        compiler = Compiler(
+            src_file,
+            dst_file,
+            use_ast,
+            ast_cache_dir,
+            optimize,
+            pool_strings,
+            class_index,
+        )
+        compiler.compile(mode)
+        eliminated_calls = compiler.eliminated_calls
+        del compiler
+    except Exception as e:
+        return str(e), {}
+
+    return None, eliminated_calls
 
 
 argparser = argparse.ArgumentParser(
@@ -875,6 +2033,43 @@ argparser.add_argument(
     default=CompilerMode.GENERATE,
     help="action of the %(prog)s. t = tokenize, p = parse, g = generate. (default: %(default)s)",
 )
+argparser.add_argument(
+    "-c",
+    "--cache",
+    help=f"skip .jack files whose source and output are unchanged since they were last compiled by the same compiler version. Hashes are kept in a {CACHE_INDEX_FILE} file next to the .jack files.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-a",
+    "--ast",
+    help=f"parse each class into an abstract syntax tree and generate code from the tree, instead of generating code while parsing. With --cache, the trees are also pickled into a {AST_CACHE_DIR} folder next to the .jack files.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-O",
+    "--optimize",
+    help="fold constant expressions and replace multiplications by powers of two with additions, then report the Math.multiply and Math.divide calls removed from each class. Implies --ast.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-s",
+    "--pool-strings",
+    help="build each distinct string literal of a class once, into a static variable, the first time it is used, and reuse it after that. The literals become shared objects, so the program must not modify or dispose them. Implies --ast.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-k",
+    "--check-calls",
+    help="check every call to a class in the same folder against the subroutine's declaration: the subroutine must exist, be called on an object exactly when it is a method, and get one argument per parameter. Implies --ast.",
+    action="store_true",
+)
+argparser.add_argument(
+    "-j",
+    "--jobs",
+    help="number of processes compiling files concurrently. (default: %(default)s)",
+    type=int,
+    default=1,
+)
 
 
 def main() -> None:
@@ -913,9 +2108,107 @@ def main() -> None:
 
         files_to_compile.append((src_file, dst_file))
 
-    for src_file, dst_file in files_to_compile:
-        compiler = Compiler(src_file, dst_file)
-        compiler.compile(args.mode)
+    src_dir = args.target if is_dir else os.path.dirname(args.target)
+    ast_cache_dir = None
+    if args.cache and (
+        args.ast or args.optimize or args.pool_strings or args.check_calls
+    ):
+        ast_cache_dir = os.path.join(src_dir, AST_CACHE_DIR)
+
+    class_index = None
+    if args.check_calls and args.mode == CompilerMode.GENERATE:
+        class_index = ClassIndex.from_directory(src_dir or ".", ast_cache_dir)
+
+    cache = None
+    if args.cache:
+        options = ("-O" if args.optimize else "") + ("-s" if args.pool_strings else "")
+        if class_index is not None:
+            # Callers are rechecked whenever any signature changes
+            options += f"-k{class_index.digest()}"
+        cache = BuildCache(os.path.join(src_dir, CACHE_INDEX_FILE), options)
+
+    if cache is not None:
+        files_to_skip = [
+            (src_file, dst_file)
+            for src_file, dst_file in files_to_compile
+            if cache.is_up_to_date(src_file, dst_file, args.mode)
+        ]
+        files_to_compile = [
+            files for files in files_to_compile if files not in files_to_skip
+        ]
+
+    src_files = [src_file for src_file, _ in files_to_compile]
+    dst_files = [dst_file for _, dst_file in files_to_compile]
+    modes = [args.mode] * len(files_to_compile)
+    use_ast = [args.ast] * len(files_to_compile)
+    ast_cache_dirs = [ast_cache_dir] * len(files_to_compile)
+    optimize = [args.optimize] * len(files_to_compile)
+    pool_strings = [args.pool_strings] * len(files_to_compile)
+    class_indexes = [class_index] * len(files_to_compile)
+    arguments = (
+        src_files,
+        dst_files,
+        modes,
+        use_ast,
+        ast_cache_dirs,
+        optimize,
+        pool_strings,
+        class_indexes,
+    )
+    if args.jobs > 1 and len(files_to_compile) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(compile_file, *arguments))
+    else:
+        results = list(map(compile_file, *arguments))
+
+    num_failed = 0
+    total_eliminated_calls: Dict[str, int] = {}
+    for src_file, dst_file, (error, eliminated_calls) in zip(
+        src_files, dst_files, results
+    ):
+        if error is not None:
+            num_failed += 1
+            print(f"{src_file}: {error}", file=sys.stderr)
+            continue
+
+        if cache is not None:
+            cache.update(src_file, dst_file, args.mode)
+        if args.optimize and args.mode == CompilerMode.GENERATE:
+            class_name, _ = os.path.splitext(os.path.basename(src_file))
+            print(
+                f"{class_name}: eliminated "
+                + ", ".join(
+                    f"{count} {name}" for name, count in eliminated_calls.items()
+                )
+                + " call(s)"
+            )
+            for name, count in eliminated_calls.items():
+                total_eliminated_calls[name] = (
+                    total_eliminated_calls.get(name, 0) + count
+                )
+
+    if total_eliminated_calls:
+        print(
+            "Total: eliminated "
+            + ", ".join(
+                f"{count} {name}" for name, count in total_eliminated_calls.items()
+            )
+            + " call(s)"
+        )
+
+    if cache is not None:
+        cache.save()
+        print(
+            f"Compiled {len(files_to_compile) - num_failed} file(s), "
+            f"{len(files_to_skip)} unchanged"
+        )
+
+    if num_failed:
+        print(
+            f"{num_failed} of {len(files_to_compile)} file(s) failed to compile",
+            file=sys.stderr,
+        )
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,361 @@
+import argparse
+import os
+import sys
+
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+# The VM translator and the assembler live in their own projects
+PROJECTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(PROJECTS_DIR, "08"))
+sys.path.insert(1, os.path.join(PROJECTS_DIR, "06"))
+
+from JackCompiler import (
+    AST_CACHE_DIR,
+    ClassDeclaration,
+    ClassIndex,
+    generate_class,
+    load_class,
+)
+from VMInstruction import Instruction, Opcode, parse_vm, write_vm
+from VMOptimizer import VMOptimizer, remove_dead_functions, vm_size_in_bytes
+from VMTranslator import AsmOptimizer, VMParser, rom_size_of
+from assembler import (
+    OutputFormat,
+    assemble_program,
+    write_bin,
+    write_hack,
+    write_image,
+)
+
+ROM_SIZE = 32768
+# The static segments of all classes share RAM[16..255]
+MAX_STATICS = 240
+OUTPUT_EXTENSIONS = {
+    OutputFormat.TEXT: "hack",
+    OutputFormat.BIN: "bin",
+    OutputFormat.IMAGE: "himg",
+}
+
+
+class BuildError(Exception):
+    pass
+
+
+def list_folders(path: str, recursive: bool) -> Iterator[List[str]]:
+    # The files of path, one folder at a time, parent folders before their subfolders
+    if not os.path.isdir(path):
+        yield [path]
+        return
+    for folder, dir_names, file_names in os.walk(path):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith("."))
+        yield [os.path.join(folder, file) for file in sorted(file_names)]
+        if not recursive:
+            break
+
+
+def find_sources(target: str, libraries: List[str]) -> List[Tuple[str, str]]:
+    # (source file, class name) of every class in the build. A class in the target
+    # shadows library classes of the same name, and earlier libraries shadow later
+    # ones; within a folder a .jack file wins over the .vm file compiled from it.
+    # Library folders are searched with their subfolders, e.g. projects/12 keeps
+    # each OS class in a folder of its own.
+    sources: List[Tuple[str, str]] = []
+    class_names = set()
+    folders = list(list_folders(target, False))
+    for library in libraries:
+        folders.extend(list_folders(library, True))
+    for files in folders:
+        jack_classes = {
+            os.path.splitext(os.path.basename(file))[0]
+            for file in files
+            if file.endswith(".jack")
+        }
+        for file in files:
+            class_name, extension = os.path.splitext(os.path.basename(file))
+            if extension not in {".jack", ".vm"} or class_name in class_names:
+                continue
+            if extension == ".vm" and class_name in jack_classes:
+                continue
+            sources.append((file, class_name))
+            class_names.add(class_name)
+
+    return sources
+
+
+def parse_classes(
+    sources: Iterable[Tuple[str, str]], cache: bool = False
+) -> Iterator[Tuple[str, str, Optional[ClassDeclaration]]]:
+    # Stage 1: Jack source -> tokens -> AST. .vm sources pass through without a tree.
+    for src_file, class_name in sources:
+        if not src_file.endswith(".jack"):
+            yield src_file, class_name, None
+            continue
+        ast_cache_dir = None
+        if cache:
+            ast_cache_dir = os.path.join(os.path.dirname(src_file), AST_CACHE_DIR)
+        try:
+            node = load_class(src_file, ast_cache_dir)
+        except Exception as e:
+            raise BuildError(f"{src_file}: {e}")
+        yield src_file, class_name, node
+
+
+def generate_classes(
+    classes: Iterable[Tuple[str, str, Optional[ClassDeclaration]]],
+    optimize: bool = False,
+    pool_strings: bool = False,
+    class_index: Optional[ClassIndex] = None,
+    vm_optimizer: Optional[VMOptimizer] = None,
+    keep_vm: bool = False,
+) -> Iterator[Tuple[str, List[Instruction]]]:
+    # Stage 2: AST -> VM instructions, one class at a time, optimized by vm_optimizer
+    for src_file, class_name, node in classes:
+        try:
+            if node is None:
+                with open(src_file, "r") as vm_file:
+                    instructions = list(parse_vm(vm_file))
+            else:
+                instructions = generate_class(node, optimize, pool_strings, class_index)
+        except Exception as e:
+            raise BuildError(f"{src_file}: {e}")
+        if vm_optimizer is not None:
+            instructions = vm_optimizer.optimize(instructions, class_name)
+        if keep_vm and node is not None:
+            file_path, _ = os.path.splitext(src_file)
+            with open(f"{file_path}.vm", "w") as vm_file:
+                write_vm(instructions, vm_file)
+        yield class_name, instructions
+
+
+def translate_classes(
+    classes: Iterable[Tuple[str, List[Instruction]]],
+    trampolines: bool = False,
+    comments: bool = False,
+) -> Iterator[str]:
+    # Stage 3: VM instructions -> Hack assembly, starting with the bootstrap code and
+    # ending with the routines shared by the whole program
+    parser = VMParser("", "", trampolines, comments)
+    parser.bootstrap()
+    shared_routines = set(parser.shared_routines)
+    functions: Set[str] = set()
+    calls = {"Sys.init"}
+    static_count = 0
+    yield from parser.lines
+
+    for class_name, instructions in classes:
+        parser = VMParser("", class_name, trampolines, comments)
+        try:
+            parser.parse_instructions(instructions)
+        except Exception as e:
+            raise BuildError(f"{class_name}.vm: {e}")
+        shared_routines |= parser.shared_routines
+        yield from parser.lines
+        statics: Set[int] = set()
+        for instruction in instructions:
+            if instruction.opcode == Opcode.FUNCTION:
+                functions.add(instruction.arg)
+            elif instruction.opcode == Opcode.CALL:
+                calls.add(instruction.arg)
+            elif instruction.arg == "static" and instruction.opcode in {
+                Opcode.PUSH,
+                Opcode.POP,
+            }:
+                statics.add(instruction.index)
+        static_count += len(statics)
+
+    # A call to a missing function would assemble into a jump to a variable
+    missing = sorted(calls - functions)
+    if missing:
+        raise BuildError(f"undefined function(s): {', '.join(missing)}")
+    # More would be allocated on top of the stack
+    if static_count > MAX_STATICS:
+        raise BuildError(
+            f"too many static variables: {static_count} (at most {MAX_STATICS})"
+        )
+
+    parser = VMParser("", "", trampolines, comments)
+    parser.add_shared_routines(shared_routines)
+    yield from parser.lines
+
+
+def tee_lines(lines: Iterable[str], file: str) -> Iterator[str]:
+    # Passes lines on unchanged while also writing them to file
+    with open(file, "w") as dst_file:
+        for line in lines:
+            dst_file.write(f"{line}\n")
+            yield line
+
+
+argparser = argparse.ArgumentParser(
+    description="Build driver for Jack programs that chains the Jack compiler, the VM translator and the assembler in memory",
+    prog="jackc",
+)
+subparsers = argparser.add_subparsers(dest="command", required=True)
+build_parser = subparsers.add_parser(
+    "build",
+    help="compile a folder of .jack files into a Hack program.",
+    description="Compile a folder of .jack files, together with any libraries, into a single Hack program. Jack classes are parsed, compiled to VM commands, translated to assembly and assembled without writing any intermediate file, unless asked to.",
+)
+build_parser.add_argument(
+    "target",
+    help="folder containing the .jack (or .vm) files of the program. The output will be a file named after the folder, inside it.",
+    type=str,
+)
+build_parser.add_argument(
+    "-L",
+    "--lib",
+    help="folder or .jack/.vm file of library classes, such as the operating system, to build with the program. Subfolders are searched too. Can be given several times; classes in the target, then in earlier libraries, shadow classes of the same name.",
+    action="append",
+    default=[],
+)
+build_parser.add_argument(
+    "-f",
+    "--format",
+    choices=[OutputFormat.TEXT, OutputFormat.BIN, OutputFormat.IMAGE],
+    default=OutputFormat.TEXT,
+    help="output format, as for the assembler. (default: %(default)s)",
+)
+build_parser.add_argument(
+    "-o",
+    "--output",
+    help="output file. (default: <target>/<target>.hack, .bin or .himg)",
+    type=str,
+)
+build_parser.add_argument(
+    "-O",
+    "--optimize",
+    help="fold constant expressions in the Jack classes, optimize their VM code and run the peephole optimizer over the assembly.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "-s",
+    "--pool-strings",
+    help="build each distinct string literal of a class once and reuse it, as JackCompiler --pool-strings does.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "-k",
+    "--check-calls",
+    help="check every call between the Jack classes of the build against the subroutine's declaration, as JackCompiler --check-calls does.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "-t",
+    "--trampolines",
+    help="share one copy of the call and return sequences, as VMTranslator --trampolines does.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "-d",
+    "--dead-functions",
+    help="drop every function that no chain of calls from Sys.init reaches, and report the .vm bytes and ROM words saved. All classes are compiled before any is translated.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "-c",
+    "--cache",
+    help=f"pickle the syntax tree of each class into a {AST_CACHE_DIR} folder next to it and reuse it while the class is unchanged.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "--keep-vm",
+    help="also write the .vm file of each compiled .jack file next to it.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "--keep-asm",
+    help="also write the assembly to <target>/<target>.asm, annotated with the VM commands it was translated from.",
+    action="store_true",
+)
+
+
+def build(args: argparse.Namespace) -> None:
+    target = os.path.normpath(args.target)
+    if not os.path.isdir(target):
+        raise BuildError(f"{target}: not a folder")
+    dir_name = os.path.basename(os.path.abspath(target))
+    output_file = args.output
+    if output_file is None:
+        output_file = os.path.join(
+            target, f"{dir_name}.{OUTPUT_EXTENSIONS[args.format]}"
+        )
+
+    sources = find_sources(target, args.lib)
+    if not sources:
+        raise BuildError(f"{target}: no .jack or .vm files")
+
+    classes: Iterable[Tuple[str, str, Optional[ClassDeclaration]]] = parse_classes(
+        sources, args.cache
+    )
+    class_index = None
+    if args.check_calls:
+        # Every signature is needed before the first call can be checked
+        classes = list(classes)
+        class_index = ClassIndex()
+        for _, _, node in classes:
+            if node is not None:
+                class_index.add(node)
+
+    vm_optimizer = VMOptimizer()
+    vm_classes: Iterable[Tuple[str, List[Instruction]]] = generate_classes(
+        classes,
+        args.optimize,
+        args.pool_strings,
+        class_index,
+        vm_optimizer if args.optimize else None,
+        args.keep_vm,
+    )
+    if args.dead_functions:
+        # The call graph spans every class
+        vm_classes, dead_functions = remove_dead_functions(list(vm_classes))
+        vm_bytes = sum(
+            vm_size_in_bytes(instructions) for _, instructions in dead_functions
+        )
+        print(
+            f"dead functions: removed {len(dead_functions)}, saving {vm_bytes} "
+            f".vm bytes and {rom_size_of(dead_functions, args.trampolines)} ROM words"
+        )
+    asm_lines: Iterable[str] = translate_classes(
+        vm_classes, args.trampolines, args.keep_asm
+    )
+    if args.optimize:
+        # The peephole optimizer rewrites across lines, so it needs them all at once
+        optimizer = AsmOptimizer()
+        asm_lines = optimizer.optimize(list(asm_lines))
+        print(
+            f"VM code: {vm_optimizer.instructions_before} -> "
+            f"{vm_optimizer.instructions_after} instructions "
+            f"(saved {vm_optimizer.saved()})"
+        )
+        print(
+            f"assembly: {optimizer.instructions_before} -> "
+            f"{optimizer.instructions_after} instructions "
+            f"(saved {optimizer.saved()})"
+        )
+    if args.keep_asm:
+        asm_lines = tee_lines(asm_lines, os.path.join(target, f"{dir_name}.asm"))
+
+    words, labels, variables = assemble_program(asm_lines)
+    if args.format == OutputFormat.TEXT:
+        write_hack(words, output_file)
+    elif args.format == OutputFormat.BIN:
+        write_bin(words, output_file)
+    elif args.format == OutputFormat.IMAGE:
+        write_image(words, labels, variables, output_file)
+
+    rom_note = " (too large for the 32K ROM)" if len(words) > ROM_SIZE else ""
+    print(f"{output_file}: {len(sources)} class(es), {len(words)} words{rom_note}")
+
+
+def main() -> None:
+    args = argparser.parse_args()
+    try:
+        if args.command == "build":
+            build(args)
+    except BuildError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
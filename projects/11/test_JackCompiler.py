@@ -0,0 +1,36 @@
+import unittest
+
+from JackCompiler import AstParser, TokenStream, Tokenizer
+
+CLASS_SOURCE = "class Main {\n    function void main() {\n        return;\n    }\n}\n"
+CLASS_TOKENS = ["class", "Main", "{", "function", "void", "main", "(", ")", "{"]
+CLASS_TOKENS += ["return", ";", "}", "}"]
+
+
+class TrailingCommentTest(unittest.TestCase):
+    def assert_tokens(self, text: str) -> None:
+        tokens = TokenStream(text)
+        self.assertEqual(list(tokens.values), CLASS_TOKENS)
+        # The offsets of the tokens before the comment are unaffected by it
+        self.assertEqual(list(tokens.offsets), list(TokenStream(CLASS_SOURCE).offsets))
+
+    def test_line_comment(self) -> None:
+        self.assert_tokens(f"{CLASS_SOURCE}// trailing comment\n")
+
+    def test_line_comment_without_newline(self) -> None:
+        self.assert_tokens(f"{CLASS_SOURCE}// trailing comment")
+
+    def test_block_comment(self) -> None:
+        self.assert_tokens(f"{CLASS_SOURCE}/* block */")
+
+    def test_comments_with_non_jack_characters(self) -> None:
+        self.assert_tokens(f"{CLASS_SOURCE}// Main class: don't edit\n/* #@! */\n")
+
+    def test_compiles(self) -> None:
+        tokens = TokenStream(f"{CLASS_SOURCE}// Main class: don't edit\n")
+        node = AstParser(Tokenizer(tokens)).parse()
+        self.assertEqual(node.name, "Main")
+
+
+if __name__ == "__main__":
+    unittest.main()